@@ -0,0 +1,160 @@
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
+from typing import Callable, Deque, Iterable, Iterator, List, Optional, Tuple
+
+from generate import HTMLContent, NewsletterGenerator, PlaceholderData
+from instrumentation import MetricsSnapshot, metrics
+
+# Constants
+DEFAULT_CHUNK_SIZE = 50
+PENDING_CHUNKS_PER_WORKER = 2
+
+logger = logging.getLogger(__name__)
+
+IndexedRecord = Tuple[int, PlaceholderData]
+
+RenderFunction = Callable[[PlaceholderData], List[bytes]]
+# Builds the render function from the generator and shared data; must be picklable
+RendererFactory = Callable[[NewsletterGenerator, Optional[PlaceholderData]], RenderFunction]
+
+# Per-process render function, built once by _init_worker
+_worker_render: Optional[RenderFunction] = None
+
+
+@dataclass
+class RecordResult:
+    """Outcome of rendering one record: either the HTML as UTF-8 chunks or the error message.
+
+    Chunks that come from the shared skeleton are the same objects in every
+    result, so a chunk of results pickles each of them only once.
+    """
+    index: int
+    chunks: Optional[List[bytes]] = None
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        """Whether the record rendered successfully."""
+        return self.error is None
+
+    @property
+    def html(self) -> Optional[HTMLContent]:
+        """The rendered HTML joined into one string."""
+        return b"".join(self.chunks).decode("utf-8") if self.chunks is not None else None
+
+
+def _init_worker(generator: NewsletterGenerator, newsletter_data: Optional[PlaceholderData],
+                 trace_memory: bool = False, renderer_factory: Optional[RendererFactory] = None) -> None:
+    """Build the compiled template and inlining state once per worker process."""
+    global _worker_render
+    # Forked workers inherit the parent's metrics; only report their own
+    metrics.reset()
+    if trace_memory:
+        metrics.enable_memory_tracing()
+    _worker_render = _build_renderer(generator, newsletter_data, renderer_factory)
+
+
+def _build_renderer(generator: NewsletterGenerator, newsletter_data: Optional[PlaceholderData],
+                    renderer_factory: Optional[RendererFactory]) -> RenderFunction:
+    """The factory's render function, or plain HTML chunks by default."""
+    if renderer_factory is None:
+        return generator.chunk_renderer(newsletter_data)
+    return renderer_factory(generator, newsletter_data)
+
+
+def _render_chunk(chunk: List[IndexedRecord]) -> Tuple[List[RecordResult], MetricsSnapshot]:
+    """Render a chunk of records in a worker, capturing failures per record.
+
+    The worker's metrics since the previous chunk are returned alongside.
+    """
+    return _render_records(_worker_render, chunk), metrics.drain()
+
+
+def _render_records(render: RenderFunction,
+                    chunk: List[IndexedRecord]) -> List[RecordResult]:
+    """Render records one by one so a bad record only fails itself."""
+    results = []
+    for index, record in chunk:
+        try:
+            results.append(RecordResult(index=index, chunks=render(record)))
+        except Exception as e:
+            results.append(RecordResult(index=index, error=f"{type(e).__name__}: {e}"))
+    return results
+
+
+def _chunked(records: Iterable[PlaceholderData], chunk_size: int,
+             start: int) -> Iterator[List[IndexedRecord]]:
+    """Group records into numbered chunks without materializing the input."""
+    indexed = enumerate(records, start=start)
+    while True:
+        chunk = list(islice(indexed, chunk_size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class BatchRunner:
+    """Render many records across a process pool, yielding results in input order.
+
+    Each worker compiles the template and builds its inlining state once at
+    startup and then renders whole chunks of records. Only a bounded number
+    of chunks is in flight at any time, so memory stays flat for long lists.
+    With ``workers=1`` records are rendered in-process. Metrics recorded by
+    the workers are merged into this process's metrics as chunks complete.
+    A ``renderer_factory`` (e.g. ``mime_messages.message_renderer``) replaces
+    the generator's plain HTML chunk renderer.
+    """
+
+    def __init__(
+        self,
+        generator: NewsletterGenerator,
+        workers: Optional[int] = None,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        newsletter_data: Optional[PlaceholderData] = None,
+        renderer_factory: Optional[RendererFactory] = None
+    ):
+        self.generator = generator
+        self.workers = workers or os.cpu_count() or 1
+        self.chunk_size = chunk_size
+        self.newsletter_data = newsletter_data
+        self.renderer_factory = renderer_factory
+
+    def run(self, records: Iterable[PlaceholderData], start: int = 0) -> Iterator[RecordResult]:
+        """Yield one RecordResult per record, numbered from ``start``, in order."""
+        chunks = _chunked(records, self.chunk_size, start)
+
+        if self.workers <= 1:
+            render = _build_renderer(self.generator, self.newsletter_data, self.renderer_factory)
+            for chunk in chunks:
+                yield from _render_records(render, chunk)
+            return
+
+        logger.info(f"Rendering with {self.workers} worker processes, {self.chunk_size} records per chunk")
+        with ProcessPoolExecutor(
+            max_workers=self.workers,
+            initializer=_init_worker,
+            initargs=(self.generator, self.newsletter_data, metrics.trace_memory, self.renderer_factory)
+        ) as executor:
+            pending: Deque[Tuple[List[IndexedRecord], Future]] = deque()
+            max_pending = self.workers * PENDING_CHUNKS_PER_WORKER
+
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(_render_chunk, chunk)))
+                if len(pending) >= max_pending:
+                    yield from self._collect(*pending.popleft())
+            while pending:
+                yield from self._collect(*pending.popleft())
+
+    def _collect(self, chunk: List[IndexedRecord], future: Future) -> List[RecordResult]:
+        """Wait for a chunk; if the worker itself failed, fail each of its records."""
+        try:
+            results, snapshot = future.result()
+        except Exception as e:
+            logger.error(f"Chunk starting at record {chunk[0][0]} failed: {e}")
+            return [RecordResult(index=index, error=f"{type(e).__name__}: {e}") for index, _ in chunk]
+        metrics.merge(snapshot)
+        return results
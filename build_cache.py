@@ -0,0 +1,105 @@
+import hashlib
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Optional, Union
+
+from instrumentation import metrics
+from streaming import AtomicStreamWriter
+
+# Constants
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_MAX_AGE_SECONDS = 30 * 24 * 3600
+ENTRY_SUFFIX = ".html"
+
+logger = logging.getLogger(__name__)
+
+KeyPart = Union[str, bytes]
+
+
+class BuildCache:
+    """A directory of intermediate pipeline results, each stored under a hash of its inputs.
+
+    Keys are derived from a stage name and everything that stage reads (see
+    ``key``), so a result can be reused by any later run, or any other issue,
+    with the same inputs. Entries are plain HTML files; a hit refreshes the
+    file's modification time, which ``evict`` uses to drop entries that were
+    not used for ``max_age`` seconds and then the least recently used ones
+    until the cache fits in ``max_bytes``.
+    """
+
+    def __init__(self, directory: Union[str, Path], max_bytes: int = DEFAULT_MAX_BYTES,
+                 max_age: float = DEFAULT_MAX_AGE_SECONDS):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(stage: str, *parts: KeyPart) -> str:
+        """Hash a stage name and its inputs into an entry key."""
+        digest = hashlib.sha256(stage.encode("utf-8"))
+        for part in parts:
+            data = part.encode("utf-8") if isinstance(part, str) else part
+            # Length-prefix every part so different splits never collide
+            digest.update(len(data).to_bytes(8, "big"))
+            digest.update(data)
+        return f"{stage}-{digest.hexdigest()}"
+
+    def _path(self, key: str) -> Path:
+        """Location of an entry."""
+        return self.directory / f"{key}{ENTRY_SUFFIX}"
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the stored result for ``key``, or None on a miss."""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                content = f.read()
+        except FileNotFoundError:
+            self.misses += 1
+            metrics.increment("build_cache.misses")
+            return None
+        os.utime(path)
+        self.hits += 1
+        metrics.increment("build_cache.hits")
+        return content
+
+    def put(self, key: str, content: str) -> None:
+        """Store a result, replacing the entry atomically."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        with AtomicStreamWriter(self._path(key)) as out:
+            out.write(content)
+
+    def evict(self) -> int:
+        """Drop expired entries, then the least recently used ones over the size bound.
+
+        Returns the number of entries removed.
+        """
+        if not self.directory.is_dir():
+            return 0
+        entries = []
+        for path in self.directory.glob(f"*{ENTRY_SUFFIX}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        expired_before = time.time() - self.max_age
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, path in entries:
+            if mtime >= expired_before and total <= self.max_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+
+        if removed:
+            metrics.increment("build_cache.evictions", removed)
+            logger.info(f"Evicted {removed} build cache entries from {self.directory}")
+        return removed
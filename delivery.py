@@ -0,0 +1,610 @@
+import asyncio
+import base64
+import json
+import logging
+import re
+import socket
+import ssl
+import time
+from dataclasses import dataclass
+from email.utils import parseaddr
+from functools import partial
+from itertools import islice
+from pathlib import Path
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple, Union
+
+from batch import DEFAULT_CHUNK_SIZE, BatchRunner
+from generate import MAIL_SETTINGS_KEY, NewsletterGenerator, PlaceholderData, log_operation
+from instrumentation import metrics
+from mail_merge import iter_recipients
+from mime_messages import RECIPIENT_ADDRESS_KEY, message_renderer
+
+# Constants
+DEFAULT_SMTP_PORT = 25
+DEFAULT_CONNECTIONS = 4
+DEFAULT_QUEUE_SIZE = 200
+DEFAULT_MAX_ATTEMPTS = 5
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 300.0
+SMTP_TIMEOUT_SECONDS = 60.0
+JOURNAL_SUFFIX = ".delivery-journal.jsonl"
+FINAL_STATUSES = ('sent', 'failed')
+CRLF = b"\r\n"
+LEADING_DOT_PATTERN = re.compile(rb'^\.', re.MULTILINE)
+
+logger = logging.getLogger(__name__)
+
+SMTPResponse = Tuple[int, List[str]]
+
+
+class SMTPError(Exception):
+    """An SMTP reply other than the expected one."""
+
+    def __init__(self, code: int, message: str):
+        super().__init__(f"{code} {message}")
+        self.code = code
+        self.message = message
+
+    @property
+    def transient(self) -> bool:
+        """4xx replies are worth retrying; 5xx replies are final."""
+        return 400 <= self.code < 500
+
+
+class SMTPSetupError(SMTPError):
+    """STARTTLS or authentication failed, so the session cannot be used as configured."""
+
+
+@dataclass(frozen=True)
+class SMTPSettings:
+    """Where and how to connect. ``use_tls`` is implicit TLS (port 465), ``starttls`` upgrades."""
+    host: str = "localhost"
+    port: int = DEFAULT_SMTP_PORT
+    starttls: bool = False
+    use_tls: bool = False
+    username: Optional[str] = None
+    password: Optional[str] = None
+    local_hostname: Optional[str] = None
+    timeout: float = SMTP_TIMEOUT_SECONDS
+
+    @classmethod
+    def from_address(cls, address: str, **options) -> 'SMTPSettings':
+        """Parse ``HOST[:PORT]``."""
+        host, _, port = address.rpartition(':') if ':' in address else (address, '', '')
+        return cls(host=host, port=int(port) if port else DEFAULT_SMTP_PORT, **options)
+
+
+def _dot_stuff(chunk: bytes) -> bytes:
+    """Double leading dots; chunks always start at the beginning of a line."""
+    return LEADING_DOT_PATTERN.sub(b'..', chunk)
+
+
+class SMTPConnection:
+    """One SMTP session on asyncio streams.
+
+    Supports EHLO (falling back to HELO), STARTTLS, AUTH PLAIN and, when the
+    server advertises PIPELINING, sends MAIL, all RCPT commands and DATA in a
+    single write. The session stays open across messages.
+    """
+
+    def __init__(self, settings: SMTPSettings):
+        self.settings = settings
+        self.extensions: Dict[str, str] = {}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def connect(self) -> None:
+        """Open the connection and complete the greeting, TLS and authentication."""
+        settings = self.settings
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(settings.host, settings.port,
+                                    ssl=ssl.create_default_context() if settings.use_tls else None),
+            settings.timeout
+        )
+        self._check(await self._read_response(), 220)
+        await self._hello()
+        if settings.starttls:
+            if 'starttls' not in self.extensions:
+                raise SMTPSetupError(530, "Server does not offer STARTTLS")
+            try:
+                await self._command(b"STARTTLS", 220)
+            except SMTPError as e:
+                raise SMTPSetupError(e.code, f"STARTTLS refused: {e.message}") from e
+            await self._writer.start_tls(ssl.create_default_context(), server_hostname=settings.host)
+            await self._hello()
+        if settings.username:
+            credentials = f"\0{settings.username}\0{settings.password or ''}".encode('utf-8')
+            try:
+                await self._command(b"AUTH PLAIN " + base64.b64encode(credentials), 235)
+            except SMTPError as e:
+                raise SMTPSetupError(e.code, f"Authentication failed: {e.message}") from e
+        metrics.increment('smtp.connections')
+
+    async def _hello(self) -> None:
+        """EHLO and record the extensions; HELO for servers without ESMTP."""
+        name = (self.settings.local_hostname or socket.getfqdn()).encode('ascii', 'replace')
+        code, lines = await self._request(b"EHLO " + name)
+        if code == 250:
+            self.extensions = {line.split(' ', 1)[0].lower(): line for line in lines[1:]}
+        else:
+            await self._command(b"HELO " + name, 250)
+            self.extensions = {}
+
+    async def _read_response(self) -> SMTPResponse:
+        """Read one (possibly multiline) reply."""
+        lines = []
+        while True:
+            line = await asyncio.wait_for(self._reader.readline(), self.settings.timeout)
+            if not line:
+                raise ConnectionError("Connection closed by the server")
+            text = line.decode('utf-8', 'replace').rstrip('\r\n')
+            lines.append(text[4:])
+            if text[3:4] != '-':
+                return int(text[:3]), lines
+
+    async def _request(self, command: bytes) -> SMTPResponse:
+        """Send a command and return the reply."""
+        self._writer.write(command + CRLF)
+        await self._writer.drain()
+        return await self._read_response()
+
+    async def _command(self, command: bytes, expected: int) -> List[str]:
+        """Send a command and fail unless the reply has the expected code."""
+        return self._check(await self._request(command), expected)
+
+    @staticmethod
+    def _check(response: SMTPResponse, expected: int) -> List[str]:
+        code, lines = response
+        if code != expected:
+            raise SMTPError(code, ' '.join(lines))
+        return lines
+
+    async def send(self, sender: str, recipients: List[str], chunks: List[bytes]) -> Dict[str, SMTPError]:
+        """Send one message and return the recipients the server refused.
+
+        Raises SMTPError when the whole transaction fails (MAIL, DATA or all
+        recipients refused); the session is reset and can be reused.
+        """
+        envelope = [f"MAIL FROM:<{sender}>".encode('utf-8')]
+        envelope += [f"RCPT TO:<{recipient}>".encode('utf-8') for recipient in recipients]
+        if 'pipelining' in self.extensions:
+            self._writer.write(b"".join(command + CRLF for command in envelope + [b"DATA"]))
+            await self._writer.drain()
+            responses = [await self._read_response() for _ in range(len(envelope) + 1)]
+            data_response = responses.pop()
+        else:
+            responses = [await self._request(envelope[0])]
+            if responses[0][0] == 250:
+                responses += [await self._request(command) for command in envelope[1:]]
+            data_response = None
+
+        refused = {
+            recipient: SMTPError(code, ' '.join(lines))
+            for recipient, (code, lines) in zip(recipients, responses[1:]) if code not in (250, 251)
+        }
+        mail_code, mail_lines = responses[0]
+        if mail_code != 250 or len(refused) == len(recipients):
+            if data_response is not None and data_response[0] == 354:
+                # Some servers accept DATA even without recipients; end it empty
+                await self._request(b".")
+            await self.reset()
+            if mail_code != 250:
+                raise SMTPError(mail_code, ' '.join(mail_lines))
+            raise next(iter(refused.values()))
+
+        if data_response is None:
+            data_response = await self._request(b"DATA")
+        if data_response[0] != 354:
+            await self.reset()
+            raise SMTPError(data_response[0], ' '.join(data_response[1]))
+        for chunk in chunks:
+            self._writer.write(_dot_stuff(chunk))
+        if chunks and not chunks[-1].endswith(CRLF):
+            self._writer.write(CRLF)
+        await self._command(b".", 250)
+        return refused
+
+    async def reset(self) -> None:
+        """Abort the current transaction."""
+        await self._command(b"RSET", 250)
+
+    async def close(self) -> None:
+        """Say goodbye and close the connection, ignoring errors."""
+        if self._writer is None:
+            return
+        try:
+            await asyncio.wait_for(self._request(b"QUIT"), self.settings.timeout)
+        except (OSError, ConnectionError, asyncio.TimeoutError, SMTPError):
+            pass
+        self._writer.close()
+        self._writer = None
+
+
+class DomainRateLimiter:
+    """Spread messages to each recipient domain evenly at a fixed rate (messages per second).
+
+    Domains without their own rate use ``default_rate``; ``None`` means unlimited.
+    """
+
+    def __init__(self, rates: Optional[Dict[str, float]] = None, default_rate: Optional[float] = None):
+        self.rates = {domain.lower(): rate for domain, rate in (rates or {}).items()}
+        self.default_rate = default_rate
+        self._next_slot: Dict[str, float] = {}
+
+    def acquire(self, domain: str) -> float:
+        """Take the domain's next send slot and return 0, or return how long until it is free."""
+        domain = domain.lower()
+        rate = self.rates.get(domain, self.default_rate)
+        if not rate:
+            return 0.0
+        now = time.monotonic()
+        next_slot = self._next_slot.get(domain, now)
+        if next_slot > now:
+            return next_slot - now
+        self._next_slot[domain] = now + 1.0 / rate
+        return 0.0
+
+
+class DeliveryJournal:
+    """Append-only JSONL log of delivery outcomes, one line per outcome.
+
+    Lines are flushed as they are written. On resume, recipients with a
+    final (sent or failed) outcome are not sent again; a line torn by a
+    crash is ignored.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self._file = None
+
+    def finished(self) -> Dict[int, Set[str]]:
+        """Recipients with a final outcome, by message index."""
+        finished: Dict[int, Set[str]] = {}
+        if not self.path.exists():
+            return finished
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if entry.get("status") in FINAL_STATUSES:
+                    finished.setdefault(entry["index"], set()).update(entry["recipients"])
+        return finished
+
+    def open(self, restart: bool = False) -> None:
+        """Open for appending (or start over), ending a torn last line first."""
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        torn = False
+        if not restart and self.path.exists() and self.path.stat().st_size:
+            with open(self.path, "rb") as f:
+                f.seek(-1, 2)
+                torn = f.read(1) != b"\n"
+        self._file = open(self.path, "w" if restart else "a", encoding="utf-8")
+        if torn:
+            self._file.write("\n")
+
+    def record(self, index: int, status: str, recipients: List[str], attempts: int, detail: str = "") -> None:
+        """Append one outcome: sent, failed or retry."""
+        entry = {"index": index, "status": status, "recipients": recipients,
+                 "attempts": attempts, "detail": detail, "time": round(time.time(), 3)}
+        self._file.write(json.dumps(entry) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        """Close the journal file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+@dataclass
+class Delivery:
+    """One message on its way to one or more recipients, or a row that could not be rendered."""
+    index: int
+    recipients: List[str]
+    chunks: List[bytes]
+    attempts: int = 0
+    error: Optional[str] = None
+
+    @property
+    def domain(self) -> str:
+        """Recipient domain used for rate limiting."""
+        return self.recipients[0].rpartition('@')[2].lower()
+
+
+@dataclass
+class DeliveryReport:
+    """What a delivery run did."""
+    sent: int = 0
+    failed: int = 0
+    retries: int = 0
+    skipped: int = 0
+    seconds: float = 0.0
+
+    @property
+    def messages_per_second(self) -> float:
+        """Delivered messages per second of wall time."""
+        return self.sent / self.seconds if self.seconds else 0.0
+
+    def summary(self) -> str:
+        """One line for the log."""
+        return (f"Delivered {self.sent} messages in {self.seconds:.1f} s ({self.messages_per_second:.1f} msgs/s), "
+                f"{self.failed} failed, {self.retries} retries, {self.skipped} already done")
+
+
+def _is_transient(error: Exception) -> bool:
+    """Network errors and 4xx replies are retried."""
+    return error.transient if isinstance(error, SMTPError) else True
+
+
+class DeliveryEngine:
+    """Send messages through a fixed pool of reused SMTP connections.
+
+    Messages are pulled from a blocking iterator (e.g. the batch renderer)
+    in a thread and fed into a bounded queue, so rendering runs ahead of
+    sending by at most ``queue_size`` messages. Each of the ``connections``
+    workers owns one SMTP session and reconnects when it drops. A message
+    whose domain is over its rate is put back until its slot comes up
+    instead of blocking the connection. Transient failures (4xx replies,
+    network errors) are retried with exponential backoff up to
+    ``max_attempts``; permanent ones are recorded as failed. A session that
+    fails to connect is closed and never used; if STARTTLS or authentication
+    is refused for good, the run stops with SMTPSetupError instead of
+    failing every message the same way.
+    """
+
+    def __init__(
+        self,
+        settings: SMTPSettings,
+        sender: str,
+        connections: int = DEFAULT_CONNECTIONS,
+        queue_size: int = DEFAULT_QUEUE_SIZE,
+        rate_limiter: Optional[DomainRateLimiter] = None,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        backoff: float = DEFAULT_BACKOFF_SECONDS,
+        journal: Optional[DeliveryJournal] = None,
+        connection_factory: Callable[[SMTPSettings], SMTPConnection] = SMTPConnection
+    ):
+        self.settings = settings
+        self.sender = sender
+        self.connections = connections
+        self.queue_size = queue_size
+        self.rate_limiter = rate_limiter or DomainRateLimiter()
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.journal = journal
+        self.connection_factory = connection_factory
+        self.report = DeliveryReport()
+
+    async def deliver(self, deliveries: Iterator[Delivery]) -> DeliveryReport:
+        """Send everything the iterator yields and return the report."""
+        self.report = DeliveryReport()
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        # Messages taken from the iterator that have not reached a final outcome yet
+        self._outstanding = 0
+        self._producing = True
+        self._done = asyncio.Event()
+        self._timers: Set[asyncio.Task] = set()
+
+        started = time.perf_counter()
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.connections)]
+        tasks = {asyncio.create_task(self._produce(deliveries)), *workers}
+        done = asyncio.create_task(self._done.wait())
+        try:
+            while not done.done():
+                finished, _ = await asyncio.wait(tasks | {done}, return_when=asyncio.FIRST_COMPLETED)
+                for task in finished - {done}:
+                    tasks.discard(task)
+                    task.result()  # re-raise a producer or worker error
+            for _ in workers:
+                await self._queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for task in (*self._timers, *tasks, done):
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self.report.seconds = time.perf_counter() - started
+        return self.report
+
+    async def _produce(self, deliveries: Iterator[Delivery]) -> None:
+        """Move messages from the (blocking) iterator into the queue."""
+        while True:
+            delivery = await asyncio.to_thread(next, deliveries, None)
+            if delivery is None:
+                break
+            if delivery.error:
+                self._give_up(delivery, delivery.recipients, delivery.error)
+                continue
+            self._outstanding += 1
+            await self._queue.put(delivery)
+        self._producing = False
+        self._check_done()
+
+    def _check_done(self) -> None:
+        if not self._producing and not self._outstanding:
+            self._done.set()
+
+    def _requeue(self, delivery: Delivery, delay: float) -> None:
+        """Put a message back into the queue after ``delay`` seconds."""
+        async def later() -> None:
+            await asyncio.sleep(delay)
+            await self._queue.put(delivery)
+        timer = asyncio.create_task(later())
+        self._timers.add(timer)
+        timer.add_done_callback(self._timers.discard)
+
+    async def _worker(self) -> None:
+        """Send messages from the queue over one SMTP connection."""
+        connection: Optional[SMTPConnection] = None
+        try:
+            while True:
+                delivery = await self._queue.get()
+                if delivery is None:
+                    return
+                wait = self.rate_limiter.acquire(delivery.domain)
+                if wait:
+                    metrics.increment('delivery.rate_limited')
+                    self._requeue(delivery, wait)
+                    continue
+                delivery.attempts += 1
+                errors: Dict[str, Optional[Exception]] = {}
+                try:
+                    if connection is None:
+                        connection = await self._connect()
+                    refused = await connection.send(self.sender, delivery.recipients, delivery.chunks)
+                    errors = {recipient: refused.get(recipient) for recipient in delivery.recipients}
+                except (SMTPError, OSError, ConnectionError, asyncio.TimeoutError) as e:
+                    if isinstance(e, SMTPSetupError) and not e.transient:
+                        logger.error(f"Cannot set up the SMTP session: {e}")
+                        raise
+                    if connection is not None and (not isinstance(e, SMTPError) or e.code == 421):
+                        # The session is gone; reconnect for the next message
+                        await connection.close()
+                        connection = None
+                    errors = dict.fromkeys(delivery.recipients, e)
+                self._settle(delivery, errors)
+        finally:
+            if connection is not None:
+                await connection.close()
+
+    async def _connect(self) -> SMTPConnection:
+        """Open a session; a half-open one is closed whatever made the setup fail."""
+        connection = self.connection_factory(self.settings)
+        try:
+            await connection.connect()
+        except BaseException:
+            await connection.close()
+            raise
+        return connection
+
+    def _settle(self, delivery: Delivery, errors: Dict[str, Optional[Exception]]) -> None:
+        """Record the outcome per recipient and retry the transient failures after a backoff."""
+        sent = [recipient for recipient, error in errors.items() if error is None]
+        if sent:
+            self.report.sent += 1
+            metrics.increment('delivery.sent')
+            if self.journal:
+                self.journal.record(delivery.index, 'sent', sent, delivery.attempts)
+
+        retry = []
+        for recipient, error in errors.items():
+            if error is None:
+                continue
+            if _is_transient(error) and delivery.attempts < self.max_attempts:
+                retry.append(recipient)
+            else:
+                self._give_up(delivery, [recipient], str(error))
+        if not retry:
+            self._outstanding -= 1
+            self._check_done()
+            return
+
+        detail = str(errors[retry[0]])
+        self.report.retries += 1
+        metrics.increment('delivery.retries')
+        if self.journal:
+            self.journal.record(delivery.index, 'retry', retry, delivery.attempts, detail)
+        delay = min(self.backoff * 2 ** (delivery.attempts - 1), MAX_BACKOFF_SECONDS)
+        logger.warning(f"Message {delivery.index} deferred ({detail}); retrying in {delay:.1f} s")
+        self._requeue(Delivery(delivery.index, retry, delivery.chunks, delivery.attempts), delay)
+
+    def _give_up(self, delivery: Delivery, recipients: List[str], error: str) -> None:
+        logger.error(f"Message {delivery.index} to {', '.join(recipients) or '(nobody)'} failed: {error}")
+        self.report.failed += 1
+        metrics.increment('delivery.failed')
+        if self.journal:
+            self.journal.record(delivery.index, 'failed', recipients, delivery.attempts, error)
+
+
+class BulkDelivery:
+    """Render one message per subscriber row and send it over SMTP.
+
+    Messages are rendered by a BatchRunner (in worker processes with
+    ``workers > 1``) as CRLF MIME messages and handed to a DeliveryEngine.
+    Outcomes go to a journal next to the recipient list; a rerun skips
+    every recipient that already has a final outcome.
+    """
+
+    def __init__(
+        self,
+        generator: NewsletterGenerator,
+        recipients_path: Union[str, Path],
+        settings: SMTPSettings,
+        journal_path: Optional[Union[str, Path]] = None,
+        connections: int = DEFAULT_CONNECTIONS,
+        rate_limiter: Optional[DomainRateLimiter] = None,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+        backoff: float = DEFAULT_BACKOFF_SECONDS,
+        workers: int = 1,
+        chunk_size: int = DEFAULT_CHUNK_SIZE
+    ):
+        self.generator = generator
+        self.recipients_path = Path(recipients_path)
+        self.settings = settings
+        self.journal = DeliveryJournal(
+            journal_path or self.recipients_path.with_name(self.recipients_path.name + JOURNAL_SUFFIX)
+        )
+        self.connections = connections
+        self.rate_limiter = rate_limiter
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.runner_options = {"workers": workers, "chunk_size": chunk_size}
+        # Rows of the current run that already had an outcome for every recipient
+        self._skipped = 0
+
+    def _deliveries(self, newsletter_data: PlaceholderData, finished: Dict[int, Set[str]]) -> Iterator[Delivery]:
+        """Render the rows that still have unsent recipients (runs in the engine's producer thread).
+
+        Rows that are not rendered because they are finished are counted in ``_skipped``.
+        """
+        # Rows before the first unfinished one need not be rendered at all
+        start = 0
+        while start in finished:
+            start += 1
+        self._skipped += start
+        recipients: Dict[int, List[str]] = {}
+
+        def rows() -> Iterator[PlaceholderData]:
+            for index, row in enumerate(islice(iter_recipients(self.recipients_path), start, None), start):
+                address = row.get(RECIPIENT_ADDRESS_KEY)
+                recipients[index] = [address] if address else []
+                yield row
+
+        runner = BatchRunner(
+            self.generator, newsletter_data=newsletter_data,
+            renderer_factory=partial(message_renderer, linesep='\r\n'), **self.runner_options
+        )
+        for result in runner.run(rows(), start=start):
+            pending = [r for r in recipients.pop(result.index) if r not in finished.get(result.index, ())]
+            if result.index in finished and not pending:
+                self._skipped += 1
+            elif not result.ok or not pending:
+                yield Delivery(result.index, pending, [], error=result.error or f"no {RECIPIENT_ADDRESS_KEY} address")
+            else:
+                yield Delivery(result.index, pending, result.chunks)
+
+    @log_operation("SMTP delivery")
+    def run(self, resume: bool = True) -> DeliveryReport:
+        """Send all remaining messages and return the report."""
+        newsletter_data = self.generator.read_newsletter_data()
+        settings = newsletter_data.get(MAIL_SETTINGS_KEY) or {}
+        # Bounces go to return_path if set, otherwise to the From address
+        sender = parseaddr(settings.get('return_path') or settings.get('from') or '')[1]
+        finished = self.journal.finished() if resume else {}
+        if finished:
+            logger.info(f"Resuming delivery: {len(finished)} messages already have an outcome")
+
+        engine = DeliveryEngine(
+            self.settings, sender, connections=self.connections, rate_limiter=self.rate_limiter,
+            max_attempts=self.max_attempts, backoff=self.backoff, journal=self.journal
+        )
+        self._skipped = 0
+        self.journal.open(restart=not resume)
+        try:
+            report = asyncio.run(engine.deliver(self._deliveries(newsletter_data, finished)))
+        finally:
+            self.journal.close()
+        report.skipped = self._skipped
+        logger.info(report.summary())
+        return report
@@ -1,31 +1,95 @@
 from pathlib import Path
+import argparse
 import re
-import yaml
-import base64
 import os
 import logging
-from typing import Dict, Any, Optional, Callable, TypeVar, Union
-import traceback
-from functools import wraps
-from dataclasses import dataclass
+from typing import Dict, Any, Optional, Callable, TypeVar, Union, Iterable, Iterator, List, Set, Tuple, Hashable, FrozenSet
+import hashlib
+from html import unescape as unescape_html
+import importlib.util
+import io
+import json
+import pickle
+from collections import OrderedDict
+from functools import wraps, cached_property, lru_cache
+from dataclasses import dataclass, field
+
+from instrumentation import metrics, payload_size, profile_to
 
 # Constants
 NEWSLETTER_TEMPLATE = "newsletter_template.html"
 NEWSLETTER_OUTPUT = "newsletter_ready.html" 
 NEWSLETTER_DATA = "newsletter_data.yaml"
-CSS_VAR_PATTERN = r'--([a-zA-Z0-9-]+):\s*([^;]+);'
+CSS_VAR_PATTERN = r'--([a-zA-Z0-9_-]+)\s*:\s*([^;}]+)'
+CSS_RULE_PATTERN = r'([^{}]*)\{([^{}]*)\}'
+CSS_COMMENT_PATTERN = r'/\*.*?\*/'
+CSS_SIMPLE_VAR_PATTERN = re.compile(r'var\(\s*(--[A-Za-z0-9_-]+)\s*\)')
+ROOT_SELECTORS = {':root', 'html'}
 LOGO_CONTAINER_PATTERN = r'<div class="logo-container">.*?(<img[^>]*?src\s*=\s*["\']?\s*["\']?[^>]*?>)'
 IMG_SRC_PATTERN = 'src=""'
-BASE64_IMG_FORMAT = 'data:image/png;base64,{}'
+DATA_URI_FORMAT = 'data:{mime};base64,{data}'
+CID_URI_FORMAT = 'cid:{content_id}'
+CONTENT_ID_FORMAT = '{stem}.{digest}@newsletter'
+IMAGE_EMBEDDING_MODES = ('data', 'cid')
+MAIL_SETTINGS_KEY = 'mail'
+DEFAULT_IMAGE_MIME = 'image/png'
+ASSET_CACHE_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_IMAGE_DPR = 2.0
+DEFAULT_JPEG_QUALITY = 85
+GMAIL_CLIP_BYTES = 102 * 1024
+BUDGET_ACTIONS = ('warn', 'fail')
+MSO_CONDITIONAL_PATTERN = (
+    r'<!--\[if [^\]]*\]><!-->|<!--<!\[endif\]-->'
+    r'|<!--\[if [^\]]*\]>.*?<!\[endif\]-->'
+)
+STYLE_BLOCK_PATTERN = r'<style\b[^>]*>.*?</style>'
+STYLE_ATTRIBUTE_PATTERN = r'\sstyle\s*=\s*(?:"[^"]*"|\'[^\']*\')'
+EMBEDDED_ASSET_PATTERN = r'data:[\w/+.-]+;base64,[A-Za-z0-9+/=]*'
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+    (b'\x00\x00\x01\x00', 'image/x-icon'),
+)
+PLACEHOLDER_PATTERN = r'\{\{ ([A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)?) \}\}'
+STYLE_CONTEXT_PATTERN = (
+    r'(?P<open><style\b[^>]*>)(?P<css>.*?)(?P<close></style>)'
+    r'|(?P<attr>\sstyle\s*=\s*)(?P<quote>["\'])(?P<declarations>.*?)(?P=quote)'
+)
+SLOT_SENTINEL_PREFIX = 'NLSLOT'
+SLOT_SENTINEL_PATTERN = SLOT_SENTINEL_PREFIX + r'(\d+)X'
+# Slot values are filled in after inlining, escaped the way the HTML serializer
+# writes them; it rewrites markup and carriage returns in ways a fill cannot
+SLOT_MARKUP_PATTERN = r'[<\r]'
+# In attributes it also percent-encodes whitespace and non-ASCII in URLs, and a
+# quote would end the value
+UNSAFE_ATTRIBUTE_VALUE_PATTERN = r'[^\x21-\x7e]|"'
+SKELETON_CACHE_SIZE = 32
+VERIFIED_SKELETONS_SIZE = 1024
+TEMPLATE_CACHE_SIZE = 16
+DEFAULT_SERVER_ADDRESS = '127.0.0.1:8040'
+TEMPLATE_TOKEN_PATTERN = PLACEHOLDER_PATTERN + r'|\{%\s*(\w+)\s*(.*?)\s*%\}'
+FOR_ARGUMENTS_PATTERN = r'([A-Za-z_][A-Za-z0-9_]*) in ([A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)?)'
+IF_ARGUMENTS_PATTERN = r'(not )?([A-Za-z0-9_-]+(?:\.[A-Za-z0-9_-]+)?)'
+CONDITION_FALSE_VALUES = (None, '', 'False', 'false', '0')
+LOOP_MARKER_PREFIX = '<!--NLLOOP'
+LOOP_MARKER_FORMAT = LOOP_MARKER_PREFIX + '{kind}{index}-->'
+SKELETON_TOKEN_PATTERN = SLOT_SENTINEL_PATTERN + r'|<!--NLLOOP([BE])(\d+)-->'
+POSITIONAL_SELECTOR_PATTERN = r':(?:nth-|only-|first-of-type|last-of-type)'
+PRECOMPILED_FORMAT_VERSION = 2
+DEFAULT_BUILD_CACHE_MB = 256
+DEFAULT_BUILD_CACHE_DAYS = 30
+PRECOMPILED_CLASSES = {'Slot', 'Loop', 'Conditional', 'SkeletonLoop', 'SkeletonShapes'}
 
-# Configure logging
-logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
 # Type definitions
 T = TypeVar('T')
 HTMLContent = str
 PlaceholderData = Dict[str, Any]
+PlaceholderValues = Dict[str, Any]  # strings, or lists for loops
 
 
 @dataclass
@@ -45,18 +109,1115 @@ class NewsletterPaths:
         )
 
 
+class SizeBudgetExceeded(ValueError):
+    """Raised when the generated HTML is larger than the configured budget."""
+
+
+@dataclass(frozen=True)
+class SizeReport:
+    """Byte sizes of the generated HTML, broken down by what takes up the space.
+
+    MSO conditional comments are measured first; the other sections are
+    measured outside of them so nothing is counted twice.
+    """
+    total: int
+    style_blocks: int
+    inline_styles: int
+    embedded_assets: int
+    mso_conditionals: int
+    budget: Optional[int] = None
+
+    @classmethod
+    def from_html(cls, html_content: HTMLContent, budget: Optional[int] = None) -> 'SizeReport':
+        """Measure the UTF-8 encoded size of each section of the document."""
+        def size(text: str) -> int:
+            return len(text.encode('utf-8'))
+        
+        mso_parts = re.findall(MSO_CONDITIONAL_PATTERN, html_content, re.DOTALL)
+        remainder = re.sub(MSO_CONDITIONAL_PATTERN, '', html_content, flags=re.DOTALL)
+        
+        return cls(
+            total=size(html_content),
+            style_blocks=sum(map(size, re.findall(STYLE_BLOCK_PATTERN, remainder, re.DOTALL))),
+            inline_styles=sum(map(size, re.findall(STYLE_ATTRIBUTE_PATTERN, remainder))),
+            embedded_assets=sum(map(size, re.findall(EMBEDDED_ASSET_PATTERN, remainder))),
+            mso_conditionals=sum(map(size, mso_parts)),
+            budget=budget
+        )
+
+    @property
+    def other(self) -> int:
+        """Markup and text not covered by any other section."""
+        return self.total - self.style_blocks - self.inline_styles - self.embedded_assets - self.mso_conditionals
+
+    @property
+    def over_budget(self) -> bool:
+        """Whether the total exceeds the budget."""
+        return self.budget is not None and self.total > self.budget
+
+    def to_dict(self) -> Dict[str, Optional[int]]:
+        """The report as a plain dictionary."""
+        return {
+            'total': self.total,
+            'style_blocks': self.style_blocks,
+            'inline_styles': self.inline_styles,
+            'embedded_assets': self.embedded_assets,
+            'mso_conditionals': self.mso_conditionals,
+            'other': self.other,
+            'budget': self.budget,
+        }
+
+    def summary(self) -> str:
+        """Human readable, one line per section."""
+        lines = [f"Total size: {self.total} bytes"]
+        for name, value in (
+            ("Style blocks", self.style_blocks),
+            ("Inline style attributes", self.inline_styles),
+            ("Embedded assets", self.embedded_assets),
+            ("MSO conditional comments", self.mso_conditionals),
+            ("Other markup and text", self.other),
+        ):
+            share = value / self.total * 100 if self.total else 0
+            lines.append(f"  {name}: {value} bytes ({share:.1f}%)")
+        if self.budget is not None:
+            lines.append(f"  Budget: {self.budget} bytes ({self.total / self.budget * 100:.1f}% used)")
+        return "\n".join(lines)
+
+
+class TemplateSyntaxError(ValueError):
+    """Raised when the block tags of a template are malformed or unbalanced."""
+
+
+@dataclass(frozen=True)
+class Slot:
+    """A ``{{ key }}`` placeholder; ``bound`` if the key belongs to a loop variable.
+
+    In an inlined skeleton, ``escaped`` slots are filled the way the HTML
+    serializer writes their values (see ``escape_slot_text``).
+    """
+    key: str
+    bound: bool = False
+    escaped: bool = False
+
+
+@dataclass(frozen=True)
+class Loop:
+    """A ``{% for variable in source %}`` ... ``{% endfor %}`` block."""
+    variable: str
+    source: str
+    body: Tuple['TemplateNode', ...]
+
+
+@dataclass(frozen=True)
+class Conditional:
+    """An ``{% if [not] key %}`` block with an optional ``{% else %}`` branch."""
+    key: str
+    negated: bool
+    body: Tuple['TemplateNode', ...]
+    orelse: Tuple['TemplateNode', ...] = ()
+
+
+TemplateNode = Union[str, Slot, Loop, Conditional]
+
+
+def _to_string(value: Any) -> str:
+    """Convert any value to a string."""
+    if isinstance(value, (int, float)):
+        return str(value)
+    return str(value) if value is not None else ""
+
+
+def _slot_text(values: PlaceholderValues, key: str) -> str:
+    """The text for a slot; unknown placeholders are left untouched."""
+    value = values.get(key)
+    if value is None:
+        return f"{{{{ {key} }}}}"
+    return value if type(value) is str else _to_string(value)
+
+
+def slot_value_safe(value: Any, attribute: bool = False) -> bool:
+    """Whether a value can be filled into an inlined skeleton instead of inlined with it.
+
+    Plain text, including ampersands, apostrophes and quotes, comes out of
+    the serializer as ``escape_slot_text`` writes it. Markup, entity
+    references and carriage returns do not, and neither do quotes, whitespace
+    and non-ASCII characters inside an ``attribute`` value.
+    """
+    text = _to_string(value)
+    if re.search(SLOT_MARKUP_PATTERN, text):
+        return False
+    if attribute and re.search(UNSAFE_ATTRIBUTE_VALUE_PATTERN, text):
+        return False
+    return '&' not in text or unescape_html(text) == text
+
+
+def escape_slot_text(text: str) -> str:
+    """Escape a safe slot value (see ``slot_value_safe``) as the HTML serializer writes it."""
+    if '&' in text:
+        text = text.replace('&', '&amp;')
+    if '>' in text:
+        text = text.replace('>', '&gt;')
+    return text
+
+
+def loop_items(values: PlaceholderValues, source: str) -> List[Any]:
+    """The list a loop iterates over; anything else counts as empty."""
+    items = values.get(source)
+    return items if isinstance(items, list) else []
+
+
+def loop_scope(values: PlaceholderValues, variable: str, item: Any) -> PlaceholderValues:
+    """The values visible inside one iteration.
+
+    A dict item is exposed as ``{{ variable.key }}`` (lists stay lists, for
+    nested loops), anything else as ``{{ variable }}``.
+    """
+    scope = dict(values)
+    if isinstance(item, dict):
+        for key, value in item.items():
+            scope[f"{variable}.{key}"] = value if isinstance(value, list) else _to_string(value)
+    else:
+        scope[variable] = _to_string(item)
+    return scope
+
+
+def loop_position(index: int, count: int) -> str:
+    """Where an iteration sits among its siblings, as far as ``:first-child``/``:last-child`` can tell."""
+    if count == 1:
+        return 'only'
+    if index == 0:
+        return 'first'
+    return 'last' if index == count - 1 else 'middle'
+
+
+def condition_holds(conditional: Conditional, values: PlaceholderValues) -> bool:
+    """Evaluate an ``{% if %}``: empty lists and empty or false-like strings are false."""
+    value = values.get(conditional.key)
+    holds = bool(value) if isinstance(value, list) else value not in CONDITION_FALSE_VALUES
+    return holds != conditional.negated
+
+
+def _render_nodes(nodes: Iterable[TemplateNode], values: PlaceholderValues, parts: List[str]) -> None:
+    """Append the rendered nodes to ``parts``."""
+    for node in nodes:
+        node_type = type(node)
+        if node_type is str:
+            parts.append(node)
+        elif node_type is Slot:
+            parts.append(_slot_text(values, node.key))
+        elif node_type is Conditional:
+            _render_nodes(node.body if condition_holds(node, values) else node.orelse, values, parts)
+        else:
+            for item in loop_items(values, node.source):
+                _render_nodes(node.body, loop_scope(values, node.variable, item), parts)
+
+
+@dataclass
+class _OpenBlock:
+    """A block being parsed: its opening tag and the nodes collected so far."""
+    tag: Optional[str]
+    arguments: Tuple[Optional[str], ...]
+    line: int
+    variables: Set[str]
+    body: List[TemplateNode] = field(default_factory=list)
+    orelse: Optional[List[TemplateNode]] = None
+
+    @property
+    def nodes(self) -> List[TemplateNode]:
+        """The branch currently being filled."""
+        return self.orelse if self.orelse is not None else self.body
+
+    def close(self) -> Union[Loop, Conditional]:
+        """Build the finished node."""
+        if self.tag == 'for':
+            return Loop(variable=self.arguments[0], source=self.arguments[1], body=tuple(self.body))
+        return Conditional(key=self.arguments[1], negated=bool(self.arguments[0]),
+                           body=tuple(self.body), orelse=tuple(self.orelse or ()))
+
+
+@dataclass(frozen=True)
+class CompiledTemplate:
+    """A template parsed once into literals, placeholder slots and blocks.
+
+    Besides ``{{ key }}``/``{{ parent.sub }}`` placeholders the template may
+    contain ``{% for item in list %}``/``{% endfor %}`` and
+    ``{% if [not] key %}``/``{% else %}``/``{% endif %}`` blocks. A block tag
+    alone on its line takes the line with it, so the output is not padded
+    with blank lines.
+    """
+    nodes: Tuple[TemplateNode, ...]
+    source: str
+
+    @classmethod
+    def compile(cls, html_content: HTMLContent) -> 'CompiledTemplate':
+        """Tokenize the template and nest its blocks."""
+        blocks = [_OpenBlock(tag=None, arguments=(), line=0, variables=set())]
+        position = 0
+
+        for match in re.finditer(TEMPLATE_TOKEN_PATTERN, html_content):
+            start, end = match.span()
+            key, tag, arguments = match.groups()
+            line = html_content.count('\n', 0, start) + 1
+
+            if tag is not None:
+                line_start = html_content.rfind('\n', 0, start) + 1
+                trailing = re.match(r'[ \t]*(?:\r?\n|$)', html_content[end:])
+                if line_start >= position and not html_content[line_start:start].strip(' \t') and trailing:
+                    start, end = line_start, end + trailing.end()
+
+            if start > position:
+                blocks[-1].nodes.append(html_content[position:start])
+            position = end
+
+            if key is not None:
+                blocks[-1].nodes.append(Slot(key, bound=key.split('.')[0] in blocks[-1].variables))
+            elif tag == 'for':
+                loop = re.fullmatch(FOR_ARGUMENTS_PATTERN, arguments)
+                if not loop:
+                    raise TemplateSyntaxError(f"Line {line}: expected '{{% for item in list %}}'")
+                blocks.append(_OpenBlock('for', loop.groups(), line, blocks[-1].variables | {loop.group(1)}))
+            elif tag == 'if':
+                condition = re.fullmatch(IF_ARGUMENTS_PATTERN, arguments)
+                if not condition:
+                    raise TemplateSyntaxError(f"Line {line}: expected '{{% if [not] key %}}'")
+                blocks.append(_OpenBlock('if', condition.groups(), line, blocks[-1].variables))
+            elif tag == 'else':
+                if blocks[-1].tag != 'if' or blocks[-1].orelse is not None:
+                    raise TemplateSyntaxError(f"Line {line}: '{{% else %}}' outside of an if block")
+                blocks[-1].orelse = []
+            elif tag in ('endfor', 'endif'):
+                if blocks[-1].tag != tag[3:]:
+                    raise TemplateSyntaxError(f"Line {line}: unexpected '{{% {tag} %}}'")
+                block = blocks.pop()
+                blocks[-1].nodes.append(block.close())
+            else:
+                raise TemplateSyntaxError(f"Line {line}: unknown block tag '{tag}'")
+
+        if len(blocks) > 1:
+            raise TemplateSyntaxError(f"Line {blocks[-1].line}: '{{% {blocks[-1].tag} %}}' is never closed")
+        if position < len(html_content):
+            blocks[0].nodes.append(html_content[position:])
+        return cls(nodes=tuple(blocks[0].body), source=html_content)
+
+    @cached_property
+    def digest(self) -> str:
+        """Content hash of the template, used as a cache key."""
+        return hashlib.sha256(self.source.encode("utf-8")).hexdigest()
+
+    @cached_property
+    def has_blocks(self) -> bool:
+        """Whether the template contains loops or conditionals."""
+        return any(isinstance(node, (Loop, Conditional)) for node in self.nodes)
+
+    @cached_property
+    def _references(self) -> Tuple[Set[str], Set[str]]:
+        """Top-level keys used by slots, and by loops and conditionals."""
+        slots: Set[str] = set()
+        blocks: Set[str] = set()
+
+        def visit(nodes: Iterable[TemplateNode], bound: Set[str]) -> None:
+            for node in nodes:
+                if isinstance(node, Slot):
+                    if not node.bound:
+                        slots.add(node.key)
+                elif isinstance(node, Loop):
+                    if node.source.split('.')[0] not in bound:
+                        blocks.add(node.source)
+                    visit(node.body, bound | {node.variable})
+                elif isinstance(node, Conditional):
+                    if node.key.split('.')[0] not in bound:
+                        blocks.add(node.key)
+                    visit(node.body + node.orelse, bound)
+
+        visit(self.nodes, set())
+        return slots, blocks
+
+    @property
+    def slot_placeholders(self) -> Set[str]:
+        """Keys of the placeholders filled from the top-level data."""
+        return self._references[0]
+
+    @property
+    def placeholders(self) -> Set[str]:
+        """All top-level data keys the template refers to: slots, loop lists and conditions."""
+        return self._references[0] | self._references[1]
+
+    def style_placeholders(self) -> Set[str]:
+        """Placeholders used inside ``<style>`` blocks or ``style`` attributes."""
+        return set(self._style_placeholders)
+
+    @cached_property
+    def _style_placeholders(self) -> frozenset:
+        """Scan the source for placeholders in style contexts once per template."""
+        return frozenset(
+            key
+            for match in re.finditer(STYLE_CONTEXT_PATTERN, self.source, re.DOTALL)
+            for key in re.findall(PLACEHOLDER_PATTERN, match.group(0))
+        )
+
+    def attribute_placeholders(self) -> Set[str]:
+        """Placeholders inside tags, that is in attribute values."""
+        return set(self._attribute_placeholders)
+
+    @cached_property
+    def _attribute_placeholders(self) -> frozenset:
+        """Scan the source for placeholders between ``<`` and ``>`` once per template."""
+        return frozenset(
+            match.group(1)
+            for match in re.finditer(PLACEHOLDER_PATTERN, self.source)
+            if self.source.rfind('<', 0, match.start()) > self.source.rfind('>', 0, match.start())
+        )
+
+    def unknown_placeholders(self, values: PlaceholderValues) -> Set[str]:
+        """Placeholders in the template that have no value in the data."""
+        return self.placeholders - values.keys()
+
+    def unused_keys(self, values: PlaceholderValues) -> Set[str]:
+        """Data keys that no placeholder in the template refers to."""
+        return values.keys() - self.placeholders
+
+    def render(self, values: PlaceholderValues) -> HTMLContent:
+        """Fill every slot and expand every block in one pass."""
+        parts: List[str] = []
+        _render_nodes(self.nodes, values, parts)
+        return "".join(parts)
+
+
+LoopMarker = Tuple[Loop, Hashable]
+
+
+class SkeletonShapes:
+    """Decide which loop iterations can share one CSS-inlined body.
+
+    An iteration's signature is its position among its siblings, the branch
+    each of its conditionals takes, the signatures of its nested loops and
+    the item values that cannot stay slots (markup, anything used in CSS,
+    see ``baked``) and are therefore baked into the body. Iterations with equal signatures
+    inline identically, so only one of each is inlined; a loop of forty
+    plain items costs the same as one of three. Templates using ``:nth-child``
+    and similar selectors can tell every position apart, so with
+    ``collapse=False`` every iteration gets its own signature.
+    """
+
+    def __init__(self, baked_keys: Set[str], attribute_keys: Set[str], collapse: bool = True):
+        self.baked_keys = baked_keys
+        self.attribute_keys = attribute_keys
+        self.collapse = collapse
+
+    def baked(self, key: str, value: Any) -> bool:
+        """Whether a value has to be inlined with the template instead of slotted."""
+        if key in self.baked_keys:
+            return True
+        return not slot_value_safe(value, key in self.attribute_keys)
+
+    def shape(self, nodes: Iterable[TemplateNode], values: PlaceholderValues) -> Tuple:
+        """Everything about ``values`` that changes the inlined output of ``nodes``
+        beyond what slots can fill in."""
+        shape: List[Any] = []
+        for node in nodes:
+            if isinstance(node, Slot):
+                value = values.get(node.key)
+                if node.bound and self.baked(node.key, value):
+                    shape.append((node.key, _to_string(value)))
+            elif isinstance(node, Conditional):
+                holds = condition_holds(node, values)
+                shape.append((holds, self.shape(node.body if holds else node.orelse, values)))
+            elif isinstance(node, Loop):
+                shape.append(tuple(self.iterations(node, values)))
+        return tuple(shape)
+
+    def signature(self, loop: Loop, index: int, count: int, scope: PlaceholderValues) -> Hashable:
+        """The signature of one iteration, given its scope."""
+        position = loop_position(index, count) if self.collapse else (index, count)
+        return position, self.shape(loop.body, scope)
+
+    def iterations(self, loop: Loop, values: PlaceholderValues) -> Dict[Hashable, PlaceholderValues]:
+        """Distinct iteration signatures in order, each with the scope of its first iteration."""
+        items = loop_items(values, loop.source)
+        distinct: Dict[Hashable, PlaceholderValues] = {}
+        for index, item in enumerate(items):
+            scope = loop_scope(values, loop.variable, item)
+            distinct.setdefault(self.signature(loop, index, len(items), scope), scope)
+        return distinct
+
+    def render_sentinels(self, compiled: CompiledTemplate, values: PlaceholderValues,
+                         slot_keys: Set[str]) -> Tuple[HTMLContent, List[str], List[LoopMarker]]:
+        """Render one iteration per distinct signature, with sentinels for slots.
+
+        Each iteration is wrapped in numbered marker comments so the inlined
+        bodies can be cut out again. Returns the HTML, the key of each
+        sentinel and the loop and signature of each marker.
+        """
+        parts: List[str] = []
+        keys: List[str] = []
+        sentinels: Dict[str, str] = {}
+        markers: List[LoopMarker] = []
+
+        def sentinel(key: str) -> str:
+            if key not in sentinels:
+                sentinels[key] = f"{SLOT_SENTINEL_PREFIX}{len(keys)}X"
+                keys.append(key)
+            return sentinels[key]
+
+        def walk(nodes: Iterable[TemplateNode], scope: PlaceholderValues) -> None:
+            for node in nodes:
+                if isinstance(node, str):
+                    parts.append(node)
+                elif isinstance(node, Slot):
+                    if node.bound:
+                        slotted = not self.baked(node.key, scope.get(node.key))
+                    else:
+                        slotted = node.key in slot_keys
+                    parts.append(sentinel(node.key) if slotted else _slot_text(scope, node.key))
+                elif isinstance(node, Conditional):
+                    walk(node.body if condition_holds(node, scope) else node.orelse, scope)
+                else:
+                    for signature, item_scope in self.iterations(node, scope).items():
+                        marker = len(markers)
+                        markers.append((node, signature))
+                        parts.append(LOOP_MARKER_FORMAT.format(kind='B', index=marker))
+                        walk(node.body, item_scope)
+                        parts.append(LOOP_MARKER_FORMAT.format(kind='E', index=marker))
+
+        walk(compiled.nodes, values)
+        return "".join(parts), keys, markers
+
+
+@dataclass
+class SkeletonLoop:
+    """A loop in an inlined skeleton: one inlined body per iteration signature."""
+    loop: Loop
+    variants: Dict[Hashable, Tuple[Union[str, Slot, 'SkeletonLoop'], ...]]
+
+
+class InlinedSkeleton:
+    """A template after CSS inlining, ready to be filled per recipient.
+
+    Slots are filled with a join; each loop iteration picks the inlined body
+    for its signature and fills that, so no CSS work happens per record.
+    ``render_chunks`` returns the message as UTF-8 chunks instead, with the
+    literal chunks encoded once and shared by every message.
+    """
+
+    def __init__(self, nodes: Tuple[Union[str, Slot, SkeletonLoop], ...], shapes: SkeletonShapes):
+        self.nodes = nodes
+        self.shapes = shapes
+
+    @cached_property
+    def _encoded_nodes(self) -> Tuple[Union[bytes, Slot, SkeletonLoop], ...]:
+        """The nodes with every literal encoded to UTF-8."""
+        def encode(nodes: Iterable[Union[str, Slot, SkeletonLoop]]) -> Tuple:
+            return tuple(
+                node.encode('utf-8') if isinstance(node, str)
+                else SkeletonLoop(node.loop, {sig: encode(body) for sig, body in node.variants.items()})
+                if isinstance(node, SkeletonLoop) else node
+                for node in nodes
+            )
+        return encode(self.nodes)
+
+    @classmethod
+    def parse(cls, html_content: HTMLContent, keys: List[str], markers: List[LoopMarker],
+              shapes: SkeletonShapes, escaped: bool = False) -> 'InlinedSkeleton':
+        """Turn sentinels back into slots and marked iterations into loop bodies.
+
+        With ``escaped`` the document went through the HTML serializer, and
+        the slots are filled escaped as it would have written their values.
+        """
+        frames: List[List[Union[str, Slot, SkeletonLoop]]] = [[]]
+        open_markers: List[int] = []
+        position = 0
+
+        for match in re.finditer(SKELETON_TOKEN_PATTERN, html_content):
+            if match.start() > position:
+                frames[-1].append(html_content[position:match.start()])
+            position = match.end()
+            sentinel, kind, marker = match.groups()
+
+            if sentinel is not None:
+                frames[-1].append(Slot(keys[int(sentinel)], escaped=escaped))
+            elif kind == 'B':
+                open_markers.append(int(marker))
+                frames.append([])
+            else:
+                if not open_markers or open_markers.pop() != int(marker):
+                    raise ValueError("Loop markers were reordered by CSS inlining")
+                body = tuple(frames.pop())
+                loop, signature = markers[int(marker)]
+                parent = frames[-1]
+                if parent and isinstance(parent[-1], SkeletonLoop) and parent[-1].loop is loop:
+                    parent[-1].variants[signature] = body
+                else:
+                    parent.append(SkeletonLoop(loop, {signature: body}))
+
+        if open_markers:
+            raise ValueError("Loop markers were dropped by CSS inlining")
+        if position < len(html_content):
+            frames[0].append(html_content[position:])
+        return cls(tuple(frames[0]), shapes)
+
+    def render(self, values: PlaceholderValues) -> HTMLContent:
+        """Fill the skeleton for one set of values."""
+        parts: List[str] = []
+        self._expand(self.nodes, values, parts, encoded=False)
+        return "".join(parts)
+
+    def render_chunks(self, values: PlaceholderValues) -> List[bytes]:
+        """Fill the skeleton as a list of UTF-8 chunks without joining them."""
+        parts: List[bytes] = []
+        self._expand(self._encoded_nodes, values, parts, encoded=True)
+        return parts
+
+    def _expand(self, nodes: Iterable[Union[str, bytes, Slot, SkeletonLoop]], values: PlaceholderValues,
+                parts: List, encoded: bool) -> None:
+        """Append the filled nodes to ``parts``."""
+        for node in nodes:
+            node_type = type(node)
+            if node_type is str or node_type is bytes:
+                parts.append(node)
+            elif node_type is Slot:
+                text = _slot_text(values, node.key)
+                if node.escaped:
+                    text = escape_slot_text(text)
+                parts.append(text.encode('utf-8') if encoded else text)
+            else:
+                loop = node.loop
+                items = loop_items(values, loop.source)
+                for index, item in enumerate(items):
+                    scope = loop_scope(values, loop.variable, item)
+                    signature = self.shapes.signature(loop, index, len(items), scope)
+                    self._expand(node.variants[signature], scope, parts, encoded)
+
+
+class CSSVariableResolver:
+    """Resolve CSS custom properties in ``<style>`` blocks and ``style`` attributes.
+
+    The style contexts are tokenized once and the variable table is built from
+    their declarations. ``:root``/``html`` declarations apply everywhere;
+    declarations on other selectors only apply inside rules for those same
+    selectors, where they take precedence, since which elements inherit them
+    cannot be told without the document tree. Declarations inside a ``style``
+    attribute only apply to that attribute. ``var(--x)``, ``var(--x, fallback)``
+    and nested references are resolved with cycle detection and substituted
+    in a single pass over the document. References that cannot be resolved
+    and have no fallback are left untouched, with a warning if the variable
+    is only defined for other selectors.
+    """
+
+    def __init__(self, html_content: HTMLContent):
+        self.html_content = html_content
+        self.contexts = list(re.finditer(STYLE_CONTEXT_PATTERN, html_content, re.DOTALL))
+        self.scoped_variables: Dict[str, Dict[str, str]] = {}
+        self.variables = self._build_variable_table()
+        self._resolved: Dict[str, Optional[str]] = {}
+        self._cyclic: Set[str] = set()
+        self._rule_variables: Dict[FrozenSet[str], Dict[str, str]] = {}
+        self._out_of_scope: Set[str] = set()
+
+    def _build_variable_table(self) -> Dict[str, str]:
+        """Collect ``:root`` custom property declarations from all style blocks.
+
+        Declarations on other selectors go to ``scoped_variables`` by selector.
+        """
+        root_vars: Dict[str, str] = {}
+        
+        for context in self.contexts:
+            css = context.group('css')
+            if css is None or '--' not in css:
+                continue
+            for rule in re.finditer(CSS_RULE_PATTERN, re.sub(CSS_COMMENT_PATTERN, '', css, flags=re.DOTALL)):
+                declarations = self._parse_declarations(rule.group(2))
+                if not declarations:
+                    continue
+                selectors = self._selectors(rule.group(1))
+                if selectors & ROOT_SELECTORS:
+                    root_vars.update(declarations)
+                else:
+                    for selector in selectors:
+                        self.scoped_variables.setdefault(selector, {}).update(declarations)
+        
+        return root_vars
+
+    @staticmethod
+    def _selectors(selector_list: str) -> FrozenSet[str]:
+        """The selectors of a rule, with comments removed and whitespace normalized."""
+        selector_list = re.sub(CSS_COMMENT_PATTERN, '', selector_list, flags=re.DOTALL)
+        return frozenset(' '.join(selector.split()) for selector in selector_list.split(','))
+
+    def _variables_for(self, selectors: FrozenSet[str]) -> Optional[Dict[str, str]]:
+        """Scoped variables that every one of ``selectors`` defines with the same value."""
+        if selectors not in self._rule_variables:
+            tables = [self.scoped_variables.get(selector, {}) for selector in selectors]
+            self._rule_variables[selectors] = {
+                name: value for name, value in tables[0].items()
+                if all(table.get(name) == value for table in tables[1:])
+            }
+        return self._rule_variables[selectors] or None
+
+    @staticmethod
+    def _parse_declarations(declarations: str) -> Dict[str, str]:
+        """Extract ``--name: value`` pairs from a declaration block."""
+        return {
+            match.group(1): match.group(2).strip()
+            for match in re.finditer(CSS_VAR_PATTERN, declarations)
+        }
+
+    def resolve(self) -> HTMLContent:
+        """Return the document with every resolvable var() reference substituted."""
+        parts = []
+        position = 0
+        
+        for context in self.contexts:
+            parts.append(self.html_content[position:context.start()])
+            if context.group('css') is not None:
+                parts.append(context.group('open'))
+                parts.append(self._substitute_rules(context.group('css')))
+                parts.append(context.group('close'))
+            else:
+                declarations = context.group('declarations')
+                local_vars = self._parse_declarations(declarations) if '--' in declarations else None
+                quote = context.group('quote')
+                parts.append(context.group('attr') + quote)
+                parts.append(self._substitute(declarations, local_vars))
+                parts.append(quote)
+            position = context.end()
+        
+        parts.append(self.html_content[position:])
+        return "".join(parts)
+
+    def _substitute_rules(self, css: str) -> str:
+        """Substitute a style block, each rule with the variables scoped to its selectors."""
+        if not self.scoped_variables:
+            return self._substitute(css)
+        parts = []
+        position = 0
+        
+        for rule in re.finditer(CSS_RULE_PATTERN, css):
+            parts.append(self._substitute(css[position:rule.start(2)]))
+            parts.append(self._substitute(rule.group(2), self._variables_for(self._selectors(rule.group(1)))))
+            position = rule.end(2)
+        
+        parts.append(self._substitute(css[position:]))
+        return "".join(parts)
+
+    def _substitute(self, text: str, local_vars: Optional[Dict[str, str]] = None,
+                    resolving: Tuple[str, ...] = ()) -> str:
+        """Replace each var() in ``text``, scanning it once from left to right.
+
+        Inside a variable value (``resolving`` is not empty) an unresolvable
+        reference makes the whole value invalid; in the document it is kept.
+        """
+        parts = []
+        position = 0
+        
+        while True:
+            start = text.find('var(', position)
+            if start == -1:
+                break
+            if start > 0 and (text[start - 1].isalnum() or text[start - 1] in '-_'):
+                parts.append(text[position:start + 4])
+                position = start + 4
+                continue
+            simple = CSS_SIMPLE_VAR_PATTERN.match(text, start)
+            if simple:
+                end = simple.end() - 1
+                value = self._lookup(simple.group(1)[2:], local_vars, resolving)
+            else:
+                end = self._find_closing_paren(text, start + 3)
+                if end == -1:
+                    break
+                value = self._resolve_reference(text[start + 4:end], local_vars, resolving)
+            reference = text[start:end + 1]
+            if value is None:
+                if resolving:
+                    raise _InvalidCSSVariable(reference)
+                value = reference
+            parts.append(text[position:start])
+            parts.append(value)
+            position = end + 1
+        
+        parts.append(text[position:])
+        return "".join(parts)
+
+    @staticmethod
+    def _find_closing_paren(text: str, open_index: int) -> int:
+        """Return the index of the parenthesis closing the one at ``open_index``, or -1."""
+        depth = 0
+        for index in range(open_index, len(text)):
+            if text[index] == '(':
+                depth += 1
+            elif text[index] == ')':
+                depth -= 1
+                if depth == 0:
+                    return index
+        return -1
+
+    def _resolve_reference(self, arguments: str, local_vars: Optional[Dict[str, str]],
+                           resolving: Tuple[str, ...]) -> Optional[str]:
+        """Resolve the arguments of one var() call, using the fallback as CSS does."""
+        name, has_fallback, fallback = arguments.partition(',')
+        name = name.strip()
+        if not name.startswith('--'):
+            return None
+        
+        value = self._lookup(name[2:], local_vars, resolving)
+        if value is None and has_fallback:
+            return self._substitute(fallback.strip(), local_vars, resolving)
+        return value
+
+    def _lookup(self, name: str, local_vars: Optional[Dict[str, str]],
+                resolving: Tuple[str, ...]) -> Optional[str]:
+        """Return the fully resolved value of a variable, or None if undefined, invalid or cyclic."""
+        if name in resolving:
+            if name not in self._cyclic:
+                self._cyclic.add(name)
+                logger.warning(f"Cyclic CSS variable reference: {' -> '.join(resolving + (name,))}")
+            return None
+        
+        if local_vars and name in local_vars:
+            return self._resolve_value(local_vars[name], local_vars, resolving + (name,))
+        if name not in self.variables:
+            if name not in self._out_of_scope and any(name in table for table in self.scoped_variables.values()):
+                self._out_of_scope.add(name)
+                selectors = sorted(selector for selector, table in self.scoped_variables.items() if name in table)
+                logger.warning(f"CSS variable --{name} is only defined for {', '.join(selectors)}; "
+                               f"references outside those rules are left unresolved")
+            return None
+        # Only variables on a cycle can resolve differently depending on the
+        # stack, and those are invalid either way, so caching is safe.
+        if name not in self._resolved:
+            self._resolved[name] = self._resolve_value(self.variables[name], None, resolving + (name,))
+        return self._resolved[name]
+
+    def _resolve_value(self, value: str, local_vars: Optional[Dict[str, str]],
+                       resolving: Tuple[str, ...]) -> Optional[str]:
+        """Resolve a variable value, returning None if any reference in it is invalid."""
+        try:
+            return self._substitute(value, local_vars, resolving)
+        except _InvalidCSSVariable:
+            return None
+
+
+class _InvalidCSSVariable(Exception):
+    """Raised while resolving a variable value that references an invalid variable."""
+
+
+def detect_image_mime(data: bytes, path: Union[str, Path] = '') -> str:
+    """Detect an image MIME type from its magic bytes, falling back to the file name."""
+    for signature, mime in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return mime
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    if b'<svg' in data[:1024]:
+        return 'image/svg+xml'
+    
+    import mimetypes
+    guessed, _ = mimetypes.guess_type(str(path))
+    return guessed if guessed and guessed.startswith('image/') else DEFAULT_IMAGE_MIME
+
+
+@dataclass(frozen=True)
+class EncodedAsset:
+    """A file encoded for embedding as a data URI."""
+    mime: str
+    data: str
+    size: int
+    original_size: int = 0
+
+    @property
+    def data_uri(self) -> str:
+        """The asset as a ``data:`` URI."""
+        return DATA_URI_FORMAT.format(mime=self.mime, data=self.data)
+
+    @property
+    def saved_bytes(self) -> int:
+        """Bytes saved by optimization, before base64 encoding."""
+        return max(self.original_size - self.size, 0)
+
+
+@dataclass(frozen=True)
+class InlineImage:
+    """An image that the HTML references by ``cid:`` and that travels as its own MIME part."""
+    content_id: str
+    filename: str
+    asset: EncodedAsset
+
+    @classmethod
+    def from_asset(cls, path: Union[str, Path], asset: EncodedAsset) -> 'InlineImage':
+        """Name the image after its file; the Content-ID changes whenever the content does."""
+        path = Path(path)
+        digest = hashlib.sha256(asset.data.encode('ascii')).hexdigest()[:16]
+        return cls(content_id=CONTENT_ID_FORMAT.format(stem=path.stem, digest=digest),
+                   filename=path.name, asset=asset)
+
+    @property
+    def cid_uri(self) -> str:
+        """The ``cid:`` URI that points at this image."""
+        return CID_URI_FORMAT.format(content_id=self.content_id)
+
+
+class ImageOptimizer:
+    """Downscale, strip metadata from and recompress images before embedding.
+
+    Images larger than the declared display size times ``dpr`` are scaled
+    down (keeping the aspect ratio) and re-saved without EXIF or text
+    metadata; the ICC profile is kept so colors do not shift. The result is
+    only used when it is smaller than the original. Requires Pillow; without
+    it images are embedded unchanged.
+    """
+
+    FORMATS = {'PNG', 'JPEG', 'WEBP', 'GIF'}
+
+    def __init__(self, dpr: float = DEFAULT_IMAGE_DPR, jpeg_quality: int = DEFAULT_JPEG_QUALITY):
+        self.dpr = dpr
+        self.jpeg_quality = jpeg_quality
+
+    def cache_key(self, display_size: Optional[Tuple[int, int]]) -> Tuple:
+        """Everything that influences the optimized output."""
+        return ('optimized', display_size, self.dpr, self.jpeg_quality)
+
+    def available(self) -> bool:
+        """Check whether Pillow can be imported."""
+        try:
+            from PIL import Image
+            return True
+        except ImportError:
+            return False
+
+    def optimize(self, raw: bytes, display_size: Optional[Tuple[int, int]] = None) -> Optional[bytes]:
+        """Return the optimized image, or None if it would not be smaller."""
+        from PIL import Image
+        
+        with Image.open(io.BytesIO(raw)) as image:
+            if image.format not in self.FORMATS or getattr(image, 'is_animated', False):
+                return None
+            image_format = image.format
+            icc_profile = image.info.get('icc_profile')
+            
+            if display_size:
+                max_size = tuple(max(int(side * self.dpr), 1) for side in display_size)
+                if image.width > max_size[0] or image.height > max_size[1]:
+                    image.thumbnail(max_size, Image.LANCZOS)
+            
+            options: Dict[str, Any] = {'optimize': True}
+            if icc_profile:
+                options['icc_profile'] = icc_profile
+            if image_format == 'JPEG':
+                if image.mode not in ('RGB', 'L'):
+                    image = image.convert('RGB')
+                options.update(quality=self.jpeg_quality, progressive=True)
+            elif image_format == 'WEBP':
+                options.update(quality=self.jpeg_quality, method=6)
+            
+            output = io.BytesIO()
+            image.save(output, image_format, **options)
+        
+        optimized = output.getvalue()
+        return optimized if len(optimized) < len(raw) else None
+
+
+class AssetCache:
+    """LRU cache of base64-encoded assets keyed on path, mtime and size.
+
+    Entries are evicted once the encoded data exceeds ``max_bytes``. With a
+    ``store_dir`` encoded assets are also kept on disk, so later runs skip
+    the encoding as long as the file is unchanged.
+    """
+
+    def __init__(self, max_bytes: int = ASSET_CACHE_MAX_BYTES, store_dir: Optional[Union[str, Path]] = None):
+        self.max_bytes = max_bytes
+        self.store_dir = Path(store_dir) if store_dir else None
+        self.hits = 0
+        self.misses = 0
+        self._entries: 'OrderedDict[Tuple, EncodedAsset]' = OrderedDict()
+        self._size = 0
+
+    def __len__(self) -> int:
+        """Number of encoded assets held in memory."""
+        return len(self._entries)
+
+    @property
+    def size(self) -> int:
+        """Bytes of base64 data held in memory, bounded by ``max_bytes``."""
+        return self._size
+
+    def get(self, path: Union[str, Path], optimizer: Optional[ImageOptimizer] = None,
+            display_size: Optional[Tuple[int, int]] = None) -> EncodedAsset:
+        """Return the encoded asset for ``path``, encoding it only if it changed.
+
+        With an ``optimizer`` the image is optimized for ``display_size``
+        first; optimized results are cached separately from the originals.
+        """
+        stat = os.stat(path)
+        key = (os.path.realpath(path), stat.st_mtime_ns, stat.st_size)
+        if optimizer is not None:
+            key += optimizer.cache_key(display_size)
+        
+        if key in self._entries:
+            self.hits += 1
+            metrics.increment('asset_cache.hits')
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        
+        self.misses += 1
+        metrics.increment('asset_cache.misses')
+        asset = self._load_stored(key)
+        if asset is None:
+            asset = self._encode(path, optimizer, display_size)
+            self._store(key, asset)
+        self._add(key, asset)
+        return asset
+
+    def _encode(self, path: Union[str, Path], optimizer: Optional[ImageOptimizer] = None,
+                display_size: Optional[Tuple[int, int]] = None) -> EncodedAsset:
+        """Read, optionally optimize, and base64-encode a file."""
+        import base64
+        
+        with open(path, "rb") as f:
+            original = f.read()
+        
+        raw = original
+        if optimizer is not None:
+            raw = optimizer.optimize(original, display_size) or original
+        
+        return EncodedAsset(
+            mime=detect_image_mime(raw, path),
+            data=base64.b64encode(raw).decode('utf-8'),
+            size=len(raw),
+            original_size=len(original)
+        )
+
+    def _add(self, key: Tuple, asset: EncodedAsset) -> None:
+        """Insert an entry and evict the least recently used ones over the size bound."""
+        self._entries[key] = asset
+        self._size += len(asset.data)
+        while self._size > self.max_bytes and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self._size -= len(evicted.data)
+
+    def _store_path(self, key: Tuple) -> Path:
+        """Location of an entry in the on-disk store."""
+        digest = hashlib.sha256(repr(key).encode('utf-8')).hexdigest()
+        return self.store_dir / f"{digest}.json"
+
+    def _load_stored(self, key: Tuple) -> Optional[EncodedAsset]:
+        """Load an entry from the on-disk store, if there is one."""
+        if self.store_dir is None:
+            return None
+        store_path = self._store_path(key)
+        if not store_path.exists():
+            return None
+        try:
+            with open(store_path, "r", encoding="utf-8") as f:
+                return EncodedAsset(**json.load(f))
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Ignoring unreadable asset cache entry {store_path}: {e}")
+            return None
+
+    def _store(self, key: Tuple, asset: EncodedAsset) -> None:
+        """Write an entry to the on-disk store."""
+        if self.store_dir is None:
+            return
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+        atomic_write_text(
+            self._store_path(key),
+            json.dumps({
+                'mime': asset.mime,
+                'data': asset.data,
+                'size': asset.size,
+                'original_size': asset.original_size,
+            })
+        )
+
+
+def merge_newsletter_data(base: PlaceholderData, overlay: PlaceholderData) -> PlaceholderData:
+    """Overlay per-recipient fields onto the shared newsletter data.
+
+    Nested dictionaries (like colors) are merged one level deep, matching the
+    placeholder depth supported by the template.
+    """
+    merged = dict(base)
+    for key, value in overlay.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = {**merged[key], **value}
+        else:
+            merged[key] = value
+    return merged
+
+
+def load_yaml_file(path: Union[str, Path]) -> Any:
+    """Parse a YAML file, importing PyYAML only when data is first read."""
+    import yaml
+    
+    # The libyaml loader is several times faster where PyYAML was built with it
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    with open(path, "r", encoding="utf-8") as f:
+        return yaml.load(f, Loader=loader)
+
+
+def atomic_write_text(path: Union[str, Path], content: str) -> None:
+    """Write text to a temporary file next to ``path`` and rename it into place."""
+    path = Path(path)
+    temp_path = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
+@lru_cache(maxsize=None)
+def _premailer_origin() -> Optional[str]:
+    """Where premailer is installed, found without importing it (None if it is missing)."""
+    spec = importlib.util.find_spec('premailer')
+    return spec.origin if spec is not None else None
+
+
+@lru_cache(maxsize=None)
+def toolchain_fingerprint() -> str:
+    """Digest of this module's source and the installed premailer version.
+
+    Inlined output stored on disk is only reused while both are unchanged.
+    The premailer version is taken from its package ``__init__`` (which
+    holds ``__version__``) without importing it, so the fingerprint is the
+    same across fresh installs of one release, as in CI.
+    """
+    fingerprint = hashlib.sha256(Path(__file__).read_bytes())
+    origin = _premailer_origin()
+    fingerprint.update(Path(origin).read_bytes() if origin is not None else b'no premailer')
+    return fingerprint.hexdigest()
+
+
+class _SkeletonUnpickler(pickle.Unpickler):
+    """Load a pickled skeleton, allowing only the skeleton's own node classes.
+
+    Classes are looked up in this module whatever it was called when the
+    artifact was written (``generate`` or ``__main__``).
+    """
+
+    def find_class(self, module: str, name: str) -> Any:
+        if name in PRECOMPILED_CLASSES:
+            return globals()[name]
+        raise pickle.UnpicklingError(f"{module}.{name} is not allowed in a precompiled skeleton")
+
+
 def log_operation(operation_name: str) -> Callable:
-    """Decorator to log operations and handle exceptions."""
+    """Decorator to log operations, record them as metrics stages and handle exceptions.
+
+    The first string argument counts as the stage input and a string result
+    as its output.
+    """
     def decorator(func: Callable[..., T]) -> Callable[..., T]:
         @wraps(func)
         def wrapper(*args, **kwargs) -> T:
             try:
-                result = func(*args, **kwargs)
-                logger.info(f"{operation_name} completed successfully")
+                payload = next((arg for arg in args if isinstance(arg, (str, bytes))), None)
+                with metrics.stage(operation_name, payload) as probe:
+                    result = func(*args, **kwargs)
+                    probe.output_bytes = payload_size(result)
+                logger.info(f"{operation_name} completed successfully in {probe.wall_seconds * 1000:.1f} ms")
                 return result
             except Exception as e:
                 logger.error(f"{operation_name} failed: {e}")
-                logger.debug(traceback.format_exc())
+                logger.debug(f"{operation_name} failed", exc_info=True)
                 raise
         return wrapper
     return decorator
@@ -69,33 +1230,107 @@ class NewsletterGenerator:
         self, 
         template_path: str = NEWSLETTER_TEMPLATE,
         output_path: str = NEWSLETTER_OUTPUT,
-        data_path: str = NEWSLETTER_DATA
+        data_path: str = NEWSLETTER_DATA,
+        asset_cache: Optional[AssetCache] = None,
+        image_optimizer: Optional[ImageOptimizer] = None,
+        size_budget: Optional[int] = GMAIL_CLIP_BYTES,
+        budget_action: str = 'warn',
+        minify: bool = False,
+        image_embedding: str = 'data',
+        precompiled_path: Optional[Union[str, Path]] = None,
+        build_cache: Optional['BuildCache'] = None
     ):
-        """Initialize the newsletter generator with configurable paths."""
+        """Initialize the newsletter generator with configurable paths.
+
+        ``image_embedding='cid'`` makes the logo a ``cid:`` reference instead of
+        a data URI; the images are then collected in ``inline_images`` for
+        MIME messages to attach (see mime_messages.py).
+        
+        With ``precompiled_path`` ``generate()`` keeps the inlined skeleton in
+        that file and reuses it while only slot values change (see
+        ``render_precompiled``). With a ``build_cache`` (see build_cache.py)
+        it stores every stage's result and skips the stages whose inputs are
+        unchanged (see ``build_cached``).
+        """
         self.paths = NewsletterPaths.from_strings(
             template=template_path,
             output=output_path,
             data=data_path
         )
+        self.asset_cache = asset_cache or AssetCache()
+        self.image_optimizer = image_optimizer
+        if budget_action not in BUDGET_ACTIONS:
+            raise ValueError(f"budget_action must be one of {', '.join(BUDGET_ACTIONS)}")
+        self.size_budget = size_budget
+        self.budget_action = budget_action
+        self.minify = minify
+        if image_embedding not in IMAGE_EMBEDDING_MODES:
+            raise ValueError(f"image_embedding must be one of {', '.join(IMAGE_EMBEDDING_MODES)}")
+        self.image_embedding = image_embedding
+        self.inline_images: Dict[str, InlineImage] = {}
+        self.precompiled_path = Path(precompiled_path) if precompiled_path else None
+        self.build_cache = build_cache
+        self._skeletons: 'OrderedDict[Tuple, Optional[InlinedSkeleton]]' = OrderedDict()
+        self._verified_skeletons: 'OrderedDict[Tuple, None]' = OrderedDict()
+        self._templates: 'OrderedDict[str, CompiledTemplate]' = OrderedDict()
+    
+    def with_paths(self, template_path: Union[str, Path], output_path: Union[str, Path],
+                   data_path: Union[str, Path]) -> 'NewsletterGenerator':
+        """A generator for other files with the same options, sharing this one's caches.
+
+        Encoded assets, compiled templates and inlined skeletons are shared,
+        so entries that use the same template, logo and colors (see
+        manifest.py) parse and inline them only once.
+        """
+        generator = NewsletterGenerator(
+            template_path=str(template_path),
+            output_path=str(output_path),
+            data_path=str(data_path),
+            asset_cache=self.asset_cache,
+            image_optimizer=self.image_optimizer,
+            size_budget=self.size_budget,
+            budget_action=self.budget_action,
+            minify=self.minify,
+            image_embedding=self.image_embedding
+        )
+        generator._skeletons = self._skeletons
+        generator._verified_skeletons = self._verified_skeletons
+        generator._templates = self._templates
+        return generator
+
+    def cache_sizes(self) -> Dict[str, int]:
+        """Number of compiled templates and inlined skeletons currently cached."""
+        return {'templates': len(self._templates), 'skeletons': len(self._skeletons)}
     
     def convert_image_to_base64(self, image_path: str) -> str:
         """Convert an image file to base64 string."""
+        asset = self.encode_asset(image_path)
+        return asset.data if asset else ""
+
+    def encode_asset(self, image_path: Union[str, Path],
+                     display_size: Optional[Tuple[int, int]] = None) -> Optional[EncodedAsset]:
+        """Return the cached base64 encoding of an image file, or None on failure.
+
+        If an image optimizer is configured and Pillow is installed, the image
+        is optimized for ``display_size`` before encoding.
+        """
+        optimizer = self.image_optimizer
+        if optimizer is not None and not optimizer.available():
+            logger.warning("Pillow not installed. Image optimization skipped.")
+            optimizer = self.image_optimizer = None
         try:
-            with open(image_path, "rb") as img_file:
-                return base64.b64encode(img_file.read()).decode('utf-8')
+            return self.asset_cache.get(image_path, optimizer, display_size)
         except FileNotFoundError:
             logger.error(f"Image file not found: {image_path}")
-            return ""
+            return None
         except Exception as e:
             logger.error(f"Error converting image to base64: {e}")
-            return ""
+            return None
 
     def read_newsletter_data(self) -> PlaceholderData:
         """Read the newsletter data from YAML file."""
         self._validate_file_exists(self.paths.data, "Data file")
-        
-        with open(self.paths.data, "r", encoding="utf-8") as f:
-            return yaml.safe_load(f)
+        return load_yaml_file(self.paths.data)
 
     def read_html_template(self) -> HTMLContent:
         """Read the HTML template file."""
@@ -111,6 +1346,7 @@ class NewsletterGenerator:
         if not file_path.is_file():
             raise ValueError(f"{file_description} {file_path} is not a file")
 
+    @log_operation("Logo embedding")
     def process_logo_image(self, html_content: HTMLContent, newsletter_data: PlaceholderData) -> HTMLContent:
         """Process and embed the logo image as base64 in the HTML."""
         if 'logo_path' not in newsletter_data:
@@ -122,26 +1358,56 @@ class NewsletterGenerator:
             return html_content
         
         # Convert logo to base64
-        logo_base64 = self.convert_image_to_base64(logo_path)
-        if not logo_base64:
+        logo_asset = self.encode_asset(logo_path, self._logo_display_size(newsletter_data))
+        if not logo_asset:
             logger.warning("Failed to convert logo to base64")
             return html_content
         
-        logger.info(f"Converted logo '{logo_path}' to base64")
+        logger.info(f"Converted logo '{logo_path}' ({logo_asset.mime}) to base64")
+        if logo_asset.saved_bytes:
+            logger.info(
+                f"Optimized logo '{logo_path}': {logo_asset.original_size} -> {logo_asset.size} bytes "
+                f"(saved {logo_asset.saved_bytes} bytes)"
+            )
+        
+        if self.image_embedding == 'cid':
+            image = InlineImage.from_asset(logo_path, logo_asset)
+            self.inline_images[image.content_id] = image
+            logo_uri = image.cid_uri
+        else:
+            logo_uri = logo_asset.data_uri
         
-        # Find and update the logo image tag
-        return self._update_logo_image_tag(html_content, logo_base64)
+        # Find and update the logo image tags
+        return self._update_logo_image_tag(html_content, logo_uri)
         
+    def _logo_display_size(self, newsletter_data: PlaceholderData) -> Optional[Tuple[int, int]]:
+        """The logo size declared in the data, if both dimensions are valid numbers."""
+        try:
+            return int(newsletter_data['logo_width']), int(newsletter_data['logo_height'])
+        except (KeyError, TypeError, ValueError):
+            return None
+
     def _file_exists(self, file_path: Union[str, Path]) -> bool:
         """Check if a file exists."""
         return os.path.exists(file_path) and os.path.isfile(file_path)
 
-    def _update_logo_image_tag(self, html_content: HTMLContent, logo_base64: str) -> HTMLContent:
-        """Find and update the logo image tag with base64 data."""
-        # Look for image tag in the logo-container div
-        header_img_match = re.search(LOGO_CONTAINER_PATTERN, html_content, re.DOTALL)
+    def _update_logo_image_tag(self, html_content: HTMLContent, logo_uri: str) -> HTMLContent:
+        """Fill the empty src of every logo image tag with the data (or cid) URI."""
+        filled = 0
         
-        if not header_img_match:
+        def fill_src(match: re.Match) -> str:
+            nonlocal filled
+            img_tag = match.group(1)
+            if IMG_SRC_PATTERN not in img_tag:
+                return match.group(0)
+            filled += 1
+            prefix = match.group(0)[:match.start(1) - match.start(0)]
+            return prefix + img_tag.replace(IMG_SRC_PATTERN, f'src="{logo_uri}"', 1)
+        
+        # Look for image tags in the logo-container divs
+        updated_html = re.sub(LOGO_CONTAINER_PATTERN, fill_src, html_content, flags=re.DOTALL)
+        
+        if not filled:
             logger.warning(
                 "Could not find the logo image tag in the HTML template. "
                 "Please ensure there's a div with class='logo-container' "
@@ -149,68 +1415,62 @@ class NewsletterGenerator:
             )
             return html_content
         
-        # Replace the empty src with the base64 data
-        header_img_tag = header_img_match.group(1)
-        updated_header_img_tag = header_img_tag.replace(
-            IMG_SRC_PATTERN, 
-            f'src="{BASE64_IMG_FORMAT.format(logo_base64)}"'
-        )
-        
-        updated_html = html_content.replace(header_img_tag, updated_header_img_tag)
-        logger.info("Logo image src attribute updated with base64 data")
-        
+        logger.info(f"Logo image src attribute updated with {logo_uri.split(':', 1)[0]} URI ({filled} tags)")
         return updated_html
 
     def replace_placeholders(self, html_content: HTMLContent, newsletter_data: PlaceholderData) -> HTMLContent:
         """Replace all placeholders in the HTML with data from the YAML file."""
-        # Create a modified copy of the content
-        modified_content = html_content
+        compiled = CompiledTemplate.compile(html_content)
+        values = self.placeholder_values(newsletter_data)
+        self._count_placeholders(compiled, values)
+        modified_content = compiled.render(values)
+        
+        logger.info("Placeholders replaced with newsletter data")
+        return modified_content
+
+    def _count_placeholders(self, compiled: CompiledTemplate, values: PlaceholderValues) -> None:
+        """Record how many of the template's placeholders the data fills."""
+        missing = len(compiled.slot_placeholders - values.keys())
+        metrics.increment('placeholders.filled', len(compiled.slot_placeholders) - missing)
+        metrics.increment('placeholders.missing', missing)
+
+    def placeholder_values(self, newsletter_data: PlaceholderData) -> PlaceholderValues:
+        """Flatten newsletter data into placeholder keys and string values."""
+        values = {}
         
         for key, value in newsletter_data.items():
-            if key == 'logo_path':
-                # Skip logo_path as it's handled separately
+            if key in ('logo_path', MAIL_SETTINGS_KEY):
+                # Skip logo_path and mail headers as they're handled separately
                 continue
                 
             if isinstance(value, dict):
                 # Handle nested dictionaries (like colors)
-                modified_content = self._replace_nested_placeholders(modified_content, key, value)
+                for subkey, subvalue in value.items():
+                    values[f"{key}.{subkey}"] = (
+                        subvalue if isinstance(subvalue, list) else self._convert_to_string(subvalue)
+                    )
+            elif isinstance(value, list):
+                # Lists are expanded by {% for %} blocks
+                values[key] = value
             else:
                 # Handle simple placeholders
-                modified_content = self._replace_simple_placeholder(modified_content, key, value)
+                values[key] = self._convert_to_string(value)
         
-        logger.info("Placeholders replaced with newsletter data")
-        return modified_content
-
-    def _replace_nested_placeholders(self, html_content: HTMLContent, parent_key: str, 
-                                    nested_dict: Dict[str, Any]) -> HTMLContent:
-        """Replace placeholders for nested dictionary values."""
-        modified_content = html_content
-        
-        for subkey, subvalue in nested_dict.items():
-            placeholder = f"{{{{ {parent_key}.{subkey} }}}}"
-            value_str = self._convert_to_string(subvalue)
-            modified_content = modified_content.replace(placeholder, value_str)
-            
-        return modified_content
-
-    def _replace_simple_placeholder(self, html_content: HTMLContent, key: str, value: Any) -> HTMLContent:
-        """Replace a simple placeholder with its value."""
-        placeholder = f"{{{{ {key} }}}}"
-        value_str = self._convert_to_string(value)
-        return html_content.replace(placeholder, value_str)
+        return values
         
     def _convert_to_string(self, value: Any) -> str:
         """Convert any value to a string."""
-        if isinstance(value, (int, float)):
-            return str(value)
-        return str(value) if value is not None else ""
+        return _to_string(value)
 
     @log_operation("HTML preparation")
-    def prepare_html(self) -> HTMLContent:
+    def prepare_html(self, html_content: Optional[HTMLContent] = None,
+                     newsletter_data: Optional[PlaceholderData] = None) -> HTMLContent:
         """Read the HTML file, replace placeholders and insert base64 images."""
-        # Read the template and data
-        html_content = self.read_html_template()
-        newsletter_data = self.read_newsletter_data()
+        # Read the template and data unless they were read already
+        if html_content is None:
+            html_content = self.read_html_template()
+        if newsletter_data is None:
+            newsletter_data = self.read_newsletter_data()
         
         # Process logo image
         html_content = self.process_logo_image(html_content, newsletter_data)
@@ -223,40 +1483,25 @@ class NewsletterGenerator:
     @log_operation("CSS variable replacement")
     def replace_css_variables(self, html_content: HTMLContent) -> HTMLContent:
         """Replace CSS variables with actual color values for better email client compatibility."""
-        # Extract CSS variable definitions
-        css_vars = self._extract_css_variables(html_content)
-        if not css_vars:
+        resolver = CSSVariableResolver(html_content)
+        if not resolver.variables and not resolver.scoped_variables:
             logger.info("No CSS variables found to replace")
             return html_content
             
-        # Create a modified copy of the content
-        modified_content = html_content
-        
-        # Replace var() usage with the actual values
-        for var_name, var_value in css_vars.items():
-            modified_content = re.sub(f'var\\(--{var_name}\\)', var_value, modified_content)
-        
-        return modified_content
-        
-    def _extract_css_variables(self, html_content: HTMLContent) -> Dict[str, str]:
-        """Extract CSS variable definitions from HTML content."""
-        css_vars = {}
-        for match in re.finditer(CSS_VAR_PATTERN, html_content):
-            var_name = match.group(1)
-            var_value = match.group(2).strip()
-            css_vars[var_name] = var_value
-        return css_vars
+        return resolver.resolve()
 
     @log_operation("CSS inlining")
     def inline_css(self, html_content: HTMLContent) -> HTMLContent:
         """Convert CSS to inline styles for better email client compatibility."""
-        try:
-            from premailer import Premailer
-            return self._transform_with_premailer(html_content)
-        except ImportError:
+        if not self._premailer_available():
             logger.warning("Premailer not installed. CSS inlining skipped.")
             return html_content
-            
+        return self._transform_with_premailer(html_content)
+
+    def _premailer_available(self) -> bool:
+        """Check whether premailer is installed, without importing it."""
+        return _premailer_origin() is not None
+        
     def _transform_with_premailer(self, html_content: HTMLContent) -> HTMLContent:
         """Transform HTML content using Premailer."""
         from premailer import Premailer
@@ -272,37 +1517,694 @@ class NewsletterGenerator:
         
         return transformer.transform()
 
+    def compile_template(self, newsletter_data: PlaceholderData,
+                         record_keys: Iterable[str] = ()) -> CompiledTemplate:
+        """Read the template once, embed the logo and tokenize it for repeated rendering.
+
+        Placeholders without a value in ``newsletter_data`` or ``record_keys`` and
+        data keys that the template never uses are reported here, once, instead
+        of silently on every render.
+        """
+        compiled = self._compile(self.process_logo_image(self.read_html_template(), newsletter_data))
+        
+        values = self.placeholder_values(newsletter_data)
+        unknown = compiled.unknown_placeholders(values) - set(record_keys)
+        if unknown:
+            logger.warning(f"Placeholders without data: {', '.join(sorted(unknown))}")
+        unused = compiled.unused_keys(values)
+        if unused:
+            logger.warning(f"Data keys not used by the template: {', '.join(sorted(unused))}")
+        
+        return compiled
+
+    def _compile(self, html_content: HTMLContent) -> CompiledTemplate:
+        """Compile a template, reusing an earlier compilation of the same source."""
+        compiled = self._templates.get(html_content)
+        if compiled is not None:
+            metrics.increment('template_cache.hits')
+            self._templates.move_to_end(html_content)
+            return compiled
+        
+        metrics.increment('template_cache.misses')
+        compiled = self._templates[html_content] = CompiledTemplate.compile(html_content)
+        if len(self._templates) > TEMPLATE_CACHE_SIZE:
+            self._templates.popitem(last=False)
+        return compiled
+
+    def skeleton_key(self, newsletter_data: PlaceholderData) -> Tuple:
+        """What the inlined skeleton for this data depends on.
+
+        Data with equal keys (the same template, logo, baked values such as
+        colors, and loop shapes) shares one skeleton and differs only in
+        text that is filled in per render.
+        """
+        compiled = self._compile(self.process_logo_image(self.read_html_template(), newsletter_data))
+        values = self.placeholder_values(newsletter_data)
+        shapes = self._skeleton_shapes(compiled)
+        return self._skeleton_key(compiled, shapes, values, self._skeleton_slot_keys(compiled, shapes, values))
+
+    def render_many(self, records: Iterable[PlaceholderData],
+                    newsletter_data: Optional[PlaceholderData] = None,
+                    use_skeleton: bool = True) -> Iterator[HTMLContent]:
+        """Yield the finished HTML for each recipient record.
+
+        The template and shared data are read and compiled once; every record is
+        overlaid onto the shared data and rendered with a single join. The logo
+        is taken from the shared data only.
+        
+        With ``use_skeleton`` the CSS pipeline runs once per distinct set of
+        baked values (see ``build_skeleton``) instead of once per record;
+        records whose values cannot be slotted fall back to the full pipeline.
+        """
+        render = self.bulk_renderer(newsletter_data, use_skeleton)
+        for record in records:
+            yield render(record)
+
+    def bulk_renderer(self, newsletter_data: Optional[PlaceholderData] = None,
+                      use_skeleton: bool = True) -> Callable[[PlaceholderData], HTMLContent]:
+        """Compile the template once and return a function rendering one record."""
+        return self._record_renderer(newsletter_data, use_skeleton, chunked=False)
+
+    def chunk_renderer(self, newsletter_data: Optional[PlaceholderData] = None,
+                       use_skeleton: bool = True) -> Callable[[PlaceholderData], List[bytes]]:
+        """Like ``bulk_renderer``, but each message comes back as a list of UTF-8 chunks.
+
+        The literal chunks of the inlined skeleton are encoded once and shared
+        by all messages, so no document-sized string is built per message and
+        sinks can write the chunks out as they are. Messages that need the
+        full pipeline or minification come back as a single chunk.
+        """
+        return self._record_renderer(newsletter_data, use_skeleton, chunked=True)
+
+    def _record_renderer(self, newsletter_data: Optional[PlaceholderData], use_skeleton: bool,
+                         chunked: bool) -> Callable[[PlaceholderData], Union[HTMLContent, List[bytes]]]:
+        """Compile the template once and return a function rendering one record."""
+        if newsletter_data is None:
+            newsletter_data = self.read_newsletter_data()
+        compiled = self.compile_template(newsletter_data)
+        shapes = self._skeleton_shapes(compiled)
+        slot_keys = self._skeleton_slot_keys(compiled, shapes, self.placeholder_values(newsletter_data))
+        
+        def render(record: PlaceholderData) -> Union[HTMLContent, List[bytes]]:
+            with metrics.stage("Record rendering") as probe:
+                values = self.placeholder_values(merge_newsletter_data(newsletter_data, record))
+                self._count_placeholders(compiled, values)
+                skeleton = None
+                if use_skeleton and self._slot_values_safe(shapes, values, slot_keys):
+                    skeleton = self._get_skeleton(compiled, shapes, values, slot_keys)
+                metrics.increment('renders.skeleton' if skeleton is not None else 'renders.full')
+                
+                if chunked and skeleton is not None and not self.minify:
+                    chunks = skeleton.render_chunks(values)
+                    probe.output_bytes = sum(map(len, chunks))
+                    return chunks
+                
+                if skeleton is not None:
+                    html_content = skeleton.render(values)
+                else:
+                    html_content = self._inline_html(compiled.render(values))
+                if self.minify:
+                    html_content = self._minify_quietly(html_content)
+                probe.output_bytes = payload_size(html_content)
+                return [html_content.encode('utf-8')] if chunked else html_content
+        
+        return render
+
+    def _inline_html(self, html_content: HTMLContent) -> HTMLContent:
+        """Replace CSS variables and inline CSS without per-stage logging."""
+        html_content = CSSVariableResolver(html_content).resolve()
+        if self._premailer_available():
+            html_content = self._transform_with_premailer(html_content)
+        return html_content
+
+    def _minify_quietly(self, html_content: HTMLContent) -> HTMLContent:
+        """Minify without per-stage logging."""
+        from minify import minify_html
+        return minify_html(html_content, prune_inlined=self._premailer_available())[0]
+
+    def _skeleton_shapes(self, compiled: CompiledTemplate) -> SkeletonShapes:
+        """How loop iterations of this template are grouped in its skeletons."""
+        return SkeletonShapes(
+            baked_keys=compiled.style_placeholders(),
+            attribute_keys=compiled.attribute_placeholders(),
+            collapse=not re.search(POSITIONAL_SELECTOR_PATTERN, compiled.source)
+        )
+
+    def _skeleton_slot_keys(self, compiled: CompiledTemplate, shapes: SkeletonShapes,
+                            values: PlaceholderValues) -> Set[str]:
+        """Placeholders that can stay as sentinels through CSS inlining.
+
+        Nested values (colors) and anything used in CSS take part in the
+        cascade, and shared values that the HTML serializer would rewrite
+        beyond escaping cannot be filled in afterwards; those are baked into
+        the skeleton.
+        """
+        return {
+            key for key in compiled.slot_placeholders
+            if '.' not in key and not shapes.baked(key, values.get(key))
+        }
+
+    def _slot_values_safe(self, shapes: SkeletonShapes, values: PlaceholderValues, slot_keys: Set[str]) -> bool:
+        """Check that every slot value can be filled in as the HTML serializer would write it."""
+        return not any(shapes.baked(key, values.get(key)) for key in slot_keys)
+
+    def _get_skeleton(self, compiled: CompiledTemplate, shapes: SkeletonShapes,
+                      values: PlaceholderValues, slot_keys: Set[str]) -> Optional[InlinedSkeleton]:
+        """Return the cached inlined skeleton for these baked values and loop shapes,
+        building it on a miss."""
+        cache_key = self._skeleton_key(compiled, shapes, values, slot_keys)
+        
+        if cache_key in self._skeletons:
+            metrics.increment('skeleton_cache.hits')
+            self._skeletons.move_to_end(cache_key)
+            return self._skeletons[cache_key]
+        
+        metrics.increment('skeleton_cache.misses')
+        verify = cache_key not in self._verified_skeletons
+        with metrics.stage("Skeleton build"):
+            skeleton = self.build_skeleton(compiled, shapes, values, slot_keys, verify=verify)
+        self._skeletons[cache_key] = skeleton
+        if len(self._skeletons) > SKELETON_CACHE_SIZE:
+            self._skeletons.popitem(last=False)
+        if skeleton is not None:
+            self._verified_skeletons[cache_key] = None
+            self._verified_skeletons.move_to_end(cache_key)
+            if len(self._verified_skeletons) > VERIFIED_SKELETONS_SIZE:
+                self._verified_skeletons.popitem(last=False)
+        return skeleton
+
+    def _skeleton_key(self, compiled: CompiledTemplate, shapes: SkeletonShapes,
+                      values: PlaceholderValues, slot_keys: Set[str]) -> Tuple:
+        """Everything an inlined skeleton depends on besides the slot values."""
+        baked = tuple(sorted(
+            (key, values.get(key)) for key in compiled.slot_placeholders if key not in slot_keys
+        ))
+        return compiled.digest, tuple(sorted(slot_keys)), baked, shapes.shape(compiled.nodes, values)
+
+    def build_skeleton(self, compiled: CompiledTemplate, shapes: SkeletonShapes, values: PlaceholderValues,
+                       slot_keys: Set[str], verify: bool = True) -> Optional[InlinedSkeleton]:
+        """Inline the template once with sentinels in place of the slot placeholders.
+
+        Loops are rendered with one iteration per distinct signature (see
+        SkeletonShapes), so a repeated fragment is inlined once however many
+        items it has. Each recipient then only costs a string fill. With
+        ``verify`` the skeleton is checked against the full pipeline for
+        ``values`` and discarded (None) if the output is not byte-identical;
+        ``_get_skeleton`` checks each skeleton key once and skips the check
+        when the same skeleton is rebuilt after eviction.
+        """
+        if SLOT_SENTINEL_PREFIX in compiled.source or LOOP_MARKER_PREFIX in compiled.source:
+            logger.warning("Template contains the slot sentinel prefix; skeleton rendering disabled")
+            return None
+        
+        html, keys, markers = shapes.render_sentinels(compiled, values, slot_keys)
+        try:
+            skeleton = InlinedSkeleton.parse(
+                self._inline_html(html), keys, markers, shapes, escaped=self._premailer_available()
+            )
+            matches = not verify or skeleton.render(values) == self._inline_html(compiled.render(values))
+        except (ValueError, KeyError) as e:
+            logger.warning(f"Could not build the inlined skeleton ({e}); using full rendering")
+            return None
+        if not matches:
+            logger.warning("Inlined skeleton differs from the full pipeline; using full rendering")
+            return None
+        
+        logger.info(f"Built inlined skeleton with {len(keys)} slots and {len(markers)} loop bodies")
+        return skeleton
+
+    @log_operation("Precompiled rendering")
+    def render_precompiled(self) -> HTMLContent:
+        """Render the newsletter through the skeleton stored in ``precompiled_path``.
+
+        The artifact holds the inlined skeleton of the compiled template and
+        is keyed on everything it depends on: the template and logo, the
+        baked values (colors and anything else used in CSS), the loop shapes,
+        this module and the premailer install. While only slot values change,
+        a run reads the artifact and fills it in without importing premailer.
+        Otherwise the skeleton is rebuilt and the artifact replaced; if no
+        skeleton can be built the full pipeline is used. The output is the
+        same as ``generate()`` without an artifact, before minification.
+        """
+        newsletter_data = self.read_newsletter_data()
+        compiled = self.compile_template(newsletter_data)
+        values = self.placeholder_values(newsletter_data)
+        self._count_placeholders(compiled, values)
+        shapes = self._skeleton_shapes(compiled)
+        slot_keys = self._skeleton_slot_keys(compiled, shapes, values)
+        key = hashlib.sha256(repr(
+            (PRECOMPILED_FORMAT_VERSION, toolchain_fingerprint(),
+             self._skeleton_key(compiled, shapes, values, slot_keys))
+        ).encode('utf-8')).hexdigest()
+        
+        skeleton = self._load_precompiled(key)
+        if skeleton is not None:
+            metrics.increment('precompiled.hits')
+            logger.info(f"Using precompiled skeleton {self.precompiled_path}")
+            return skeleton.render(values)
+        
+        metrics.increment('precompiled.misses')
+        skeleton = self._get_skeleton(compiled, shapes, values, slot_keys)
+        if skeleton is None:
+            return self._inline_html(compiled.render(values))
+        self._save_precompiled(key, skeleton)
+        return skeleton.render(values)
+
+    @log_operation("Cached build")
+    def build_cached(self) -> HTMLContent:
+        """Run the pipeline up to CSS inlining through the build cache.
+
+        Each stage's result (after placeholders, after CSS variables, after
+        inlining) is stored under a hash of that stage's inputs and the
+        toolchain fingerprint. The first stage is keyed on the template,
+        the data and the logo bytes; every later one on the result of the
+        stage before it, so an edit that does not change an intermediate
+        result still reuses everything after it. A run with unchanged
+        inputs only reads the stored results back.
+        """
+        cache = self.build_cache
+        fingerprint = toolchain_fingerprint()
+        html_content = self.read_html_template()
+        newsletter_data = self.read_newsletter_data()
+        
+        stages = (
+            ('prepared', lambda html: self.prepare_html(html, newsletter_data)),
+            ('resolved', self.replace_css_variables),
+            ('inlined', self.inline_css),
+        )
+        inputs = (html_content, *self._prepare_inputs(newsletter_data))
+        reused = []
+        for stage, transform in stages:
+            key = cache.key(stage, fingerprint, *inputs)
+            result = cache.get(key)
+            if result is None:
+                result = transform(html_content)
+                cache.put(key, result)
+            else:
+                reused.append(stage)
+            html_content = result
+            inputs = (html_content,)
+        
+        logger.info(f"Build cache reused {len(reused)} of {len(stages)} stages"
+                    + (f" ({', '.join(reused)})" if reused else ""))
+        cache.evict()
+        return html_content
+
+    def _prepare_inputs(self, newsletter_data: PlaceholderData) -> Tuple[str, ...]:
+        """What placeholder replacement and logo embedding read besides the template."""
+        logo_digest = ''
+        logo_path = newsletter_data.get('logo_path')
+        if logo_path and self._file_exists(logo_path):
+            with open(logo_path, "rb") as f:
+                logo_digest = hashlib.sha256(f.read()).hexdigest()
+        optimizer = ''
+        if self.image_optimizer is not None:
+            optimizer = repr(self.image_optimizer.cache_key(self._logo_display_size(newsletter_data)))
+        return (
+            json.dumps(newsletter_data, sort_keys=True, default=str),
+            logo_digest, optimizer, self.image_embedding,
+        )
+
+    def _load_precompiled(self, key: str) -> Optional[InlinedSkeleton]:
+        """Load the skeleton from the precompiled artifact if it was built for ``key``."""
+        if not self.precompiled_path.exists():
+            return None
+        try:
+            with open(self.precompiled_path, "rb") as f:
+                artifact = _SkeletonUnpickler(f).load()
+            if artifact['key'] != key:
+                logger.info(f"Precompiled skeleton {self.precompiled_path} is out of date; rebuilding")
+                return None
+            return InlinedSkeleton(artifact['nodes'], artifact['shapes'])
+        except (pickle.UnpicklingError, EOFError, AttributeError, KeyError, TypeError, ImportError) as e:
+            logger.warning(f"Ignoring unreadable precompiled skeleton {self.precompiled_path}: {e}")
+            return None
+
+    def _save_precompiled(self, key: str, skeleton: InlinedSkeleton) -> None:
+        """Replace the precompiled artifact with ``skeleton``."""
+        from streaming import AtomicStreamWriter
+        
+        with AtomicStreamWriter(self.precompiled_path) as out:
+            out.write(pickle.dumps(
+                {'key': key, 'nodes': skeleton.nodes, 'shapes': skeleton.shapes},
+                protocol=pickle.HIGHEST_PROTOCOL
+            ))
+        logger.info(f"Saved precompiled skeleton to {self.precompiled_path}")
+
+    @log_operation("Minification")
+    def minify_html(self, html_content: HTMLContent) -> HTMLContent:
+        """Collapse whitespace, strip comments and drop CSS that was already inlined."""
+        from minify import minify_html
+        
+        html_content, stats = minify_html(html_content, prune_inlined=self._premailer_available())
+        logger.info(
+            f"Minified output: {stats.original_bytes} -> {stats.minified_bytes} bytes "
+            f"(ratio {stats.ratio:.2f}, saved {stats.saved_bytes} bytes)"
+        )
+        return html_content
+
+    @log_operation("Size analysis")
+    def analyze_size(self, html_content: HTMLContent) -> SizeReport:
+        """Report the output size per section and enforce the size budget.
+
+        Gmail clips messages larger than about 102 KB, so by default exceeding
+        that logs a warning; with ``budget_action='fail'`` it raises
+        SizeBudgetExceeded instead.
+        """
+        report = SizeReport.from_html(html_content, self.size_budget)
+        logger.info(report.summary())
+        
+        if report.over_budget:
+            message = f"Output is {report.total} bytes, over the budget of {report.budget} bytes"
+            if self.budget_action == 'fail':
+                raise SizeBudgetExceeded(message)
+            logger.warning(message)
+        
+        return report
+
     @log_operation("HTML saving")
     def save_html(self, html_content: HTMLContent) -> None:
-        """Save the HTML content to the output file."""
-        with open(self.paths.output, "w", encoding="utf-8") as f:
-            f.write(html_content)
+        """Save the HTML content to the output file, replacing it atomically."""
+        atomic_write_text(self.paths.output, html_content)
 
     @log_operation("Newsletter generation")
     def generate(self) -> None:
         """Generate the newsletter HTML with inline styles."""
-        # Prepare the HTML with placeholders replaced
-        html = self.prepare_html()
+        if self.build_cache is not None:
+            # Resume from the deepest stage stored for these inputs
+            html = self.build_cached()
+        elif self.precompiled_path is not None:
+            # Fill the stored skeleton, inlining only if it is out of date
+            html = self.render_precompiled()
+        else:
+            # Prepare the HTML with placeholders replaced
+            html = self.prepare_html()
+            
+            # Replace CSS variables with actual values
+            html = self.replace_css_variables(html)
+            
+            # Convert CSS to inline styles
+            html = self.inline_css(html)
         
-        # Replace CSS variables with actual values
-        html = self.replace_css_variables(html)
+        # Shrink the inlined output
+        if self.minify:
+            html = self.minify_html(html)
         
-        # Convert CSS to inline styles
-        html = self.inline_css(html)
+        # Check the output size before anything is written
+        self.analyze_size(html)
         
         # Save the processed HTML
+        if self.build_cache is not None and self._output_matches(html):
+            logger.info(f"{self.paths.output} is up to date")
+            return
+        self.save_html(html)
+
+    def _output_matches(self, html_content: HTMLContent) -> bool:
+        """Whether the output file already holds exactly this HTML."""
+        try:
+            with open(self.paths.output, "r", encoding="utf-8", newline="") as f:
+                return f.read() == html_content
+        except (FileNotFoundError, UnicodeDecodeError):
+            return False
+
+    @log_operation("Incremental generation")
+    def regenerate(self, newsletter_data: Optional[PlaceholderData] = None) -> None:
+        """Generate the newsletter through the cached skeleton.
+
+        The output is the same as ``generate()``, but a long-lived generator
+        only reruns CSS replacement and inlining when the template, the logo
+        or a baked value (such as a color) changed since the last run.
+        """
+        html = self.bulk_renderer(newsletter_data)({})
+        self.analyze_size(html)
         self.save_html(html)
 
 
-def main() -> int:
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line arguments."""
+    parser = argparse.ArgumentParser(description="Generate the newsletter HTML with inline styles.")
+    parser.add_argument("--template", default=NEWSLETTER_TEMPLATE, help="HTML template file")
+    parser.add_argument("--data", default=NEWSLETTER_DATA, help="YAML data file")
+    parser.add_argument("--output", default=NEWSLETTER_OUTPUT, help="Output HTML file")
+    parser.add_argument("--asset-cache-dir",
+                        help="Keep encoded images in this directory between runs")
+    parser.add_argument("--build-cache", metavar="DIR",
+                        help="Store each stage's result in DIR and skip stages whose inputs are unchanged")
+    parser.add_argument("--build-cache-max-mb", type=float, default=DEFAULT_BUILD_CACHE_MB,
+                        help=f"Evict the least recently used build cache entries over this size "
+                             f"(default: {DEFAULT_BUILD_CACHE_MB})")
+    parser.add_argument("--build-cache-max-age", type=float, default=DEFAULT_BUILD_CACHE_DAYS, metavar="DAYS",
+                        help=f"Evict build cache entries unused for this many days "
+                             f"(default: {DEFAULT_BUILD_CACHE_DAYS})")
+    parser.add_argument("--precompiled", metavar="PATH",
+                        help="Keep the CSS-inlined template in PATH and reuse it while only text changes, "
+                             "so such runs skip CSS inlining and never load premailer")
+    parser.add_argument("--size-budget", type=int, default=GMAIL_CLIP_BYTES,
+                        help=f"Warn when the output exceeds this many bytes (default: {GMAIL_CLIP_BYTES}, "
+                             "Gmail's clipping threshold; 0 disables the check)")
+    parser.add_argument("--fail-over-budget", action="store_true",
+                        help="Fail instead of warning when the output exceeds the size budget")
+    parser.add_argument("--minify", action="store_true",
+                        help="Collapse whitespace and drop already inlined CSS from the output")
+    parser.add_argument("--optimize-images", action="store_true",
+                        help="Downscale and recompress the logo before embedding (requires Pillow)")
+    parser.add_argument("--image-dpr", type=float, default=DEFAULT_IMAGE_DPR,
+                        help=f"Pixel density to keep when downscaling images (default: {DEFAULT_IMAGE_DPR})")
+    
+    parser.add_argument("--watch", action="store_true",
+                        help="Stay running and regenerate whenever the template, data or logo changes")
+    parser.add_argument("--watch-interval", type=float, default=0.2,
+                        help="Seconds between checks for changes in watch mode (default: 0.2)")
+    
+    profiling = parser.add_argument_group("profiling")
+    profiling.add_argument("--metrics-json", metavar="PATH",
+                           help="Write per-stage timings, sizes and counters to a JSON file")
+    profiling.add_argument("--trace-memory", action="store_true",
+                           help="Record the peak memory of each stage with tracemalloc (slow)")
+    profiling.add_argument("--profile", metavar="PATH",
+                           help="Run under cProfile and dump the stats to PATH")
+    
+    merge = parser.add_argument_group("mail merge")
+    merge.add_argument("--merge", metavar="RECIPIENTS",
+                       help="Render one newsletter per row of a CSV or JSONL subscriber list")
+    target = merge.add_mutually_exclusive_group()
+    target.add_argument("--output-dir", help="Write merged messages into a sharded directory")
+    target.add_argument("--archive", help="Stream merged messages into a single tar archive")
+    target.add_argument("--maildir", help="Deliver merged MIME messages into a Maildir (implies --mime)")
+    target.add_argument("--mbox", help="Append merged MIME messages to an mbox file (implies --mime)")
+    target.add_argument("--deliver", metavar="HOST[:PORT]",
+                        help="Send merged MIME messages to this SMTP server (implies --mime)")
+    merge.add_argument("--restart", action="store_true",
+                       help="Ignore an existing checkpoint and start from the first row")
+    merge.add_argument("--workers", type=int, default=1,
+                       help="Number of worker processes for --merge and --manifest (default: 1, in-process)")
+    merge.add_argument("--chunk-size", type=int, default=50,
+                       help="Records handed to a worker at a time (default: 50)")
+    merge.add_argument("--gzip", action="store_true",
+                       help="Gzip each merged message on the fly (.html.gz)")
+    
+    parser.add_argument("--themes", metavar="PATH",
+                        help="Render the issue once per palette in a YAML file of theme names to colors, "
+                             "inlining only once (writes <output>-<theme>.html)")
+    
+    parser.add_argument("--serve", nargs="?", const=DEFAULT_SERVER_ADDRESS, metavar="ADDRESS",
+                        help="Stay running as a render server on host:port or unix:PATH "
+                             f"(default: {DEFAULT_SERVER_ADDRESS}); POST /render takes a JSON data overlay")
+    
+    builds = parser.add_argument_group("manifest builds")
+    builds.add_argument("--manifest", metavar="PATH",
+                        help="Build every template/data/output entry of a YAML manifest in one run, "
+                             "sharing templates, inlining and assets between entries")
+    
+    smtp = parser.add_argument_group("SMTP delivery")
+    smtp.add_argument("--smtp-connections", type=int, default=4,
+                      help="SMTP connections kept open and reused (default: 4)")
+    smtp.add_argument("--smtp-starttls", action="store_true", help="Upgrade connections with STARTTLS")
+    smtp.add_argument("--smtp-ssl", action="store_true", help="Connect with implicit TLS (port 465)")
+    smtp.add_argument("--smtp-user", help="Authenticate as this user; the password is read from $SMTP_PASSWORD")
+    smtp.add_argument("--rate-limit", action="append", default=[], metavar="DOMAIN=PER_SECOND",
+                      help="Messages per second to one recipient domain; '*' sets the default (repeatable)")
+    smtp.add_argument("--max-attempts", type=int, default=5,
+                      help="Attempts per message before a temporary failure counts as failed (default: 5)")
+    smtp.add_argument("--delivery-journal", metavar="PATH",
+                      help="Delivery journal (default: next to the subscriber list)")
+    
+    messages = parser.add_argument_group("MIME messages")
+    messages.add_argument("--mime", choices=("alternative", "related"),
+                          help="Write RFC 5322 messages (.eml) with a plain-text part; 'related' attaches "
+                               "the logo and references it by cid: instead of a data URI")
+    
+    args = parser.parse_args(argv)
+    if args.merge and not (args.output_dir or args.archive or args.maildir or args.mbox or args.deliver):
+        parser.error("--merge requires --output-dir, --archive, --maildir, --mbox or --deliver")
+    if args.manifest and (args.merge or args.watch or args.mime):
+        parser.error("--manifest cannot be combined with --merge, --watch or --mime")
+    if args.themes and (args.manifest or args.merge or args.watch or args.mime):
+        parser.error("--themes cannot be combined with --manifest, --merge, --watch or --mime")
+    if args.serve and (args.manifest or args.themes or args.merge or args.watch or args.mime):
+        parser.error("--serve cannot be combined with --manifest, --themes, --merge, --watch or --mime")
+    mime_target = args.maildir or args.mbox or args.deliver
+    if mime_target and not args.merge:
+        parser.error("--maildir, --mbox and --deliver require --merge")
+    if args.gzip and mime_target:
+        parser.error("--gzip only applies to --output-dir and --archive")
+    if mime_target and not args.mime:
+        args.mime = "alternative"
+    try:
+        args.rate_limit = {
+            domain.strip(): float(rate)
+            for domain, rate in (item.split("=", 1) for item in args.rate_limit)
+        }
+    except ValueError:
+        parser.error("--rate-limit expects DOMAIN=PER_SECOND")
+    return args
+
+
+def run_merge(generator: NewsletterGenerator, args: argparse.Namespace) -> None:
+    """Run the mail merge described by the command line arguments."""
+    if args.deliver:
+        run_delivery(generator, args)
+        return
+    
+    from mail_merge import (
+        EML_EXTENSION, HTML_EXTENSION, ArchiveSink, DirectorySink, MailMerge, MaildirSink, MboxSink
+    )
+    
+    extension = EML_EXTENSION if args.mime else HTML_EXTENSION
+    if args.output_dir:
+        sink = DirectorySink(args.output_dir, compress=args.gzip, extension=extension)
+    elif args.archive:
+        sink = ArchiveSink(args.archive, compress=args.gzip, extension=extension)
+    elif args.maildir:
+        sink = MaildirSink(args.maildir)
+    else:
+        sink = MboxSink(args.mbox)
+    
+    renderer_factory = None
+    if args.mime:
+        from mime_messages import message_renderer
+        renderer_factory = message_renderer
+    MailMerge(
+        generator, args.merge, sink, workers=args.workers, chunk_size=args.chunk_size,
+        renderer_factory=renderer_factory
+    ).run(resume=not args.restart)
+
+
+def run_manifest(generator: NewsletterGenerator, args: argparse.Namespace) -> None:
+    """Build the entries of a manifest with the options of ``generator``."""
+    from manifest import ManifestBuild, load_manifest
+    
+    results = ManifestBuild(load_manifest(args.manifest), generator, workers=args.workers).run()
+    failed = [result.name for result in results if not result.ok]
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(results)} manifest entries failed: {', '.join(failed)}")
+
+
+@log_operation("Theme rendering")
+def run_themes(generator: NewsletterGenerator, args: argparse.Namespace) -> None:
+    """Render the issue in every palette of the themes file."""
+    from themes import ThemeVariants, load_themes, theme_output_path
+    
+    themes = load_themes(args.themes)
+    variants = ThemeVariants(generator).build()
+    for name, html_content in variants.render_all(themes):
+        generator.analyze_size(html_content)
+        output_path = theme_output_path(generator.paths.output, name)
+        atomic_write_text(output_path, html_content)
+        logger.info(f"Theme '{name}' saved to {output_path}")
+
+
+def run_delivery(generator: NewsletterGenerator, args: argparse.Namespace) -> None:
+    """Render and send the merge over SMTP as described by the command line arguments."""
+    from delivery import BulkDelivery, DomainRateLimiter, SMTPSettings
+    
+    settings = SMTPSettings.from_address(
+        args.deliver, starttls=args.smtp_starttls, use_tls=args.smtp_ssl,
+        username=args.smtp_user, password=os.environ.get("SMTP_PASSWORD")
+    )
+    rates = dict(args.rate_limit)
+    report = BulkDelivery(
+        generator, args.merge, settings, journal_path=args.delivery_journal,
+        connections=args.smtp_connections, max_attempts=args.max_attempts,
+        rate_limiter=DomainRateLimiter(rates, default_rate=rates.pop("*", None)),
+        workers=args.workers, chunk_size=args.chunk_size
+    ).run(resume=not args.restart)
+    if report.failed:
+        logger.warning(f"{report.failed} messages could not be delivered; see the delivery journal")
+
+
+@log_operation("MIME message generation")
+def write_message(generator: NewsletterGenerator, output_path: Union[str, Path]) -> None:
+    """Write the newsletter as a single MIME message without a recipient."""
+    from mime_messages import message_renderer
+    from streaming import AtomicStreamWriter
+    
+    with AtomicStreamWriter(output_path) as out:
+        out.writelines(message_renderer(generator)({}))
+    logger.info(f"MIME message saved to {output_path}")
+
+
+def open_build_cache(args: argparse.Namespace) -> Optional['BuildCache']:
+    """The build cache described by the command line arguments, if one was requested."""
+    if not args.build_cache:
+        return None
+    from build_cache import BuildCache
+    
+    return BuildCache(
+        args.build_cache,
+        max_bytes=int(args.build_cache_max_mb * 1024 * 1024),
+        max_age=args.build_cache_max_age * 24 * 3600
+    )
+
+
+def main(argv: Optional[List[str]] = None) -> int:
     """Main entry point for the newsletter generator."""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s')
+    if args.trace_memory:
+        metrics.enable_memory_tracing()
     try:
-        generator = NewsletterGenerator()
-        generator.generate()
+        generator = NewsletterGenerator(
+            template_path=args.template,
+            output_path=args.output,
+            data_path=args.data,
+            asset_cache=AssetCache(store_dir=args.asset_cache_dir),
+            image_optimizer=ImageOptimizer(dpr=args.image_dpr) if args.optimize_images else None,
+            size_budget=args.size_budget or None,
+            budget_action='fail' if args.fail_over_budget else 'warn',
+            minify=args.minify,
+            image_embedding='cid' if args.mime == 'related' else 'data',
+            precompiled_path=args.precompiled,
+            build_cache=open_build_cache(args)
+        )
+        with profile_to(args.profile):
+            if args.manifest:
+                run_manifest(generator, args)
+            elif args.themes:
+                run_themes(generator, args)
+            elif args.serve:
+                from server import serve
+                serve(generator, args.serve)
+            elif args.merge:
+                run_merge(generator, args)
+            elif args.watch:
+                from watch import Watcher
+                Watcher(generator, interval=args.watch_interval).run()
+            elif args.mime:
+                output = Path(args.output)
+                write_message(generator, output.with_suffix('.eml') if args.output == NEWSLETTER_OUTPUT else output)
+            else:
+                generator.generate()
+        return 0
+    except KeyboardInterrupt:
         return 0
     except Exception as e:
         logger.error(f"Newsletter generation failed: {e}")
         return 1
+    finally:
+        if args.metrics_json:
+            logger.info(f"Stage metrics:\n{metrics.summary()}")
+            metrics.write_json(args.metrics_json)
 
 
 if __name__ == "__main__":
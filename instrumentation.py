@@ -0,0 +1,222 @@
+import json
+import logging
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, fields
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+# Constants
+CACHE_HIT_SUFFIX = ".hits"
+CACHE_MISS_SUFFIX = ".misses"
+
+logger = logging.getLogger(__name__)
+
+MetricsSnapshot = Dict[str, Any]
+
+
+def payload_size(value: Any) -> int:
+    """Size in bytes of a str (UTF-8) or bytes value, 0 for anything else."""
+    if isinstance(value, str):
+        return len(value.encode("utf-8"))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    return 0
+
+
+@dataclass
+class StageStats:
+    """Measurements of one pipeline stage, summed over all of its calls.
+
+    ``peak_memory_bytes`` is the largest tracemalloc peak of a single call,
+    relative to the memory in use when the call started; it stays 0 unless
+    memory tracing is enabled.
+    """
+    calls: int = 0
+    failures: int = 0
+    wall_seconds: float = 0.0
+    cpu_seconds: float = 0.0
+    peak_memory_bytes: int = 0
+    input_bytes: int = 0
+    output_bytes: int = 0
+
+    def merge(self, other: 'StageStats') -> None:
+        """Add another set of measurements of the same stage."""
+        for stat in fields(self):
+            if stat.name == 'peak_memory_bytes':
+                self.peak_memory_bytes = max(self.peak_memory_bytes, other.peak_memory_bytes)
+            else:
+                setattr(self, stat.name, getattr(self, stat.name) + getattr(other, stat.name))
+
+
+@dataclass
+class StageProbe:
+    """Handed to the body of a stage to report its output size; holds the timing afterwards."""
+    input_bytes: int = 0
+    output_bytes: int = 0
+    wall_seconds: float = 0.0
+
+
+class Metrics:
+    """Stage timings, memory peaks, sizes and counters for one process.
+
+    Stages are recorded by ``log_operation`` and by ``stage()`` blocks;
+    counters named ``<cache>.hits``/``<cache>.misses`` are reported as cache
+    hit ratios. Worker processes export their metrics with ``drain()`` and the
+    parent folds them in with ``merge()``.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, StageStats] = {}
+        self.counters: Dict[str, int] = {}
+        self.trace_memory = False
+        # One [memory at stage start, highest peak seen so far] per open stage
+        self._memory_frames: List[List[int]] = []
+
+    def enable_memory_tracing(self) -> None:
+        """Start tracemalloc so stages record their peak memory (slows everything down)."""
+        import tracemalloc
+
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        self.trace_memory = True
+
+    def increment(self, name: str, count: int = 1) -> None:
+        """Add to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    @contextmanager
+    def stage(self, name: str, input_value: Any = None) -> Iterator[StageProbe]:
+        """Time the enclosed block as one call of stage ``name``."""
+        probe = StageProbe(input_bytes=payload_size(input_value))
+        tracing = self.trace_memory and self._tracing()
+        if tracing:
+            self._enter_memory_frame()
+        failed = False
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield probe
+        except BaseException:
+            failed = True
+            raise
+        finally:
+            probe.wall_seconds = time.perf_counter() - wall_start
+            stats = self.stages.setdefault(name, StageStats())
+            stats.calls += 1
+            stats.failures += failed
+            stats.wall_seconds += probe.wall_seconds
+            stats.cpu_seconds += time.process_time() - cpu_start
+            stats.input_bytes += probe.input_bytes
+            stats.output_bytes += probe.output_bytes
+            if tracing:
+                stats.peak_memory_bytes = max(stats.peak_memory_bytes, self._exit_memory_frame())
+
+    @staticmethod
+    def _tracing() -> bool:
+        """Whether tracemalloc is still running (only asked once memory tracing was enabled)."""
+        import tracemalloc
+        return tracemalloc.is_tracing()
+
+    def _enter_memory_frame(self) -> None:
+        """Reset the tracemalloc peak for a new stage, keeping the enclosing stage's peak."""
+        import tracemalloc
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self._memory_frames:
+            self._memory_frames[-1][1] = max(self._memory_frames[-1][1], peak)
+        tracemalloc.reset_peak()
+        self._memory_frames.append([current, current])
+
+    def _exit_memory_frame(self) -> int:
+        """Close the innermost stage and return its peak above its starting point."""
+        import tracemalloc
+
+        _, peak = tracemalloc.get_traced_memory()
+        start, seen = self._memory_frames.pop()
+        peak = max(peak, seen)
+        if self._memory_frames:
+            self._memory_frames[-1][1] = max(self._memory_frames[-1][1], peak)
+        return peak - start
+
+    def cache_hit_ratios(self) -> Dict[str, float]:
+        """Hit ratio for every counter pair named ``<cache>.hits``/``<cache>.misses``."""
+        caches = {
+            name[:-len(suffix)]
+            for name in self.counters
+            for suffix in (CACHE_HIT_SUFFIX, CACHE_MISS_SUFFIX) if name.endswith(suffix)
+        }
+        ratios = {}
+        for cache in caches:
+            hits = self.counters.get(cache + CACHE_HIT_SUFFIX, 0)
+            lookups = hits + self.counters.get(cache + CACHE_MISS_SUFFIX, 0)
+            if lookups:
+                ratios[cache] = hits / lookups
+        return ratios
+
+    def to_dict(self) -> MetricsSnapshot:
+        """All metrics as JSON-serializable data."""
+        return {
+            'stages': {name: asdict(stats) for name, stats in self.stages.items()},
+            'counters': dict(self.counters),
+            'cache_hit_ratios': self.cache_hit_ratios(),
+        }
+
+    def merge(self, snapshot: MetricsSnapshot) -> None:
+        """Fold in metrics exported by ``to_dict()``/``drain()``, e.g. from a worker process."""
+        for name, stats in snapshot.get('stages', {}).items():
+            self.stages.setdefault(name, StageStats()).merge(StageStats(**stats))
+        for name, count in snapshot.get('counters', {}).items():
+            self.increment(name, count)
+
+    def drain(self) -> MetricsSnapshot:
+        """Export the metrics and start over."""
+        snapshot = self.to_dict()
+        self.reset()
+        return snapshot
+
+    def reset(self) -> None:
+        """Forget all recorded metrics."""
+        self.stages.clear()
+        self.counters.clear()
+
+    def summary(self) -> str:
+        """Human readable, one line per stage followed by the cache hit ratios."""
+        lines = []
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].wall_seconds):
+            line = (f"{name}: {stats.calls} calls, {stats.wall_seconds * 1000:.1f} ms wall, "
+                    f"{stats.cpu_seconds * 1000:.1f} ms CPU")
+            if stats.peak_memory_bytes:
+                line += f", peak {stats.peak_memory_bytes / 1024:.0f} KiB"
+            lines.append(line)
+        for cache, ratio in sorted(self.cache_hit_ratios().items()):
+            lines.append(f"{cache} hit ratio: {ratio:.1%}")
+        return "\n".join(lines)
+
+    def write_json(self, path: Union[str, Path]) -> None:
+        """Write the metrics to a JSON file."""
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        logger.info(f"Metrics written to {path}")
+
+
+@contextmanager
+def profile_to(path: Optional[Union[str, Path]]) -> Iterator[None]:
+    """Run the enclosed block under cProfile and dump the stats to ``path`` (no-op without a path)."""
+    if not path:
+        yield
+        return
+    import cProfile
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(str(path))
+        logger.info(f"Profile written to {path} (inspect with python -m pstats)")
+
+
+# Process-wide metrics shared by the generator, batch runner and mail merge
+metrics = Metrics()
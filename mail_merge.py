@@ -0,0 +1,370 @@
+import csv
+import json
+import logging
+import os
+import socket
+import tarfile
+import time
+from itertools import islice
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+from batch import DEFAULT_CHUNK_SIZE, BatchRunner, RecordResult, RendererFactory
+from generate import (
+    NewsletterGenerator,
+    PlaceholderData,
+    atomic_write_text,
+    log_operation,
+)
+from streaming import GZIP_SUFFIX, AtomicStreamWriter, ChunkReader, chunks_size, gzip_chunks
+
+# Constants
+SHARD_SIZE = 1000
+CHECKPOINT_EVERY = 100
+MESSAGE_NAME_FORMAT = "{index:07d}{extension}"
+HTML_EXTENSION = ".html"
+EML_EXTENSION = ".eml"
+MAILDIR_NAME_FORMAT = "{run}.N{index:07d}.{host}"
+MBOX_FROM_LINE = "From MAILER-DAEMON {date}\n"
+SHARD_NAME_FORMAT = "{shard:04d}"
+STATE_FILE_NAME = ".merge-state.json"
+FAILURES_FILE_NAME = ".merge-failures.jsonl"
+
+logger = logging.getLogger(__name__)
+
+SinkState = Dict[str, Any]
+
+
+def iter_recipients(recipients_path: Union[str, Path]) -> Iterator[PlaceholderData]:
+    """Lazily yield subscriber rows from a CSV or JSONL file.
+
+    CSV columns may use dotted names (``colors.primary``) to override nested
+    values; empty cells are skipped so they do not blank out shared data.
+    """
+    path = Path(recipients_path)
+    suffix = path.suffix.lower()
+
+    if suffix == ".csv":
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                yield _expand_dotted_keys({k: v for k, v in row.items() if v not in (None, "")})
+    elif suffix in (".jsonl", ".ndjson"):
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+    else:
+        raise ValueError(f"Unsupported recipient list format: {path} (expected .csv or .jsonl)")
+
+
+def _expand_dotted_keys(row: Dict[str, Any]) -> PlaceholderData:
+    """Turn ``{'colors.primary': x}`` into ``{'colors': {'primary': x}}``."""
+    record: PlaceholderData = {}
+    for key, value in row.items():
+        if "." in key:
+            parent, subkey = key.split(".", 1)
+            record.setdefault(parent, {})[subkey] = value
+        else:
+            record[key] = value
+    return record
+
+
+def _message_name(index: int, shard_size: int, compress: bool, extension: str = HTML_EXTENSION) -> str:
+    """``<shard>/<index>.html`` (or ``.eml``), with ``.gz`` appended for compressed messages."""
+    name = (f"{SHARD_NAME_FORMAT.format(shard=index // shard_size)}/"
+            f"{MESSAGE_NAME_FORMAT.format(index=index, extension=extension)}")
+    return name + GZIP_SUFFIX if compress else name
+
+
+class DirectorySink:
+    """Write each message to ``<directory>/<shard>/<index>.html`` (``.html.gz`` with ``compress``).
+
+    Messages are streamed chunk by chunk into a temporary file that is
+    renamed into place, so after a crash every file on disk is complete and
+    rows past the last checkpoint are simply rendered again. MIME messages
+    use ``extension=".eml"``.
+    """
+
+    def __init__(self, directory: Union[str, Path], shard_size: int = SHARD_SIZE, compress: bool = False,
+                 extension: str = HTML_EXTENSION):
+        self.directory = Path(directory)
+        self.shard_size = shard_size
+        self.compress = compress
+        self.extension = extension
+        self.state_path = self.directory / STATE_FILE_NAME
+        self.failures_path = self.directory / FAILURES_FILE_NAME
+
+    def open(self, state: Optional[SinkState]) -> None:
+        """Prepare the output directory."""
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def write(self, index: int, chunks: List[bytes]) -> None:
+        """Write one rendered message."""
+        path = self.directory / _message_name(index, self.shard_size, self.compress, self.extension)
+        path.parent.mkdir(exist_ok=True)
+        with AtomicStreamWriter(path, compress=self.compress) as out:
+            out.writelines(chunks)
+
+    def state(self) -> SinkState:
+        """Sink position to store in the checkpoint."""
+        return {}
+
+    def close(self) -> None:
+        """Nothing to finalize for a directory."""
+
+
+class ArchiveSink:
+    """Stream messages into a single tar archive.
+
+    The archive itself is uncompressed so it can be truncated and appended
+    to; with ``compress`` each member is gzipped on its own instead. The
+    checkpoint records the archive offset after the last completed member;
+    on resume the archive is truncated back to it before appending.
+    """
+
+    def __init__(self, archive_path: Union[str, Path], shard_size: int = SHARD_SIZE, compress: bool = False,
+                 extension: str = HTML_EXTENSION):
+        self.archive_path = Path(archive_path)
+        self.shard_size = shard_size
+        self.compress = compress
+        self.extension = extension
+        self.state_path = self.archive_path.with_name(self.archive_path.name + STATE_FILE_NAME)
+        self.failures_path = self.archive_path.with_name(self.archive_path.name + FAILURES_FILE_NAME)
+        self._file = None
+        self._tar: Optional[tarfile.TarFile] = None
+
+    def open(self, state: Optional[SinkState]) -> None:
+        """Open the archive, truncating it to the checkpointed offset when resuming."""
+        self.archive_path.parent.mkdir(parents=True, exist_ok=True)
+        if state and self.archive_path.exists():
+            self._file = open(self.archive_path, "r+b")
+            self._file.seek(state["offset"])
+            self._file.truncate()
+        else:
+            self._file = open(self.archive_path, "w+b")
+        self._tar = tarfile.open(fileobj=self._file, mode="w")
+
+    def write(self, index: int, chunks: List[bytes]) -> None:
+        """Append one rendered message as an archive member, copying the chunks straight in."""
+        if self.compress:
+            chunks = [gzip_chunks(chunks)]
+        member = tarfile.TarInfo(_message_name(index, self.shard_size, self.compress, self.extension))
+        member.size = chunks_size(chunks)
+        member.mtime = int(time.time())
+        self._tar.addfile(member, ChunkReader(chunks))
+
+    def state(self) -> SinkState:
+        """Flush the archive and return the offset after the last member."""
+        self._file.flush()
+        return {"offset": self._tar.offset}
+
+    def close(self) -> None:
+        """Write the end-of-archive marker and close the file."""
+        if self._tar is not None:
+            self._tar.close()
+            self._file.close()
+            self._tar = None
+
+
+class MaildirSink:
+    """Deliver MIME messages into a Maildir (``tmp``/``new``/``cur``).
+
+    Each message is written to ``tmp`` and renamed into ``new``. File names
+    are derived from a run id kept in the checkpoint and the row index, so a
+    resumed run overwrites the messages it renders again instead of
+    delivering them twice.
+    """
+
+    def __init__(self, directory: Union[str, Path]):
+        self.directory = Path(directory)
+        self.state_path = self.directory / STATE_FILE_NAME
+        self.failures_path = self.directory / FAILURES_FILE_NAME
+        # Maildir names must not contain "/" or ":"
+        self._host = socket.gethostname().replace("/", "\\057").replace(":", "\\072")
+        self._run = ""
+
+    def open(self, state: Optional[SinkState]) -> None:
+        """Create the Maildir and pick up the run id when resuming."""
+        for subdir in ("tmp", "new", "cur"):
+            (self.directory / subdir).mkdir(parents=True, exist_ok=True)
+        self._run = state["run"] if state else f"{int(time.time())}.P{os.getpid()}"
+
+    def write(self, index: int, chunks: List[bytes]) -> None:
+        """Deliver one message into ``new``."""
+        name = MAILDIR_NAME_FORMAT.format(run=self._run, index=index, host=self._host)
+        with AtomicStreamWriter(self.directory / "new" / name, temp_dir=self.directory / "tmp") as out:
+            out.writelines(chunks)
+
+    def state(self) -> SinkState:
+        """Sink position to store in the checkpoint."""
+        return {"run": self._run}
+
+    def close(self) -> None:
+        """Nothing to finalize for a Maildir."""
+
+
+class MboxSink:
+    """Append MIME messages to an mbox file.
+
+    Messages from ``mime_messages.MessageBuilder`` use bare line feeds and
+    never contain a line starting with ``From``; any other such line is
+    escaped as ``>From``. Like the archive sink, the checkpoint records the
+    file offset after the last complete message and a resumed run truncates
+    back to it.
+    """
+
+    def __init__(self, mbox_path: Union[str, Path]):
+        self.mbox_path = Path(mbox_path)
+        self.state_path = self.mbox_path.with_name(self.mbox_path.name + STATE_FILE_NAME)
+        self.failures_path = self.mbox_path.with_name(self.mbox_path.name + FAILURES_FILE_NAME)
+        self._file = None
+
+    def open(self, state: Optional[SinkState]) -> None:
+        """Open the mbox file, truncating it to the checkpointed offset when resuming."""
+        self.mbox_path.parent.mkdir(parents=True, exist_ok=True)
+        if state and self.mbox_path.exists():
+            self._file = open(self.mbox_path, "r+b")
+            self._file.seek(state["offset"])
+            self._file.truncate()
+        else:
+            self._file = open(self.mbox_path, "wb")
+
+    def write(self, index: int, chunks: List[bytes]) -> None:
+        """Append one message behind its ``From`` separator line."""
+        self._file.write(MBOX_FROM_LINE.format(date=time.asctime()).encode("ascii"))
+        last = b"\n"
+        for chunk in chunks:
+            if not chunk:
+                continue
+            chunk = chunk.replace(b"\nFrom ", b"\n>From ")
+            if last.endswith(b"\n") and chunk.startswith(b"From "):
+                chunk = b">" + chunk
+            self._file.write(chunk)
+            last = chunk
+        self._file.write(b"\n" if last.endswith(b"\n") else b"\n\n")
+
+    def state(self) -> SinkState:
+        """Flush the file and return the offset after the last message."""
+        self._file.flush()
+        return {"offset": self._file.tell()}
+
+    def close(self) -> None:
+        """Close the file."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+Sink = Union[DirectorySink, ArchiveSink, MaildirSink, MboxSink]
+
+
+class MailMerge:
+    """Render one newsletter per subscriber row onto a shared data file.
+
+    Rows are streamed from the recipient list and messages are streamed to the
+    sink, so memory stays flat regardless of list size. Progress is
+    checkpointed every ``checkpoint_every`` rows and a rerun resumes after the
+    last checkpoint. Rows are rendered by a BatchRunner; rows that fail are
+    appended to the sink's failures file and do not stop the merge. A fresh
+    run empties the failures file and a resumed run drops the entries of the
+    rows it renders again, so every row is listed at most once.
+    """
+
+    def __init__(
+        self,
+        generator: NewsletterGenerator,
+        recipients_path: Union[str, Path],
+        sink: Sink,
+        checkpoint_every: int = CHECKPOINT_EVERY,
+        workers: int = 1,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        renderer_factory: Optional[RendererFactory] = None
+    ):
+        self.generator = generator
+        self.recipients_path = Path(recipients_path)
+        self.sink = sink
+        self.checkpoint_every = checkpoint_every
+        self.runner = BatchRunner(generator, workers=workers, chunk_size=chunk_size,
+                                  renderer_factory=renderer_factory)
+        self.failed = 0
+
+    def _load_checkpoint(self) -> Optional[Dict[str, Any]]:
+        """Return the stored checkpoint if it belongs to this recipient list."""
+        if not self.sink.state_path.exists():
+            return None
+        with open(self.sink.state_path, "r", encoding="utf-8") as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("recipients") != str(self.recipients_path.resolve()):
+            logger.warning(f"Ignoring checkpoint for a different recipient list: {self.sink.state_path}")
+            return None
+        return checkpoint
+
+    def _save_checkpoint(self, completed: int, done: bool = False) -> None:
+        """Atomically record the number of completed rows and the sink position."""
+        checkpoint = {
+            "recipients": str(self.recipients_path.resolve()),
+            "completed": completed,
+            "done": done,
+            "sink": self.sink.state(),
+        }
+        atomic_write_text(self.sink.state_path, json.dumps(checkpoint))
+
+    def _reset_failures(self, start: int) -> None:
+        """Keep only the failures of rows before ``start``, which this run does not render again."""
+        failures_path = self.sink.failures_path
+        if not failures_path.exists():
+            return
+        kept = []
+        if start:
+            with open(failures_path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        if json.loads(line)["index"] < start:
+                            kept.append(line)
+                    except (ValueError, KeyError, TypeError):
+                        # A line cut short by an interrupted run
+                        continue
+        atomic_write_text(failures_path, "".join(kept))
+
+    def _record_failure(self, result: RecordResult) -> None:
+        """Append a failed row to the failures file."""
+        self.failed += 1
+        logger.error(f"Row {result.index} failed: {result.error}")
+        with open(self.sink.failures_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"index": result.index, "error": result.error}) + "\n")
+
+    @log_operation("Mail merge")
+    def run(self, resume: bool = True) -> int:
+        """Render all remaining rows and return how many were written in this run."""
+        checkpoint = self._load_checkpoint() if resume else None
+        if checkpoint and checkpoint["done"]:
+            logger.info(f"Mail merge already complete ({checkpoint['completed']} messages)")
+            return 0
+
+        start = checkpoint["completed"] if checkpoint else 0
+        if start:
+            logger.info(f"Resuming mail merge after row {start}")
+
+        self.sink.open(checkpoint["sink"] if checkpoint else None)
+        self._reset_failures(start)
+        rows = islice(iter_recipients(self.recipients_path), start, None)
+        completed = start
+        try:
+            for result in self.runner.run(rows, start=start):
+                if result.ok:
+                    self.sink.write(result.index, result.chunks)
+                else:
+                    self._record_failure(result)
+                completed = result.index + 1
+                if completed % self.checkpoint_every == 0:
+                    self._save_checkpoint(completed)
+            self._save_checkpoint(completed, done=True)
+        except BaseException:
+            # Keep whatever finished so the next run resumes from here
+            self._save_checkpoint(completed)
+            raise
+        finally:
+            self.sink.close()
+
+        logger.info(f"Mail merge processed {completed - start} rows, {self.failed} failed")
+        return completed - start
@@ -0,0 +1,253 @@
+import logging
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Hashable, List, Optional, Tuple, Union
+
+from generate import NewsletterGenerator, PlaceholderData, load_yaml_file, log_operation, merge_newsletter_data
+from instrumentation import MetricsSnapshot, metrics, payload_size
+
+# Constants
+MANIFEST_ENTRIES_KEY = 'entries'
+MANIFEST_DEFAULTS_KEY = 'defaults'
+REQUIRED_ENTRY_KEYS = ('template', 'data', 'output')
+
+logger = logging.getLogger(__name__)
+
+IndexedEntry = Tuple[int, 'ManifestEntry']
+
+# Per-process build state, created once by _init_worker
+_worker_state: Optional['_BuildState'] = None
+
+
+@dataclass(frozen=True)
+class ManifestEntry:
+    """One newsletter to build: a template, data files merged in order, and the output file."""
+    name: str
+    template: Path
+    data: Tuple[Path, ...]
+    output: Path
+
+
+@dataclass
+class EntryResult:
+    """How building one entry went.
+
+    ``shared`` is set when the entry was filled into an inlined skeleton
+    shared with other entries instead of going through CSS inlining itself.
+    """
+    name: str
+    output: Path
+    seconds: float = 0.0
+    output_bytes: int = 0
+    shared: bool = False
+    error: Optional[str] = None
+
+    @property
+    def ok(self) -> bool:
+        """Whether the entry was built."""
+        return self.error is None
+
+
+def load_manifest(path: Union[str, Path]) -> List[ManifestEntry]:
+    """Read a YAML build manifest.
+
+    The manifest has an ``entries`` list; each entry names a ``template``,
+    ``data`` (one file or a list of files, merged in order like subscriber
+    overrides, e.g. a brand file followed by an issue file) and ``output``,
+    plus an optional ``name``. Keys in ``defaults`` apply to every entry.
+    Paths are relative to the manifest, and output directories are created
+    as needed; ``logo_path`` inside the data keeps its usual meaning.
+    """
+    path = Path(path)
+    manifest = load_yaml_file(path) or {}
+    defaults = manifest.get(MANIFEST_DEFAULTS_KEY) or {}
+    base = path.parent
+
+    entries = []
+    for position, item in enumerate(manifest.get(MANIFEST_ENTRIES_KEY) or [], start=1):
+        item = {**defaults, **item}
+        missing = [key for key in REQUIRED_ENTRY_KEYS if not item.get(key)]
+        if missing:
+            raise ValueError(f"Manifest entry {position} has no {', '.join(missing)}")
+        data = item['data'] if isinstance(item['data'], list) else [item['data']]
+        entries.append(ManifestEntry(
+            name=str(item.get('name') or Path(item['output']).stem),
+            template=base / item['template'],
+            data=tuple(base / data_path for data_path in data),
+            output=base / item['output'],
+        ))
+
+    if not entries:
+        raise ValueError(f"Manifest {path} has no entries")
+    outputs = [entry.output.resolve() for entry in entries]
+    if len(set(outputs)) != len(outputs):
+        raise ValueError(f"Manifest {path} writes the same output file more than once")
+    return entries
+
+
+class _BuildState:
+    """Everything a process shares between the entries it builds.
+
+    Generators for the entries come from one prototype, so they share its
+    encoded assets, compiled templates and inlined skeletons; data files
+    used by several entries (like a brand file) are parsed once.
+    """
+
+    def __init__(self, prototype: NewsletterGenerator):
+        self.prototype = prototype
+        self._data_files: Dict[Path, PlaceholderData] = {}
+
+    def data(self, entry: ManifestEntry) -> PlaceholderData:
+        """The entry's data files merged in order."""
+        merged: PlaceholderData = {}
+        for path in entry.data:
+            if path not in self._data_files:
+                self._data_files[path] = load_yaml_file(path) or {}
+            merged = merge_newsletter_data(merged, self._data_files[path])
+        return merged
+
+    def generator(self, entry: ManifestEntry) -> NewsletterGenerator:
+        """A generator for the entry's files that shares the prototype's caches."""
+        return self.prototype.with_paths(entry.template, entry.output, entry.data[-1])
+
+    def skeleton_key(self, entry: ManifestEntry) -> Hashable:
+        """Entries with equal keys can share one inlined skeleton."""
+        return self.generator(entry).skeleton_key(self.data(entry))
+
+    def build(self, entry: ManifestEntry, shared: bool) -> EntryResult:
+        """Render, check and save one entry; a failure only fails the entry."""
+        started = time.perf_counter()
+        try:
+            entry.output.parent.mkdir(parents=True, exist_ok=True)
+            generator = self.generator(entry)
+            html_content = generator.bulk_renderer(self.data(entry), use_skeleton=shared)({})
+            generator.analyze_size(html_content)
+            generator.save_html(html_content)
+        except Exception as e:
+            logger.error(f"Manifest entry {entry.name} failed: {e}")
+            return EntryResult(entry.name, entry.output, time.perf_counter() - started,
+                               error=f"{type(e).__name__}: {e}")
+        return EntryResult(entry.name, entry.output, time.perf_counter() - started,
+                           payload_size(html_content), shared)
+
+    def build_group(self, group: List[IndexedEntry], shared: bool) -> List[Tuple[int, EntryResult]]:
+        """Build entries that share a skeleton key, one after another."""
+        return [(index, self.build(entry, shared)) for index, entry in group]
+
+
+def _init_worker(prototype: NewsletterGenerator, trace_memory: bool = False) -> None:
+    """Create the shared build state once per worker process."""
+    global _worker_state
+    # Forked workers inherit the parent's metrics; only report their own
+    metrics.reset()
+    if trace_memory:
+        metrics.enable_memory_tracing()
+    _worker_state = _BuildState(prototype)
+
+
+def _build_group(group: List[IndexedEntry], shared: bool) -> Tuple[List[Tuple[int, EntryResult]], MetricsSnapshot]:
+    """Build a group of entries in a worker and return the worker's metrics alongside."""
+    return _worker_state.build_group(group, shared), metrics.drain()
+
+
+class ManifestBuild:
+    """Build every entry of a manifest in one run.
+
+    Before anything is rendered the entries are grouped by skeleton key:
+    entries with the same template, logo, colors and section layout differ
+    only in text, so each group is CSS-inlined once and every further entry
+    in it is a string fill. Entries with a unique key go through the full
+    pipeline, which for a single render is cheaper than building a
+    skeleton. Groups are the unit of scheduling across worker processes,
+    largest first; with ``workers=1`` everything runs in-process. The
+    prototype generator supplies the options (minification, size budget,
+    image handling) and its caches are warmed by the grouping, so workers
+    start with templates compiled and logos encoded.
+    """
+
+    def __init__(self, entries: List[ManifestEntry], prototype: NewsletterGenerator, workers: int = 1):
+        self.entries = entries
+        self.prototype = prototype
+        self.workers = workers
+        self._state = _BuildState(prototype)
+
+    def plan(self) -> List[List[int]]:
+        """Entry indices grouped by skeleton key, largest groups first."""
+        groups: Dict[Hashable, List[int]] = {}
+        for index, entry in enumerate(self.entries):
+            try:
+                key = self._state.skeleton_key(entry)
+            except Exception:
+                # Reported when the entry itself is built
+                key = ('unplanned', index)
+            groups.setdefault(key, []).append(index)
+        return sorted(groups.values(), key=len, reverse=True)
+
+    @log_operation("Manifest build")
+    def run(self) -> List[EntryResult]:
+        """Build all entries and return their results in manifest order."""
+        started = time.perf_counter()
+        groups = self.plan()
+        shared = sum(len(group) for group in groups if len(group) > 1)
+        logger.info(f"Building {len(self.entries)} entries in {len(groups)} groups "
+                    f"({shared} entries share a skeleton)")
+
+        results: List[Optional[EntryResult]] = [None] * len(self.entries)
+        if self.workers <= 1:
+            for group in groups:
+                for index, result in self._state.build_group(self._indexed(group), len(group) > 1):
+                    results[index] = result
+        else:
+            self._run_workers(groups, results)
+
+        logger.info(f"Manifest summary:\n{self.summary(results, time.perf_counter() - started)}")
+        return results
+
+    def _indexed(self, group: List[int]) -> List[IndexedEntry]:
+        return [(index, self.entries[index]) for index in group]
+
+    def _run_workers(self, groups: List[List[int]], results: List[Optional[EntryResult]]) -> None:
+        """Hand groups to a process pool; a crashed worker fails the entries of its group."""
+        workers = min(self.workers, len(groups))
+        logger.info(f"Building with {workers} worker processes")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            initializer=_init_worker,
+            initargs=(self.prototype, metrics.trace_memory)
+        ) as executor:
+            futures: Dict[Future, List[int]] = {
+                executor.submit(_build_group, self._indexed(group), len(group) > 1): group
+                for group in groups
+            }
+            for future in as_completed(futures):
+                try:
+                    built, snapshot = future.result()
+                except Exception as e:
+                    logger.error(f"Worker building {len(futures[future])} entries failed: {e}")
+                    for index in futures[future]:
+                        entry = self.entries[index]
+                        results[index] = EntryResult(entry.name, entry.output, error=f"{type(e).__name__}: {e}")
+                    continue
+                metrics.merge(snapshot)
+                for index, result in built:
+                    results[index] = result
+
+    @staticmethod
+    def summary(results: List[EntryResult], wall_seconds: float) -> str:
+        """One line per entry, then the totals."""
+        width = max(len(result.name) for result in results)
+        lines = []
+        for result in results:
+            if result.ok:
+                mode = "shared skeleton" if result.shared else "full pipeline"
+                lines.append(f"{result.name:<{width}}  {result.seconds * 1000:8.1f} ms  "
+                             f"{result.output_bytes / 1024:8.1f} KiB  {mode} -> {result.output}")
+            else:
+                lines.append(f"{result.name:<{width}}  {result.seconds * 1000:8.1f} ms  FAILED: {result.error}")
+        failed = sum(not result.ok for result in results)
+        busy = sum(result.seconds for result in results)
+        lines.append(f"{len(results) - failed} built, {failed} failed in {wall_seconds * 1000:.0f} ms wall "
+                     f"({busy * 1000:.0f} ms of entry time)")
+        return "\n".join(lines)
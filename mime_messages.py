@@ -0,0 +1,306 @@
+import binascii
+import logging
+import re
+import time
+import uuid
+from email.header import Header
+from email.utils import formataddr, formatdate, getaddresses, make_msgid, parseaddr
+from functools import lru_cache
+from html.parser import HTMLParser
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from generate import (
+    MAIL_SETTINGS_KEY,
+    HTMLContent,
+    InlineImage,
+    NewsletterGenerator,
+    PlaceholderData,
+    merge_newsletter_data,
+)
+from instrumentation import metrics
+
+# Constants
+RECIPIENT_ADDRESS_KEY = 'email'
+RECIPIENT_NAME_KEY = 'name'
+BASE64_LINE_LENGTH = 76
+HEADER_LINE_LENGTH = 78
+BOUNDARY_FORMAT = '=_nl{kind}{token}'
+SKIPPED_TAGS = {'head', 'style', 'script', 'title'}
+VOID_TAGS = {'area', 'base', 'br', 'col', 'hr', 'img', 'input', 'link', 'meta', 'source', 'wbr'}
+BLOCK_TAGS = {
+    'p', 'div', 'table', 'tr', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'ul', 'ol', 'blockquote', 'header', 'footer', 'section',
+}
+WHITESPACE_PATTERN = re.compile(r'\s+')
+SPACES_PATTERN = re.compile(r' {2,}')
+BLANK_LINES_PATTERN = re.compile(r'\n{3,}')
+HIDDEN_STYLE_PATTERN = re.compile(r'display\s*:\s*none', re.IGNORECASE)
+# The template's own bullet glyph after the "* " that list items get
+BULLET_GLYPH_PATTERN = re.compile(r'^\* [•·▪] ?')
+
+logger = logging.getLogger(__name__)
+
+MessageChunks = List[bytes]
+
+
+class _TextExtractor(HTMLParser):
+    """Collect the visible text of an HTML document, one block per line.
+
+    Elements in SKIPPED_TAGS and elements inlined as ``display: none`` (like
+    the mobile header) are skipped with everything inside them.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts: List[str] = []
+        # Open elements inside a skipped element, counting the skipped one
+        self._skipped = 0
+        self._links: List[Tuple[str, int]] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag in VOID_TAGS and tag != 'br':
+            return
+        if self._skipped:
+            self._skipped += tag not in VOID_TAGS
+        elif tag in SKIPPED_TAGS or HIDDEN_STYLE_PATTERN.search(dict(attrs).get('style') or ''):
+            self._skipped = 1
+        elif tag == 'br':
+            self.parts.append('\n')
+        elif tag == 'li':
+            self.parts.append('\n* ')
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n\n')
+        elif tag == 'a':
+            self._links.append((dict(attrs).get('href') or '', len(self.parts)))
+
+    def handle_endtag(self, tag: str) -> None:
+        if tag in VOID_TAGS:
+            return
+        if self._skipped:
+            self._skipped -= 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append('\n\n')
+        elif tag == 'a' and self._links:
+            href, start = self._links.pop()
+            text = ''.join(self.parts[start:]).strip()
+            # Spell out the target unless the link text already shows it
+            if href.startswith(('http:', 'https:')) and text not in (href, href.split('//', 1)[-1]):
+                self.parts.append(f' ({href})')
+
+    def handle_data(self, data: str) -> None:
+        if not self._skipped:
+            self.parts.append(WHITESPACE_PATTERN.sub(' ', data))
+
+
+def html_to_text(html_content: HTMLContent) -> str:
+    """Derive the plain-text alternative of an HTML newsletter.
+
+    Styles and the head are dropped, blocks become paragraphs, list items
+    become ``*`` bullets and links keep their target in parentheses.
+    Outlook-only markup inside conditional comments is ignored.
+    """
+    extractor = _TextExtractor()
+    extractor.feed(html_content)
+    extractor.close()
+    lines = (
+        BULLET_GLYPH_PATTERN.sub('* ', SPACES_PATTERN.sub(' ', line).strip())
+        for line in ''.join(extractor.parts).split('\n')
+    )
+    return BLANK_LINES_PATTERN.sub('\n\n', '\n'.join(lines)).strip() + '\n'
+
+
+def _check_header_value(value: str, field: str) -> str:
+    """Reject line breaks, which would end the header and start new ones (e.g. ``Bcc:``)."""
+    if '\r' in value or '\n' in value:
+        raise ValueError(f"{field} contains a line break: {value!r}")
+    return value
+
+
+@lru_cache(maxsize=256)
+def _encode_header(value: str, linesep: str) -> str:
+    """RFC 2047-encode a header value if it is not plain ASCII, folding long values."""
+    _check_header_value(value, 'Header value')
+    if value.isascii() and len(value) < HEADER_LINE_LENGTH:
+        return value
+    return Header(value, 'utf-8', maxlinelen=HEADER_LINE_LENGTH).encode(linesep=linesep)
+
+
+@lru_cache(maxsize=256)
+def _encode_address(address: str, name: str = '') -> str:
+    """Format a mailbox, encoding a non-ASCII display name.
+
+    Raises ValueError for anything that does not parse as one mailbox, so
+    data from a recipient list can never add headers or recipients.
+    """
+    _check_header_value(address, 'Address')
+    _check_header_value(name, 'Display name')
+    parsed_name, parsed_address = parseaddr(address)
+    # With a separate name the address must be a bare addr-spec
+    if name and parsed_name:
+        parsed_address = ''
+    if (len(getaddresses([address])) != 1 or not parsed_address or parsed_address.count('@') != 1
+            or any(c.isspace() for c in parsed_address) or (name and parsed_address != address.strip())):
+        raise ValueError(f"Not a valid email address: {address!r}")
+    return formataddr((name or parsed_name, parsed_address), charset='utf-8')
+
+
+class MessageBuilder:
+    """Wrap rendered HTML into a ready-to-send RFC 5322 message.
+
+    Every message is ``multipart/alternative`` with a plain-text part derived
+    from the HTML. When inline images are given, the HTML part and the images
+    form a ``multipart/related`` part, and the HTML references the images by
+    ``cid:``. Everything that is the same for all recipients (boundaries,
+    part headers and the base64 image parts) is encoded once in the
+    constructor; per message only the headers and the two quoted-printable
+    bodies are produced. The ``Date`` header is the time the message is
+    built, formatted at most once per second. The image parts are the same bytes objects in every
+    message.
+
+    Headers come from the ``mail`` section of the newsletter data (``from``,
+    ``subject``, optional ``reply_to``) and can be overridden per recipient
+    with ``mail.*`` columns; the recipient is the record's ``email`` (and
+    optional ``name``) field.
+    """
+
+    def __init__(self, newsletter_data: PlaceholderData, inline_images: Iterable[InlineImage] = (),
+                 linesep: str = '\n'):
+        settings = newsletter_data.get(MAIL_SETTINGS_KEY) or {}
+        if not settings.get('from'):
+            raise ValueError(f"Set {MAIL_SETTINGS_KEY}.from in the newsletter data to build MIME messages")
+        # Fail before the first message if the shared headers are unusable
+        for key in ('from', 'reply_to'):
+            if settings.get(key):
+                _encode_address(settings[key])
+        self.linesep = linesep
+        self.inline_images = list(inline_images)
+        self.domain = parseaddr(settings['from'])[1].rpartition('@')[2] or 'localhost'
+        self._date: Tuple[int, str] = (-1, '')
+
+        token = uuid.uuid4().hex
+        self.boundary = BOUNDARY_FORMAT.format(kind='A', token=token)
+        self.related_boundary = BOUNDARY_FORMAT.format(kind='R', token=token)
+
+        self._text_headers = self._part_headers(
+            f'--{self.boundary}',
+            'Content-Type: text/plain; charset="utf-8"',
+            'Content-Transfer-Encoding: quoted-printable',
+        )
+        html_delimiter = self.related_boundary if self.inline_images else self.boundary
+        self._html_headers = self._part_headers(
+            *([f'--{self.boundary}',
+               f'Content-Type: multipart/related; type="text/html"; boundary="{self.related_boundary}"',
+               ''] if self.inline_images else []),
+            f'--{html_delimiter}',
+            'Content-Type: text/html; charset="utf-8"',
+            'Content-Transfer-Encoding: quoted-printable',
+        )
+        # Shared parts: encoded here once and reused by every message
+        self._image_parts = b''.join(self._image_part(image) for image in self.inline_images)
+        closing = [f'--{self.related_boundary}--'] if self.inline_images else []
+        self._closing = self._lines(*closing, f'--{self.boundary}--')
+
+    def _lines(self, *lines: str) -> bytes:
+        """Join header lines, each terminated by the line separator."""
+        return ''.join(line + self.linesep for line in lines).encode('ascii')
+
+    def _part_headers(self, *lines: str) -> bytes:
+        """A delimiter and part headers, followed by the blank line that starts the body."""
+        return self._lines(*lines, '')
+
+    def _image_part(self, image: InlineImage) -> bytes:
+        """One base64 image part of the ``multipart/related`` part."""
+        data = image.asset.data
+        body = self.linesep.join(
+            data[i:i + BASE64_LINE_LENGTH] for i in range(0, len(data), BASE64_LINE_LENGTH)
+        )
+        return self._part_headers(
+            f'--{self.related_boundary}',
+            f'Content-Type: {image.asset.mime}; name="{image.filename}"',
+            'Content-Transfer-Encoding: base64',
+            f'Content-ID: <{image.content_id}>',
+            f'Content-Disposition: inline; filename="{image.filename}"',
+        ) + body.encode('ascii') + self.linesep.encode('ascii')
+
+    def date(self) -> str:
+        """The current time for the ``Date`` header, reformatted only when the second changes."""
+        now = int(time.time())
+        if self._date[0] != now:
+            self._date = (now, formatdate(now, localtime=True))
+        return self._date[1]
+
+    def _quoted_printable(self, data: bytes) -> bytes:
+        """Quoted-printable body ending in a line break.
+
+        ``From`` at the start of a line is encoded as ``=46rom`` so the
+        message can go into an mbox file unchanged.
+        """
+        data = data.replace(b'\r\n', b'\n')
+        if self.linesep != '\n':
+            data = data.replace(b'\n', self.linesep.encode('ascii'))
+        encoded = binascii.b2a_qp(data, istext=True)
+        newline = self.linesep.encode('ascii')
+        encoded = encoded.replace(newline + b'From ', newline + b'=46rom ')
+        if encoded.startswith(b'From '):
+            encoded = b'=46' + encoded[1:]
+        return encoded if encoded.endswith(newline) else encoded + newline
+
+    def headers(self, data: PlaceholderData) -> bytes:
+        """The message headers for one recipient, ending with the blank line."""
+        settings = data.get(MAIL_SETTINGS_KEY) or {}
+        lines = [
+            f"From: {_encode_address(settings['from'])}",
+        ]
+        if data.get(RECIPIENT_ADDRESS_KEY):
+            lines.append(f"To: {_encode_address(data[RECIPIENT_ADDRESS_KEY], data.get(RECIPIENT_NAME_KEY) or '')}")
+        if settings.get('reply_to'):
+            lines.append(f"Reply-To: {_encode_address(settings['reply_to'])}")
+        subject = settings.get('subject') or data.get('newsletter_title') or ''
+        lines += [
+            f"Subject: {_encode_header(subject, self.linesep)}",
+            f"Date: {self.date()}",
+            f"Message-ID: {make_msgid(domain=self.domain)}",
+            'MIME-Version: 1.0',
+            f'Content-Type: multipart/alternative; boundary="{self.boundary}"',
+            '',
+        ]
+        return self._lines(*lines)
+
+    def build(self, html_chunks: List[bytes], data: PlaceholderData) -> MessageChunks:
+        """The complete message for one recipient, as chunks to write out in order."""
+        html_bytes = b''.join(html_chunks)
+        text = html_to_text(html_bytes.decode('utf-8'))
+        chunks = [
+            self.headers(data),
+            self._text_headers, self._quoted_printable(text.encode('utf-8')),
+            self._html_headers, self._quoted_printable(html_bytes),
+        ]
+        if self.inline_images:
+            chunks.append(self._image_parts)
+        chunks.append(self._closing)
+        return chunks
+
+
+def message_renderer(generator: NewsletterGenerator, newsletter_data: Optional[PlaceholderData] = None,
+                     linesep: str = '\n') -> Callable[[PlaceholderData], MessageChunks]:
+    """Like ``generator.chunk_renderer``, but each record comes back as a complete MIME message.
+
+    A generator with ``image_embedding='cid'`` produces ``multipart/related``
+    messages carrying the logo as an attachment instead of a data URI. The
+    function is picklable with ``functools.partial``, so the batch runner can
+    build it in each worker process.
+    """
+    if newsletter_data is None:
+        newsletter_data = generator.read_newsletter_data()
+    render_html = generator.chunk_renderer(newsletter_data)
+    builder = MessageBuilder(newsletter_data, generator.inline_images.values(), linesep)
+
+    def render(record: PlaceholderData) -> MessageChunks:
+        html_chunks = render_html(record)
+        with metrics.stage("Message encoding") as probe:
+            message = builder.build(html_chunks, merge_newsletter_data(newsletter_data, record))
+            probe.output_bytes = sum(map(len, message))
+        return message
+
+    return render
+
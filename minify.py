@@ -0,0 +1,263 @@
+import re
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+# Constants
+HTML_TOKEN_PATTERN = re.compile(
+    r'<!--.*?-->'
+    r'|<(?P<raw>pre|textarea|script)\b.*?</(?P=raw)\s*>'
+    r'|<style\b(?P<style_attrs>[^>]*)>(?P<css>.*?)</style\s*>'
+    r'|<[^>]+>',
+    re.DOTALL | re.IGNORECASE
+)
+CONDITIONAL_COMMENT_PREFIXES = ('<!--[if', '<!--<![endif]')
+HTML_WHITESPACE_PATTERN = re.compile(r'[ \t\n\r\f]+')
+QUOTED_PATTERN = re.compile(r'("[^"]*"|\'[^\']*\')')
+STYLE_ATTRIBUTE_PATTERN = re.compile(r'(\sstyle\s*=\s*)(["\'])(.*?)\2', re.DOTALL | re.IGNORECASE)
+CSS_COMMENT_PATTERN = re.compile(r'/\*.*?\*/', re.DOTALL)
+IMPORTANT_PATTERN = re.compile(r'\s*!\s*important\s*$', re.IGNORECASE)
+NESTED_AT_RULES = ('@media', '@supports', '@document')
+
+
+@dataclass(frozen=True)
+class MinifyStats:
+    """Size of the document before and after minification."""
+    original_bytes: int
+    minified_bytes: int
+
+    @property
+    def ratio(self) -> float:
+        """Minified size as a fraction of the original size."""
+        return self.minified_bytes / self.original_bytes if self.original_bytes else 1.0
+
+    @property
+    def saved_bytes(self) -> int:
+        """Bytes removed by minification."""
+        return self.original_bytes - self.minified_bytes
+
+
+@dataclass
+class CSSRule:
+    """A style rule, a nested at-rule when ``children`` is set, or an
+    at-statement such as ``@import`` when neither is set."""
+    prelude: str
+    declarations: Optional[str] = None
+    children: Optional[List['CSSRule']] = None
+
+
+def minify_html(html_content: str, prune_inlined: bool = False) -> Tuple[str, MinifyStats]:
+    """Shrink the HTML without changing how it renders.
+
+    - Whitespace runs in text and between attributes collapse to one space
+      (or one newline, keeping lines short enough for SMTP).
+    - ``<pre>``, ``<textarea>``, ``<script>`` and conditional comments
+      (``<!--[if ...]>``, ``<!--<![endif]-->``) are left untouched; other
+      comments are dropped.
+    - ``style`` attributes are normalized and duplicate declarations removed.
+    - ``<style>`` blocks lose comments and whitespace; with ``prune_inlined``
+      top-level rules that CSS inlining already applied are dropped, keeping
+      media queries, pseudo-class/element rules and ``*`` selectors, and
+      custom properties go once no ``var()`` is left in the document.
+    """
+    parts = []
+    position = 0
+    drop_custom_properties = prune_inlined and 'var(' not in html_content
+
+    for token in HTML_TOKEN_PATTERN.finditer(html_content):
+        parts.append(_collapse_whitespace(html_content[position:token.start()]))
+        text = token.group(0)
+        if text.startswith('<!--'):
+            if text.startswith(CONDITIONAL_COMMENT_PREFIXES):
+                parts.append(text)
+        elif token.group('raw'):
+            parts.append(text)
+        elif token.group('css') is not None:
+            css = minify_css(token.group('css'), prune_inlined, drop_custom_properties)
+            if css:
+                parts.append(_minify_tag(f"<style{token.group('style_attrs')}>") + css + "</style>")
+        else:
+            parts.append(_minify_tag(text))
+        position = token.end()
+
+    parts.append(_collapse_whitespace(html_content[position:]))
+    minified = "".join(parts)
+    return minified, MinifyStats(
+        original_bytes=len(html_content.encode('utf-8')),
+        minified_bytes=len(minified.encode('utf-8'))
+    )
+
+
+def _collapse_whitespace(text: str) -> str:
+    """Collapse each run of HTML whitespace, keeping a newline if the run had one."""
+    return HTML_WHITESPACE_PATTERN.sub(lambda m: '\n' if '\n' in m.group(0) else ' ', text)
+
+
+def _minify_tag(tag: str) -> str:
+    """Collapse whitespace between attributes and normalize the style attribute."""
+    pieces = QUOTED_PATTERN.split(tag)
+    for index in range(0, len(pieces), 2):
+        pieces[index] = re.sub(r'[ \t\n\r\f]+', ' ', pieces[index])
+    tag = "".join(pieces)
+    tag = re.sub(r'\s+(/?>)$', r'\1', tag)
+    return STYLE_ATTRIBUTE_PATTERN.sub(
+        lambda m: m.group(1) + m.group(2) + normalize_declarations(m.group(3)) + m.group(2),
+        tag
+    )
+
+
+def _split_top_level(text: str, separator: str) -> List[str]:
+    """Split on ``separator`` outside of quotes and parentheses."""
+    parts = []
+    depth = 0
+    quote = None
+    start = 0
+    for index, char in enumerate(text):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '(':
+            depth += 1
+        elif char == ')':
+            depth = max(depth - 1, 0)
+        elif char == separator and depth == 0:
+            parts.append(text[start:index])
+            start = index + 1
+    parts.append(text[start:])
+    return parts
+
+
+def normalize_declarations(declarations: str) -> str:
+    """Normalize a declaration list and drop declarations that cannot take effect.
+
+    Repeating a property with a different value is kept: clients that do not
+    understand the later value fall back to the earlier one, as in
+    ``width:600px;width:100%``. An exact repeat replaces the earlier
+    declaration, and a declaration after an ``!important`` one of the same
+    property is dropped unless it is ``!important`` too, as in the cascade.
+    """
+    kept: List[Tuple[str, str, bool]] = []
+
+    for declaration in _split_top_level(declarations, ';'):
+        name, colon, value = declaration.partition(':')
+        name = name.strip().lower() if not name.strip().startswith('--') else name.strip()
+        value = _collapse_css_whitespace(value.strip())
+        if not colon or not name or not value:
+            continue
+        important = bool(IMPORTANT_PATTERN.search(value))
+        if important:
+            value = IMPORTANT_PATTERN.sub('', value) + ' !important'
+
+        if not important and any(entry[0] == name and entry[2] for entry in kept):
+            continue
+        if (name, value, important) in kept:
+            kept.remove((name, value, important))
+        kept.append((name, value, important))
+
+    return ";".join(f"{name}:{value}" for name, value, _ in kept)
+
+
+def _collapse_css_whitespace(text: str) -> str:
+    """Collapse whitespace outside of quoted strings."""
+    pieces = QUOTED_PATTERN.split(text)
+    for index in range(0, len(pieces), 2):
+        pieces[index] = re.sub(r'\s+', ' ', pieces[index])
+    return "".join(pieces)
+
+
+def parse_css(css: str) -> List[CSSRule]:
+    """Parse a stylesheet into rules and nested at-rules (comments removed)."""
+    rules, _ = _parse_block(CSS_COMMENT_PATTERN.sub('', css), 0)
+    return rules
+
+
+def _parse_block(css: str, position: int) -> Tuple[List[CSSRule], int]:
+    """Parse rules until the closing brace of the current block or the end."""
+    rules = []
+    while position < len(css):
+        next_open = css.find('{', position)
+        next_close = css.find('}', position)
+        next_semicolon = css.find(';', position)
+
+        if next_close != -1 and (next_open == -1 or next_close < next_open):
+            return rules, next_close + 1
+        if next_open == -1:
+            break
+
+        if next_semicolon != -1 and next_semicolon < next_open:
+            # At-statement such as @import or @charset
+            statement = css[position:next_semicolon].strip()
+            if statement:
+                rules.append(CSSRule(prelude=statement))
+            position = next_semicolon + 1
+            continue
+
+        prelude = _collapse_css_whitespace(css[position:next_open].strip())
+        if prelude.lower().startswith(NESTED_AT_RULES):
+            children, position = _parse_block(css, next_open + 1)
+            rules.append(CSSRule(prelude=prelude, children=children))
+        else:
+            end = _find_block_end(css, next_open)
+            rules.append(CSSRule(prelude=prelude, declarations=css[next_open + 1:end]))
+            position = end + 1
+    return rules, len(css)
+
+
+def _find_block_end(css: str, open_index: int) -> int:
+    """Index of the brace closing the declaration block opened at ``open_index``."""
+    quote = None
+    for index in range(open_index + 1, len(css)):
+        char = css[index]
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in '"\'':
+            quote = char
+        elif char == '}':
+            return index
+    return len(css)
+
+
+def is_inlinable_selector(selector: str) -> bool:
+    """Whether CSS inlining applies this selector to the matching elements."""
+    return ':' not in selector and '*' not in selector and not selector.startswith('@')
+
+
+def minify_css(css: str, prune_inlined: bool = False, drop_custom_properties: bool = False) -> str:
+    """Minify a stylesheet, optionally dropping rules inlining already applied.
+
+    ``drop_custom_properties`` removes ``--name`` declarations, which are dead
+    once every ``var()`` in the document has been resolved.
+    """
+    return _serialize_rules(parse_css(css), prune_inlined, drop_custom_properties, top_level=True)
+
+
+def _serialize_rules(rules: List[CSSRule], prune_inlined: bool, drop_custom_properties: bool,
+                     top_level: bool) -> str:
+    """Serialize rules compactly, skipping pruned and empty ones."""
+    output = []
+    for rule in rules:
+        selectors = [re.sub(r'\s+', ' ', s.strip()) for s in _split_top_level(rule.prelude, ',')]
+        prelude = ",".join(selectors)
+
+        if rule.children is not None:
+            body = _serialize_rules(rule.children, prune_inlined, drop_custom_properties, top_level=False)
+            if body:
+                output.append(f"{prelude}{{{body}}}")
+            continue
+        if rule.declarations is None:
+            output.append(f"{rule.prelude};")
+            continue
+
+        declarations = normalize_declarations(rule.declarations)
+        if drop_custom_properties:
+            declarations = ";".join(
+                d for d in _split_top_level(declarations, ';') if d and not d.startswith('--')
+            )
+        if not declarations:
+            continue
+        if prune_inlined and top_level and all(map(is_inlinable_selector, selectors)):
+            continue
+        output.append(f"{prelude}{{{declarations}}}")
+    return "".join(output)
@@ -0,0 +1,311 @@
+import json
+import logging
+import os
+import signal
+import socketserver
+import stat
+import threading
+import time
+from collections import deque
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import AbstractSet, Any, Callable, Deque, Dict, FrozenSet, List, Optional, Tuple, Union
+
+from generate import (
+    DEFAULT_SERVER_ADDRESS,
+    MAIL_SETTINGS_KEY,
+    SKELETON_CACHE_SIZE,
+    TEMPLATE_CACHE_SIZE,
+    CompiledTemplate,
+    NewsletterGenerator,
+    PlaceholderData,
+)
+from instrumentation import metrics
+from streaming import chunks_size, write_chunks
+from watch import FileSignature, file_signature
+
+# Constants
+UNIX_ADDRESS_PREFIX = 'unix:'
+LATENCY_WINDOW = 4096
+LATENCY_PERCENTILES = (50, 90, 99)
+MAX_REQUEST_BYTES = 1024 * 1024
+RENDER_PATH = '/render'
+METRICS_PATH = '/metrics'
+HEALTH_PATH = '/health'
+# Data keys a render request may never set, whatever the template uses:
+# file paths, the logo, the colors and the mail settings come from the
+# server's own data file
+PROTECTED_DATA_KEYS = frozenset({'colors', 'logo_path', 'logo_width', 'logo_height', MAIL_SETTINGS_KEY})
+# Hit/miss counter prefixes of the generator's caches, by the name reported
+CACHE_COUNTERS = {'template_cache': 'templates', 'skeleton_cache': 'skeletons', 'asset_cache': 'assets'}
+
+logger = logging.getLogger(__name__)
+
+ServerAddress = Union[Tuple[str, int], str]
+
+
+class OverlayError(ValueError):
+    """A render request's data overlay is not a JSON object or sets keys it may not set."""
+
+
+def overlay_keys(compiled: CompiledTemplate) -> FrozenSet[str]:
+    """Top-level data keys the template uses, except ``PROTECTED_DATA_KEYS``."""
+    return frozenset(key.split('.')[0] for key in compiled.placeholders) - PROTECTED_DATA_KEYS
+
+
+def check_overlay(overlay: Any, allowed: AbstractSet[str]) -> PlaceholderData:
+    """Return the overlay if it is a JSON object setting only ``allowed`` keys, raise OverlayError otherwise."""
+    if not isinstance(overlay, dict):
+        raise OverlayError("The request body must be a JSON object")
+    rejected = sorted(str(key) for key in overlay if key not in allowed)
+    if rejected:
+        raise OverlayError(f"Render requests may not set {', '.join(rejected)}")
+    return overlay
+
+
+def parse_content_length(value: str) -> int:
+    """The body length from a Content-Length header, raise ValueError unless it is a plain non-negative integer."""
+    value = value.strip()
+    # int() would also take signs, underscores and non-ASCII digits
+    if not (value.isascii() and value.isdigit()):
+        raise ValueError(f"Invalid Content-Length {value!r}")
+    return int(value)
+
+
+class LatencyRecorder:
+    """Render latencies of the most recent requests, for percentiles."""
+
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._samples: Deque[float] = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.errors = 0
+
+    def record(self, seconds: float, failed: bool = False) -> None:
+        with self._lock:
+            self._samples.append(seconds)
+            self.count += 1
+            self.errors += failed
+
+    def summary(self) -> Dict[str, Any]:
+        """Request counts and latency percentiles in milliseconds over the window."""
+        with self._lock:
+            samples = sorted(self._samples)
+            summary: Dict[str, Any] = {'requests': self.count, 'errors': self.errors, 'window': len(samples)}
+        if samples:
+            for percentile in LATENCY_PERCENTILES:
+                index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+                summary[f'p{percentile}_ms'] = round(samples[index] * 1000, 3)
+            summary['max_ms'] = round(samples[-1] * 1000, 3)
+        return summary
+
+
+class RenderService:
+    """A resident generator that renders the newsletter for JSON data overlays.
+
+    The template is compiled and the logo encoded once into a renderer for
+    the data file; requests only fill it in, so a request that changes text
+    is a skeleton fill. The renderer is rebuilt when the template, the data
+    file or the logo changes on disk. Overlays may only set the top-level
+    keys the template uses, less ``PROTECTED_DATA_KEYS``. Rendering holds a lock: the caches are not
+    thread-safe and the work is CPU-bound under the GIL anyway, while
+    reading requests and writing responses runs concurrently in the
+    server's threads.
+    """
+
+    def __init__(self, generator: NewsletterGenerator):
+        self.generator = generator
+        self.latency = LatencyRecorder()
+        self._lock = threading.Lock()
+        self._renderer: Optional[Callable[[PlaceholderData], List[bytes]]] = None
+        self._signatures: List[FileSignature] = []
+        self._logo_path: Optional[Path] = None
+        self.overlay_keys = overlay_keys(CompiledTemplate.compile(generator.read_html_template()))
+
+    def _input_signatures(self) -> List[FileSignature]:
+        """Signatures of the template, the data file and the logo it names."""
+        files = [self.generator.paths.template, self.generator.paths.data]
+        if self._logo_path is not None:
+            files.append(self._logo_path)
+        return [file_signature(path) for path in files]
+
+    def _current_renderer(self) -> Callable[[PlaceholderData], List[bytes]]:
+        """The renderer for the data file, rebuilt only if an input changed."""
+        signatures = self._input_signatures()
+        if self._renderer is None or signatures != self._signatures:
+            newsletter_data = self.generator.read_newsletter_data()
+            logo_path = newsletter_data.get('logo_path')
+            self._logo_path = Path(logo_path) if logo_path else None
+            self._renderer = self.generator.chunk_renderer(newsletter_data)
+            self.overlay_keys = overlay_keys(CompiledTemplate.compile(self.generator.read_html_template()))
+            self._signatures = self._input_signatures()
+            logger.info(f"Loaded {self.generator.paths.template} and {self.generator.paths.data}")
+        return self._renderer
+
+    def render(self, overlay: PlaceholderData) -> List[bytes]:
+        """The newsletter with ``overlay`` merged over the data file, as UTF-8 chunks.
+
+        Skeleton fills share the skeleton's encoded literal chunks, which are
+        written to the socket as they are instead of being joined first.
+        Raises OverlayError if the overlay sets keys it may not set.
+        """
+        with self._lock:
+            renderer = self._current_renderer()
+            return renderer(check_overlay(overlay, self.overlay_keys))
+
+    def warm_up(self) -> None:
+        """Compile the template, encode the logo and build the skeleton before the first request."""
+        started = time.perf_counter()
+        self.render({})
+        logger.info(f"Warmed up in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+    def stats(self) -> Dict[str, Any]:
+        """Latency percentiles, cache sizes and hit ratios."""
+        asset_cache = self.generator.asset_cache
+        with self._lock:
+            cache_hit_ratios = metrics.cache_hit_ratios()
+            cache_sizes = self.generator.cache_sizes()
+            caches = {
+                'templates': {'entries': cache_sizes['templates'], 'capacity': TEMPLATE_CACHE_SIZE},
+                'skeletons': {'entries': cache_sizes['skeletons'], 'capacity': SKELETON_CACHE_SIZE},
+                'assets': {'entries': len(asset_cache), 'bytes': asset_cache.size,
+                           'capacity_bytes': asset_cache.max_bytes},
+            }
+        for cache, ratio in cache_hit_ratios.items():
+            caches.setdefault(CACHE_COUNTERS.get(cache, cache), {})['hit_ratio'] = round(ratio, 4)
+        return {'latency': self.latency.summary(), 'caches': caches}
+
+
+class RenderRequestHandler(BaseHTTPRequestHandler):
+    """``POST /render`` with a JSON object returns the HTML; ``GET /metrics`` and ``GET /health``."""
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'NewsletterRenderServer'
+
+    @property
+    def service(self) -> RenderService:
+        return self.server.service
+
+    def do_GET(self) -> None:
+        if self.path == METRICS_PATH:
+            self._send(HTTPStatus.OK, json.dumps(self.service.stats(), indent=2), 'application/json')
+        elif self.path == HEALTH_PATH:
+            self._send(HTTPStatus.OK, 'ok\n', 'text/plain')
+        else:
+            self._send_error(HTTPStatus.NOT_FOUND, f"No such path {self.path}")
+
+    def do_POST(self) -> None:
+        if self.path != RENDER_PATH:
+            self._send_error(HTTPStatus.NOT_FOUND, f"No such path {self.path}")
+            return
+        length_header = self.headers.get('Content-Length')
+        if length_header is None:
+            self.close_connection = True
+            self._send_error(HTTPStatus.LENGTH_REQUIRED, "Render requests need a Content-Length header")
+            return
+        try:
+            length = parse_content_length(length_header)
+        except ValueError as e:
+            # The body cannot be delimited, so the connection cannot be reused
+            self.close_connection = True
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        if length > MAX_REQUEST_BYTES:
+            self.close_connection = True
+            self._send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"Request body over {MAX_REQUEST_BYTES} bytes")
+            return
+        try:
+            overlay = json.loads(self.rfile.read(length) or b'{}')
+        except json.JSONDecodeError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, f"Invalid JSON: {e}")
+            return
+
+        started = time.perf_counter()
+        try:
+            chunks = self.service.render(overlay)
+        except OverlayError as e:
+            self._send_error(HTTPStatus.BAD_REQUEST, str(e))
+            return
+        except Exception as e:
+            self.service.latency.record(time.perf_counter() - started, failed=True)
+            logger.error(f"Render failed: {e}")
+            self._send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f"{type(e).__name__}: {e}")
+            return
+        self.service.latency.record(time.perf_counter() - started)
+        self._send_chunks(HTTPStatus.OK, chunks, 'text/html')
+
+    def _send(self, status: HTTPStatus, body: str, content_type: str) -> None:
+        self._send_chunks(status, [body.encode('utf-8')], content_type)
+
+    def _send_chunks(self, status: HTTPStatus, chunks: List[bytes], content_type: str) -> None:
+        self.send_response(status)
+        self.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        self.send_header('Content-Length', str(chunks_size(chunks)))
+        self.end_headers()
+        write_chunks(self.wfile, chunks)
+
+    def _send_error(self, status: HTTPStatus, message: str) -> None:
+        self._send(status, json.dumps({'error': message}), 'application/json')
+
+    def log_message(self, format: str, *args: Any) -> None:
+        # Unix socket clients have no address, so log without address_string()
+        logger.debug(f"{self.command} {self.path}: {format % args}")
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP over a Unix socket, one thread per connection."""
+    daemon_threads = True
+
+
+def parse_address(address: str) -> ServerAddress:
+    """``host:port``, ``:port`` or ``unix:/path/to/socket``."""
+    if address.startswith(UNIX_ADDRESS_PREFIX):
+        return address[len(UNIX_ADDRESS_PREFIX):]
+    host, _, port = address.rpartition(':')
+    if not port.isdigit():
+        raise ValueError(f"Server address {address!r} is neither host:port nor unix:PATH")
+    return host or '127.0.0.1', int(port)
+
+
+def create_server(service: RenderService, address: ServerAddress) -> socketserver.BaseServer:
+    """Bind a threading HTTP server for ``service`` to a TCP address or a Unix socket path."""
+    if isinstance(address, str):
+        # A socket file left behind by an earlier server would make bind fail;
+        # anything else at that path is not ours to remove
+        try:
+            mode = os.lstat(address).st_mode
+        except FileNotFoundError:
+            pass
+        else:
+            if not stat.S_ISSOCK(mode):
+                raise ValueError(f"{address} exists and is not a socket; not replacing it")
+            os.unlink(address)
+        server = ThreadingUnixHTTPServer(address, RenderRequestHandler)
+    else:
+        server = ThreadingHTTPServer(address, RenderRequestHandler)
+    server.service = service
+    return server
+
+
+def _interrupt(signum: int, frame: Any) -> None:
+    raise KeyboardInterrupt
+
+
+def serve(generator: NewsletterGenerator, address: str = DEFAULT_SERVER_ADDRESS) -> None:
+    """Warm up and serve render requests until interrupted or terminated."""
+    service = RenderService(generator)
+    service.warm_up()
+    bound = parse_address(address)
+    server = create_server(service, bound)
+    shown = f"{UNIX_ADDRESS_PREFIX}{bound}" if isinstance(bound, str) else "%s:%d" % server.server_address[:2]
+    logger.info(f"Render server listening on {shown} "
+                f"(POST {RENDER_PATH}, GET {METRICS_PATH}, GET {HEALTH_PATH})")
+    # Shut down cleanly (and remove the socket file) on SIGTERM as well
+    signal.signal(signal.SIGTERM, _interrupt)
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if isinstance(bound, str):
+            Path(bound).unlink(missing_ok=True)
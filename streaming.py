@@ -0,0 +1,123 @@
+import gzip
+import io
+import os
+from pathlib import Path
+from typing import BinaryIO, Iterable, List, Optional, Union
+
+# Constants
+DEFAULT_GZIP_LEVEL = 6
+GZIP_SUFFIX = ".gz"
+
+Chunk = Union[bytes, str]
+
+
+def _as_bytes(chunk: Chunk) -> bytes:
+    """Encode text chunks as UTF-8."""
+    return chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+class AtomicStreamWriter:
+    """Write a file chunk by chunk into a temporary file that replaces ``path`` on success.
+
+    Use as a context manager. If the block raises, the temporary file is
+    removed and ``path`` is left as it was. With ``compress`` the chunks are
+    gzipped on the fly (with a zero timestamp, so equal input gives equal
+    files). The temporary file lives next to ``path`` unless ``temp_dir``
+    (on the same file system) is given.
+    """
+
+    def __init__(self, path: Union[str, Path], compress: bool = False,
+                 compresslevel: int = DEFAULT_GZIP_LEVEL, temp_dir: Optional[Union[str, Path]] = None):
+        self.path = Path(path)
+        self.compress = compress
+        self.compresslevel = compresslevel
+        temp_name = f".{self.path.name}.{os.getpid()}.tmp"
+        self.temp_path = Path(temp_dir) / temp_name if temp_dir else self.path.with_name(temp_name)
+        self.bytes_written = 0
+        self._file: Optional[BinaryIO] = None
+        self._stream: Optional[BinaryIO] = None
+
+    def __enter__(self) -> 'AtomicStreamWriter':
+        self._file = open(self.temp_path, "wb")
+        if self.compress:
+            self._stream = gzip.GzipFile(
+                filename=self.path.name.removesuffix(GZIP_SUFFIX), mode="wb",
+                fileobj=self._file, compresslevel=self.compresslevel, mtime=0
+            )
+        else:
+            self._stream = self._file
+        return self
+
+    def write(self, chunk: Chunk) -> None:
+        """Write one chunk; ``bytes_written`` counts uncompressed bytes."""
+        data = _as_bytes(chunk)
+        self._stream.write(data)
+        self.bytes_written += len(data)
+
+    def writelines(self, chunks: Iterable[Chunk]) -> None:
+        """Write chunks in order."""
+        for chunk in chunks:
+            self.write(chunk)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        try:
+            if self._stream is not self._file:
+                self._stream.close()
+            self._file.close()
+        finally:
+            if exc_type is None:
+                os.replace(self.temp_path, self.path)
+            else:
+                self.temp_path.unlink(missing_ok=True)
+
+
+class ChunkReader(io.RawIOBase):
+    """A read-only file object over a list of chunks, for APIs that pull data (tarfile)."""
+
+    def __init__(self, chunks: Iterable[Chunk]):
+        self._chunks = iter(chunks)
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        # Fill the whole buffer: tarfile treats a short read as truncated data
+        filled = 0
+        while filled < len(buffer):
+            if not self._pending:
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._pending = memoryview(_as_bytes(chunk))
+                continue
+            count = min(len(buffer) - filled, len(self._pending))
+            buffer[filled:filled + count] = self._pending[:count]
+            self._pending = self._pending[count:]
+            filled += count
+        return filled
+
+
+def gzip_chunks(chunks: Iterable[Chunk], compresslevel: int = DEFAULT_GZIP_LEVEL) -> bytes:
+    """Compress chunks into one gzip member without joining them first."""
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=compresslevel, mtime=0) as stream:
+        for chunk in chunks:
+            stream.write(_as_bytes(chunk))
+    return buffer.getvalue()
+
+
+def write_chunks(target, chunks: Iterable[Chunk]) -> int:
+    """Send chunks to a socket (``sendall``) or binary file object (``write``); return the byte count."""
+    send = target.sendall if hasattr(target, "sendall") else target.write
+    total = 0
+    for chunk in chunks:
+        data = _as_bytes(chunk)
+        send(data)
+        total += len(data)
+    return total
+
+
+def chunks_size(chunks: List[Chunk]) -> int:
+    """Total encoded size of a list of chunks."""
+    return sum(len(_as_bytes(chunk)) for chunk in chunks)
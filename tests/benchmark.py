@@ -0,0 +1,373 @@
+import argparse
+import logging
+import platform
+import random
+import shutil
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+
+import yaml
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from generate import NewsletterGenerator  # noqa: E402
+from instrumentation import metrics  # noqa: E402
+
+# ANSI color codes
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+BLUE = "\033[94m"
+BOLD = "\033[1m"
+RESET = "\033[0m"
+
+BENCHMARKS_DIR = Path(__file__).parent / "benchmarks"
+BASE_PARAMETERS = {'sections': 3, 'variables': 0, 'recipients': 200, 'logo_kb': 20}
+SCENARIOS = {
+    'base': {},
+    'many-sections': {'sections': 40},
+    'large-theme': {'variables': 100},
+    'large-logo': {'logo_kb': 200},
+    'many-recipients': {'recipients': 2000},
+}
+FULL_PIPELINE_SAMPLE = 20
+DEFAULT_REPEAT = 3
+DEFAULT_THRESHOLD = 0.3
+# Timings that moved by less than this are noise, whatever the ratio
+MIN_SIGNIFICANT_MS = 2.0
+
+
+def get_commit_hash(ref='HEAD'):
+    return subprocess.check_output(['git', 'rev-parse', ref], cwd=REPO_ROOT).decode('utf-8').strip()
+
+
+def has_uncommitted_changes():
+    status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT)
+    return bool(status.strip())
+
+
+def print_section_header(title):
+    """Print a formatted section header"""
+    width = shutil.get_terminal_size().columns
+    print(f"\n{BLUE}{BOLD}{'=' * width}{RESET}")
+    print(f"{BLUE}{BOLD}{title.center(width)}{RESET}")
+    print(f"{BLUE}{BOLD}{'=' * width}{RESET}\n")
+
+
+def synthetic_png(kilobytes, seed=0):
+    """A valid PNG of roughly the given size; noise keeps it from compressing."""
+    rng = random.Random(seed)
+    width = 256
+    height = max(1, kilobytes * 1024 // (width * 3 + 1))
+    raw = b''.join(b'\x00' + rng.randbytes(width * 3) for _ in range(height))
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw, 1))
+            + chunk(b'IEND', b''))
+
+
+def synthetic_template(variables):
+    """The shipped template with ``variables`` extra CSS variables, each used by a rule and an element."""
+    html = (REPO_ROOT / "newsletter_template.html").read_text(encoding='utf-8')
+    if not variables:
+        return html
+    declarations = "".join(f"\n            --bench-{i}: #{i * 2654435761 % 0xffffff:06x};" for i in range(variables))
+    rules = "".join(f"\n        .bench-{i} {{ color: var(--bench-{i}); }}" for i in range(variables))
+    elements = "".join(f'\n<p class="bench-{i}">Theme sample {i}</p>' for i in range(variables))
+    html = html.replace(":root {", ":root {" + declarations, 1)
+    html = html.replace("</style>", rules + "\n    </style>", 1)
+    return html.replace("</body>", elements + "\n</body>", 1)
+
+
+def synthetic_data(sections, logo_path):
+    """The shipped data with ``sections`` generated news sections."""
+    with open(REPO_ROOT / "newsletter_data.yaml", 'r', encoding='utf-8') as f:
+        data = yaml.safe_load(f)
+    data['logo_path'] = str(logo_path)
+    data['sections'] = [
+        {
+            'title': f"Section {i}",
+            'text': f"Lorem ipsum dolor sit amet, section {i} consectetur adipiscing elit.",
+            'bullets': [f"Point {j} of section {i}, sed do eiusmod tempor." for j in range(i % 4)],
+        }
+        for i in range(sections)
+    ]
+    return data
+
+
+def write_inputs(directory, parameters):
+    """Write the template, data and logo for one scenario; return the file paths."""
+    logo_path = directory / "logo.png"
+    logo_path.write_bytes(synthetic_png(parameters['logo_kb']))
+    template_path = directory / "template.html"
+    template_path.write_text(synthetic_template(parameters['variables']), encoding='utf-8')
+    data_path = directory / "data.yaml"
+    with open(data_path, 'w', encoding='utf-8') as f:
+        yaml.safe_dump(synthetic_data(parameters['sections'], logo_path), f, allow_unicode=True)
+    return template_path, data_path
+
+
+def make_generator(directory, template_path, data_path):
+    return NewsletterGenerator(
+        template_path=str(template_path),
+        output_path=str(directory / "output.html"),
+        data_path=str(data_path),
+        size_budget=None
+    )
+
+
+def run_scenario(parameters, repeat):
+    """Time every generator stage and the bulk rendering throughput for one scenario."""
+    with tempfile.TemporaryDirectory(prefix="newsletter-bench-") as tmp:
+        directory = Path(tmp)
+        template_path, data_path = write_inputs(directory, parameters)
+
+        # Warm up imports and premailer once so they do not count against the first repeat
+        make_generator(directory, template_path, data_path).generate()
+
+        stage_runs = {}
+        generate_runs = []
+        for _ in range(repeat):
+            metrics.reset()
+            make_generator(directory, template_path, data_path).generate()
+            for name, stats in metrics.stages.items():
+                stage_runs.setdefault(name, []).append(stats.wall_seconds * 1000)
+            generate_runs.append(metrics.stages["Newsletter generation"].wall_seconds * 1000)
+
+        generator = make_generator(directory, template_path, data_path)
+        newsletter_data = generator.read_newsletter_data()
+        records = [{'greeting_text': f"Dear subscriber {i},"} for i in range(parameters['recipients'])]
+
+        started = time.perf_counter()
+        render = generator.bulk_renderer(newsletter_data)
+        for record in records:
+            render(record)
+        throughput = len(records) / (time.perf_counter() - started)
+
+        sample = records[:FULL_PIPELINE_SAMPLE]
+        started = time.perf_counter()
+        render = generator.bulk_renderer(newsletter_data, use_skeleton=False)
+        for record in sample:
+            render(record)
+        full_throughput = len(sample) / (time.perf_counter() - started)
+
+    return {
+        'parameters': parameters,
+        'generate_ms': round(statistics.median(generate_runs), 2),
+        'stages_ms': {
+            name: round(statistics.median(runs), 2)
+            for name, runs in sorted(stage_runs.items()) if name != "Newsletter generation"
+        },
+        'throughput_msgs_per_s': round(throughput, 1),
+        'full_pipeline_msgs_per_s': round(full_throughput, 1),
+    }
+
+
+def time_command(arguments, repeat, cwd=REPO_ROOT):
+    """Median wall time of a fresh Python process running ``arguments``, in ms."""
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *arguments], cwd=cwd, check=True, capture_output=True)
+        runs.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(runs), 2)
+
+
+def measure_cold_start(repeat):
+    """Median time for a fresh interpreter to import the generator, in ms."""
+    return time_command(["-c", "import generate"], repeat)
+
+
+def measure_startup(repeat):
+    """Cold command line runs on the base scenario: the full pipeline and a precompiled run, in ms.
+
+    The precompiled run reuses an artifact written by an earlier run with
+    different text, the way a scheduler invoking the generator per issue does.
+    """
+    with tempfile.TemporaryDirectory(prefix="newsletter-bench-") as tmp:
+        directory = Path(tmp)
+        template_path, data_path = write_inputs(directory, BASE_PARAMETERS)
+        command = [str(REPO_ROOT / "generate.py"), "--template", str(template_path), "--data", str(data_path),
+                   "--output", str(directory / "output.html"), "--size-budget", "0"]
+        precompiled = ["--precompiled", str(directory / "newsletter.precompiled")]
+        full_ms = time_command(command, repeat, cwd=directory)
+
+        data = yaml.safe_load(data_path.read_text(encoding='utf-8'))
+        data['newsletter_title'] = "Precompiled build"
+        subprocess.run([sys.executable, *command, *precompiled], cwd=directory, check=True, capture_output=True)
+        data_path.write_text(yaml.safe_dump(data, allow_unicode=True), encoding='utf-8')
+        return full_ms, time_command(command + precompiled, repeat, cwd=directory)
+
+
+def run_benchmarks(scenario_names, repeat, recipients):
+    results = {
+        'commit': get_commit_hash(),
+        'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cold_start_ms': measure_cold_start(repeat),
+        'scenarios': {},
+    }
+    results['cold_run_ms'], results['precompiled_run_ms'] = measure_startup(repeat)
+    for name in scenario_names:
+        parameters = {**BASE_PARAMETERS, **SCENARIOS[name]}
+        if recipients:
+            parameters['recipients'] = recipients
+        print(f"{BOLD}{name}{RESET} ({', '.join(f'{k}={v}' for k, v in parameters.items())})")
+        scenario = run_scenario(parameters, repeat)
+        results['scenarios'][name] = scenario
+        print(f"  generate: {scenario['generate_ms']:.1f} ms, "
+              f"bulk: {scenario['throughput_msgs_per_s']:.1f} msgs/s, "
+              f"full pipeline: {scenario['full_pipeline_msgs_per_s']:.1f} msgs/s")
+        for stage, ms in scenario['stages_ms'].items():
+            print(f"    {stage}: {ms:.1f} ms")
+    print(f"{BOLD}cold start{RESET}: {results['cold_start_ms']:.1f} ms import, "
+          f"{results['cold_run_ms']:.1f} ms full run, {results['precompiled_run_ms']:.1f} ms precompiled run")
+    return results
+
+
+def find_baseline(commit=None):
+    """The baseline for ``commit``, or for the nearest ancestor of HEAD that has one."""
+    if commit:
+        path = BENCHMARKS_DIR / f"{get_commit_hash(commit)}.bench"
+        return path if path.exists() else None
+    head = get_commit_hash()
+    ancestors = subprocess.check_output(['git', 'rev-list', 'HEAD'], cwd=REPO_ROOT).decode('utf-8').split()
+    for ancestor in ancestors:
+        path = BENCHMARKS_DIR / f"{ancestor}.bench"
+        if ancestor != head and path.exists():
+            return path
+    return None
+
+
+def comparison_rows(baseline, current):
+    """(label, baseline value, current value, higher is better) for every shared measurement."""
+    rows = [
+        ("cold start ms", baseline.get('cold_start_ms'), current.get('cold_start_ms'), False),
+        ("cold run ms", baseline.get('cold_run_ms'), current.get('cold_run_ms'), False),
+        ("precompiled run ms", baseline.get('precompiled_run_ms'), current.get('precompiled_run_ms'), False),
+    ]
+    for name, scenario in current['scenarios'].items():
+        previous = baseline.get('scenarios', {}).get(name)
+        if not previous:
+            continue
+        rows.append((f"{name} generate ms", previous['generate_ms'], scenario['generate_ms'], False))
+        rows.append((f"{name} bulk msgs/s", previous['throughput_msgs_per_s'],
+                     scenario['throughput_msgs_per_s'], True))
+        rows.append((f"{name} full msgs/s", previous['full_pipeline_msgs_per_s'],
+                     scenario['full_pipeline_msgs_per_s'], True))
+        for stage, ms in scenario['stages_ms'].items():
+            if stage in previous['stages_ms']:
+                rows.append((f"{name} {stage} ms", previous['stages_ms'][stage], ms, False))
+    return [row for row in rows if row[1] and row[2] is not None]
+
+
+def compare(baseline_path, current, threshold):
+    """Print current results against a baseline; return the number of regressions."""
+    with open(baseline_path, 'r') as file:
+        baseline = yaml.safe_load(file)
+
+    print(f"{BOLD}Baseline:{RESET} {baseline['commit']} ({baseline.get('created', 'unknown date')})")
+    print(f"{BOLD}Current:{RESET}  {current['commit']}")
+    if baseline.get('platform') != current.get('platform') or baseline.get('python') != current.get('python'):
+        print(f"{YELLOW}Warning: baseline was recorded on {baseline.get('platform')} / Python "
+              f"{baseline.get('python')}; numbers may not be comparable.{RESET}")
+
+    regressions = 0
+    width = max((len(row[0]) for row in comparison_rows(baseline, current)), default=0)
+    for label, before, after, higher_is_better in comparison_rows(baseline, current):
+        ratio = after / before
+        slowdown = 1 / ratio if higher_is_better else ratio
+        if not higher_is_better and abs(after - before) < MIN_SIGNIFICANT_MS:
+            color, mark = "", ""
+        elif slowdown > 1 + threshold:
+            color, mark = RED, "REGRESSION"
+            regressions += 1
+        elif slowdown < 1 / (1 + threshold):
+            color, mark = GREEN, "improved"
+        else:
+            color, mark = "", ""
+        print(f"  {label:<{width}}  {before:>10.1f} -> {after:>10.1f}  ({ratio:5.2f}x) {color}{mark}{RESET}")
+
+    if regressions:
+        print(f"\n{RED}{BOLD}{regressions} measurements regressed by more than {threshold:.0%}{RESET}")
+    else:
+        print(f"\n{GREEN}No regressions beyond {threshold:.0%}{RESET}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the newsletter generation pipeline.")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="Scenario to run (repeatable; default: all)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT,
+                        help=f"Runs per measurement, the median is kept (default: {DEFAULT_REPEAT})")
+    parser.add_argument("--recipients", type=int,
+                        help="Override the number of recipients rendered per scenario")
+    parser.add_argument("--save", action="store_true",
+                        help="Store the results as the baseline for the current commit")
+    parser.add_argument("--force", action="store_true", help="Overwrite an existing baseline")
+    parser.add_argument("--compare", nargs="?", const="", metavar="COMMIT",
+                        help="Compare against the baseline of COMMIT (default: nearest ancestor with one)")
+    parser.add_argument("--startup-budget", type=float, metavar="MS",
+                        help="Fail if a cold precompiled command line run takes longer than MS")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Relative slowdown reported as a regression (default: {DEFAULT_THRESHOLD})")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print_section_header("Newsletter Benchmarks")
+    if has_uncommitted_changes():
+        print(f"{YELLOW}Warning: There are uncommitted changes; results are recorded for "
+              f"{get_commit_hash()} anyway.{RESET}")
+
+    results = run_benchmarks(args.scenario or list(SCENARIOS), args.repeat, args.recipients)
+    exit_code = 0
+    if args.startup_budget and results['precompiled_run_ms'] > args.startup_budget:
+        print(f"{RED}{BOLD}Precompiled run took {results['precompiled_run_ms']:.1f} ms, over the startup "
+              f"budget of {args.startup_budget:.0f} ms{RESET}")
+        exit_code = 1
+
+    if args.compare is not None:
+        print_section_header("Comparison")
+        baseline_path = find_baseline(args.compare or None)
+        if baseline_path is None:
+            print(f"{YELLOW}No baseline found in {BENCHMARKS_DIR}{RESET}")
+        elif compare(baseline_path, results, args.threshold):
+            exit_code = 1
+
+    if args.save:
+        report_path = BENCHMARKS_DIR / f"{results['commit']}.bench"
+        if report_path.exists() and not args.force:
+            print(f"\n{YELLOW}Baseline for {results['commit']} already exists; use --force to overwrite.{RESET}")
+        else:
+            BENCHMARKS_DIR.mkdir(parents=True, exist_ok=True)
+            with open(report_path, 'w') as file:
+                yaml.dump(results, file, sort_keys=False)
+            print(f"\n{GREEN}Baseline saved to {report_path}{RESET}")
+
+    return exit_code
+
+
+if __name__ == "__main__":
+    try:
+        exit(main())
+    except KeyboardInterrupt:
+        print(f"\n\n{YELLOW}Benchmark interrupted by user.{RESET}")
+        exit(0)
@@ -0,0 +1,370 @@
+import argparse
+import logging
+import os
+import re
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import yaml
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from generate import NEWSLETTER_DATA, NEWSLETTER_TEMPLATE, NewsletterGenerator, PlaceholderData  # noqa: E402
+from tests.update_readme import STRUCTURE_REPORT_SUFFIX  # noqa: E402
+
+# ANSI color codes
+GREEN = "\033[92m"
+RED = "\033[91m"
+YELLOW = "\033[93m"
+BLUE = "\033[94m"
+BOLD = "\033[1m"
+RESET = "\033[0m"
+
+TESTS_DIR = Path(__file__).parent
+REPORTS_DIR = TESTS_DIR / "reports"
+STRUCTURE_TESTCASE = "Structure"
+
+CSS_VARIABLE_PATTERN = re.compile(r'var\(\s*--')
+CONDITIONAL_PATTERN = re.compile(r'<!--\[if ([^\]]*)\]>(<!-->)?|(<!--)?<!\[endif\]-->')
+DESKTOP_HEADER_MARKER = 'class="desktop-header"'
+MOBILE_HEADER_MARKER = 'class="mobile-header"'
+BODY_MARKER = 'id="emailBody"'
+LOGO_IMG_PATTERN = re.compile(r'<div class="logo-container"[^>]*>\s*<img\b[^>]*?\bsrc="([^"]*)"', re.DOTALL)
+LIST_ITEM_PATTERN = re.compile(r'<li\b')
+BULLET_PATTERN = re.compile(r'<span class="bullet"')
+MSO_BULLET_PATTERN = re.compile(r'<!--\[if mso\]><span class="bullet-spacer">')
+LINE_PATTERN = re.compile(r'<span class="h2-line"([^>]*)>')
+INLINE_COLOR_PATTERN = re.compile(r'style="[^"]*(?:background-color|border[\w-]*)\s*:[^";]*[#\w]')
+TABLE_OPEN_PATTERN = re.compile(r'<table\b')
+TABLE_CLOSE_PATTERN = re.compile(r'</table>')
+
+# Set by _init_worker in every worker process
+_document: Optional['Document'] = None
+
+
+@dataclass(frozen=True)
+class ClientProfile:
+    """What a client is known to do with the message (see client_profiles.yaml)."""
+    name: str
+    clip_bytes: Optional[int] = None
+    mso: bool = False
+    style_block: bool = True
+
+
+@dataclass(frozen=True)
+class Document:
+    """The generated HTML and the data it was rendered from."""
+    html: str
+    data: PlaceholderData
+
+    def header(self, variant: str) -> str:
+        """The desktop or mobile header table."""
+        desktop = self.html.find(DESKTOP_HEADER_MARKER)
+        mobile = self.html.find(MOBILE_HEADER_MARKER)
+        if variant == 'desktop':
+            return self.html[desktop:mobile] if 0 <= desktop < mobile else ''
+        end = self.html.find(BODY_MARKER, mobile)
+        return self.html[mobile:end] if 0 <= mobile < end else ''
+
+
+# A check returns None when it passes and the reason otherwise
+CheckFunction = Callable[[Document, ClientProfile], Optional[str]]
+
+
+@dataclass(frozen=True)
+class Check:
+    """One automated question of a test case, asked only of the clients it applies to."""
+    testcase: str
+    question: str
+    run: CheckFunction
+    applies: Callable[[ClientProfile], bool] = lambda profile: True
+
+
+def check_css_variables(document: Document, profile: ClientProfile) -> Optional[str]:
+    count = len(CSS_VARIABLE_PATTERN.findall(document.html))
+    return f"{count} var(--...) references left" if count else None
+
+
+def check_size(document: Document, profile: ClientProfile) -> Optional[str]:
+    size = len(document.html.encode('utf-8'))
+    return f"{size} bytes, clipped above {profile.clip_bytes}" if size > profile.clip_bytes else None
+
+
+def check_conditionals(document: Document, profile: ClientProfile) -> Optional[str]:
+    """Conditional comments pair up (they cannot nest) and close the way they were opened."""
+    open_match = None
+    for match in CONDITIONAL_PATTERN.finditer(document.html):
+        if match.group(1) is not None:
+            if open_match is not None:
+                return f"[if {open_match.group(1)}] at offset {open_match.start()} is never closed"
+            open_match = match
+            continue
+        if open_match is None:
+            return f"[endif] at offset {match.start()} closes nothing"
+        if bool(open_match.group(2)) != bool(match.group(3)):
+            return f"[if {open_match.group(1)}] at offset {open_match.start()} is closed as the other kind"
+        open_match = None
+    if open_match is not None:
+        return f"[if {open_match.group(1)}] at offset {open_match.start()} is never closed"
+    return None
+
+
+def check_mso_tables(document: Document, profile: ClientProfile) -> Optional[str]:
+    """The tables Outlook builds from MSO-only markup open and close in equal numbers."""
+    mso_markup = "".join(
+        document.html[match.end():document.html.find('<![endif]-->', match.end())]
+        for match in CONDITIONAL_PATTERN.finditer(document.html)
+        if match.group(1) is not None and match.group(1).strip().startswith(('mso', 'gte mso'))
+    )
+    opened = len(TABLE_OPEN_PATTERN.findall(mso_markup))
+    closed = len(TABLE_CLOSE_PATTERN.findall(mso_markup))
+    return f"{opened} tables opened, {closed} closed" if opened != closed else None
+
+
+def check_logo(document: Document, profile: ClientProfile) -> Optional[str]:
+    missing = []
+    for variant in ('desktop', 'mobile'):
+        sources = LOGO_IMG_PATTERN.findall(document.header(variant))
+        if not sources or not all(source.strip() for source in sources):
+            missing.append(variant)
+    return f"no logo src in the {' and '.join(missing)} header" if missing else None
+
+
+def check_mso_logo(document: Document, profile: ClientProfile) -> Optional[str]:
+    header = document.header('desktop')
+    logo = header.find('class="logo-container"')
+    return None if 0 <= header.find('<!--[if mso]>') < logo else "the desktop logo has no MSO table wrapper"
+
+
+def check_title(document: Document, profile: ClientProfile) -> Optional[str]:
+    missing = []
+    for key in ('newsletter_title', 'newsletter_subtitle'):
+        value = str(document.data.get(key, ''))
+        for variant in ('desktop', 'mobile'):
+            if not value or value not in document.header(variant):
+                missing.append(f"{key} ({variant})")
+    return f"missing {', '.join(missing)}" if missing else None
+
+
+def _bullet_count(document: Document) -> int:
+    return sum(len(section.get('bullets') or []) for section in document.data.get('sections') or [])
+
+
+def check_bullets(document: Document, profile: ClientProfile) -> Optional[str]:
+    expected = _bullet_count(document)
+    items = len(LIST_ITEM_PATTERN.findall(document.html))
+    bullets = len(BULLET_PATTERN.findall(document.html))
+    if items != expected or bullets != expected:
+        return f"{items} list items and {bullets} bullet marks for {expected} bullets"
+    return None
+
+
+def check_mso_bullets(document: Document, profile: ClientProfile) -> Optional[str]:
+    expected = _bullet_count(document)
+    found = len(MSO_BULLET_PATTERN.findall(document.html))
+    return f"{found} MSO bullet marks for {expected} bullets" if found != expected else None
+
+
+def check_lines(document: Document, profile: ClientProfile) -> Optional[str]:
+    expected = len(document.data.get('sections') or [])
+    lines = LINE_PATTERN.findall(document.html)
+    if len(lines) != expected:
+        return f"{len(lines)} headline lines for {expected} headlines"
+    if not profile.style_block:
+        unstyled = sum(not INLINE_COLOR_PATTERN.search(attributes) for attributes in lines)
+        if unstyled:
+            return f"{unstyled} headline lines have no inline color"
+    return None
+
+
+def check_signature_dash(document: Document, profile: ClientProfile) -> Optional[str]:
+    signature = str(document.data.get('signature', ''))
+    return None if f"—</span>{signature}" in document.html else "no dash before the signature"
+
+
+CHECKS = [
+    Check(STRUCTURE_TESTCASE, "No CSS variables are left.", check_css_variables),
+    Check(STRUCTURE_TESTCASE, "The message is smaller than the clipping limit.", check_size,
+          lambda profile: profile.clip_bytes is not None),
+    Check(STRUCTURE_TESTCASE, "Conditional comments are intact.", check_conditionals),
+    Check(STRUCTURE_TESTCASE, "MSO-only tables are complete.", check_mso_tables, lambda profile: profile.mso),
+    Check("Logo", "The logo src is set in both header variants.", check_logo),
+    Check("Logo", "The desktop logo has its MSO table wrapper.", check_mso_logo, lambda profile: profile.mso),
+    Check("Title and subtitle", "Title and subtitle appear in both header variants.", check_title),
+    Check("Bulletpoints", "Every bullet is a list item with a bullet mark.", check_bullets),
+    Check("Bulletpoints", "Every bullet has an MSO bullet mark.", check_mso_bullets, lambda profile: profile.mso),
+    Check("Red lines", "Every headline has a line under it.", check_lines),
+    Check("Red lines", "The signature has a dash before it.", check_signature_dash),
+]
+
+
+def load_profiles(clients: List[str], profiles_path: Path) -> List[ClientProfile]:
+    """A profile for every client, with the defaults for clients not described."""
+    with open(profiles_path, 'r') as file:
+        profiles = yaml.safe_load(file) or {}
+    defaults = profiles.get('defaults') or {}
+    described = profiles.get('clients') or {}
+    return [ClientProfile(name=client, **{**defaults, **(described.get(client) or {})}) for client in clients]
+
+
+def check_client(profile: ClientProfile, document: Optional[Document] = None) -> Tuple[str, Dict, List[str]]:
+    """Run every applicable check for one client.
+
+    Returns the client name, its results in report format and the reasons
+    for every failed question.
+    """
+    document = document or _document
+    results: Dict[str, Dict] = {}
+    reasons = []
+    for check in CHECKS:
+        if not check.applies(profile):
+            continue
+        result = results.setdefault(check.testcase, {'passed': True, 'failed_questions': []})
+        reason = check.run(document, profile)
+        if reason is not None:
+            result['passed'] = False
+            result['failed_questions'].append(check.question)
+            reasons.append(f"{check.testcase}: {check.question} ({reason})")
+    return profile.name, results, reasons
+
+
+def _init_worker(document: Document) -> None:
+    """Hand the document to a worker once instead of with every client."""
+    global _document
+    _document = document
+
+
+def run_checks(profiles: List[ClientProfile], document: Document,
+               workers: int) -> Dict[str, Tuple[Dict, List[str]]]:
+    """Check every client, across a process pool when ``workers`` is above 1."""
+    if workers <= 1:
+        checked = [check_client(profile, document) for profile in profiles]
+    else:
+        with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(document,)) as executor:
+            checked = list(executor.map(check_client, profiles))
+    return {name: (results, reasons) for name, results, reasons in checked}
+
+
+def render_document(html_path: Optional[Path]) -> Document:
+    """Generate the newsletter the way generate.py does, or read an already generated file."""
+    generator = NewsletterGenerator(template_path=str(REPO_ROOT / NEWSLETTER_TEMPLATE),
+                                    data_path=str(REPO_ROOT / NEWSLETTER_DATA))
+    data = generator.read_newsletter_data()
+    if html_path is not None:
+        return Document(html_path.read_text(encoding='utf-8'), data)
+    return Document(generator.bulk_renderer(data, use_skeleton=False)({}), data)
+
+
+def git_output(*arguments: str) -> str:
+    return subprocess.check_output(['git', *arguments], cwd=REPO_ROOT).decode('utf-8').strip()
+
+
+def structure_report_path(commit_hash: str) -> Path:
+    return REPORTS_DIR / f"{commit_hash}{STRUCTURE_REPORT_SUFFIX}"
+
+
+def previous_report() -> Optional[Path]:
+    """The structure report of the nearest ancestor commit (HEAD included) that has one."""
+    for commit_hash in git_output('rev-list', 'HEAD').split():
+        path = structure_report_path(commit_hash)
+        if path.exists():
+            return path
+    return None
+
+
+def changes(previous: Dict, current: Dict) -> List[str]:
+    """Describe every test case whose outcome differs from the previous report."""
+    lines = []
+    previous_clients = previous.get('clients') or {}
+    for client, results in current['clients'].items():
+        if client not in previous_clients:
+            lines.append(f"{client}: not in the previous report")
+            continue
+        for testcase, result in results.items():
+            before = previous_clients[client].get(testcase)
+            if before is None:
+                lines.append(f"{client} / {testcase}: new test case, {'passes' if result['passed'] else 'fails'}")
+            elif before['passed'] and not result['passed']:
+                lines.append(f"{RED}{client} / {testcase}: now fails: "
+                             f"{'; '.join(result['failed_questions'])}{RESET}")
+            elif not before['passed'] and result['passed']:
+                lines.append(f"{GREEN}{client} / {testcase}: now passes{RESET}")
+            elif set(before['failed_questions']) != set(result['failed_questions']):
+                lines.append(f"{YELLOW}{client} / {testcase}: fails differently: "
+                             f"{'; '.join(result['failed_questions'])}{RESET}")
+    return lines
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Automated, offline structural checks alongside run_tests.py: checks the generated "
+                    "newsletter against the known constraints of every client in clients.yaml, writes "
+                    "tests/reports/<commit>.structure.report (never the manual report or the README) and "
+                    "lists only what changed since the report of the nearest ancestor commit."
+    )
+    parser.add_argument("--html", type=Path, help="Check this generated file instead of rendering the newsletter")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Worker processes checking clients in parallel (default: one per CPU)")
+    parser.add_argument("--profiles", type=Path, default=TESTS_DIR / "client_profiles.yaml",
+                        help="Client constraints (default: tests/client_profiles.yaml)")
+    parser.add_argument("--dry-run", action="store_true", help="Print the results without writing a report")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+    # logo_path and the other data paths are relative to the repository
+    os.chdir(REPO_ROOT)
+    started = time.perf_counter()
+
+    commit_hash = git_output('rev-parse', 'HEAD')
+    if git_output('status', '--porcelain'):
+        print(f"{YELLOW}Uncommitted changes: the report describes the working tree, not {commit_hash}{RESET}")
+
+    with open(TESTS_DIR / "clients.yaml", 'r') as file:
+        clients = yaml.safe_load(file)['clients']
+    profiles = load_profiles(clients, args.profiles)
+    document = render_document(args.html)
+    checked = run_checks(profiles, document, min(args.workers, len(profiles)))
+
+    report = {'commit': commit_hash, 'clients': {name: results for name, (results, _) in checked.items()}}
+    failed = {name: reasons for name, (_, reasons) in checked.items() if reasons}
+    elapsed = time.perf_counter() - started
+
+    print(f"{BOLD}Checked {len(profiles)} clients, {len(CHECKS)} checks, in {elapsed:.2f} s{RESET}")
+    for name, reasons in failed.items():
+        for reason in reasons:
+            print(f"  {RED}✗ {name}: {reason}{RESET}")
+    print(f"  Passing clients: {GREEN}{len(profiles) - len(failed)}/{len(profiles)}{RESET}")
+
+    report_path = structure_report_path(commit_hash)
+    if report_path.exists() and not args.dry_run:
+        print(f"{RED}{report_path} already exists; not overwriting it (use --dry-run to compare){RESET}")
+        exit(1)
+    previous_path = previous_report()
+    if previous_path is not None:
+        with open(previous_path, 'r') as file:
+            changed = changes(yaml.safe_load(file) or {}, report)
+        print(f"\n{BOLD}Changes since {previous_path.name[:-len(STRUCTURE_REPORT_SUFFIX)]} (for review):{RESET}")
+        for line in changed or ["none"]:
+            print(f"  {line}")
+
+    if args.dry_run:
+        exit(1 if failed else 0)
+
+    os.makedirs(report_path.parent, exist_ok=True)
+    with open(report_path, 'w') as file:
+        yaml.dump(report, file)
+    print(f"\n{GREEN}Structure report saved to {report_path}{RESET}")
+    exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
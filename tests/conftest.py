@@ -0,0 +1,34 @@
+"""Shared fixtures: the shipped template and data, rendered from a temporary directory.
+
+Run the tests with ``python -m pytest -q`` from the repository root.
+"""
+from pathlib import Path
+
+import pytest
+import yaml
+
+from generate import NewsletterGenerator, load_yaml_file
+
+# Constants
+REPO_DIR = Path(__file__).resolve().parent.parent
+TEMPLATE = REPO_DIR / 'newsletter_template.html'
+DATA = REPO_DIR / 'newsletter_data.yaml'
+
+
+@pytest.fixture
+def data():
+    """The shipped newsletter data without the logo, which is not in the repository."""
+    newsletter_data = load_yaml_file(DATA)
+    newsletter_data.pop('logo_path', None)
+    return newsletter_data
+
+
+@pytest.fixture
+def generator(tmp_path, data):
+    """A generator for the shipped template, with the data written to a temporary directory."""
+    data_path = tmp_path / 'newsletter_data.yaml'
+    data_path.write_text(yaml.safe_dump(data, allow_unicode=True), encoding='utf-8')
+    return NewsletterGenerator(
+        template_path=str(TEMPLATE), output_path=str(tmp_path / 'out.html'),
+        data_path=str(data_path), size_budget=None
+    )
@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import csv
+import email
+import logging
+import sys
+import tempfile
+import threading
+import time
+from email import policy
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_ROOT))
+
+from delivery import BulkDelivery, DomainRateLimiter, SMTPSettings  # noqa: E402
+from generate import NEWSLETTER_DATA, NEWSLETTER_TEMPLATE, NewsletterGenerator  # noqa: E402
+
+# ANSI color codes
+GREEN = "\033[92m"
+RED = "\033[91m"
+BOLD = "\033[1m"
+RESET = "\033[0m"
+
+StoredMessage = Tuple[str, List[str], bytes]
+
+
+class StubSMTPServer:
+    """Accept every message (EHLO with PIPELINING, no TLS or auth) and keep it in memory."""
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, defer_every: int = 0, latency: float = 0.0):
+        self.host = host
+        self.port = port
+        self.defer_every = defer_every
+        self.latency = latency
+        self.messages: List[StoredMessage] = []
+        self.connections = 0
+        self._rcpt_count = 0
+        self._server: Optional[asyncio.AbstractServer] = None
+
+    async def start(self) -> int:
+        """Start listening and return the port."""
+        self._server = await asyncio.start_server(self._session, self.host, self.port, limit=2 ** 24)
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def stop(self) -> None:
+        self._server.close()
+        await self._server.wait_closed()
+
+    async def _session(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        self.connections += 1
+
+        def reply(line: str) -> None:
+            writer.write(line.encode() + b"\r\n")
+
+        reply("220 stub ESMTP")
+        sender, recipients = "", []
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            command = line.decode("utf-8", "replace").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                reply("250-stub" if verb == "EHLO" else "250 stub")
+                if verb == "EHLO":
+                    reply("250-PIPELINING")
+                    reply("250 8BITMIME")
+            elif verb == "MAIL":
+                sender, recipients = command.partition(":")[2].strip("<> "), []
+                reply("250 OK")
+            elif verb == "RCPT":
+                self._rcpt_count += 1
+                if self.defer_every and self._rcpt_count % self.defer_every == 0:
+                    reply("451 Try again later")
+                else:
+                    recipients.append(command.partition(":")[2].strip("<> "))
+                    reply("250 OK")
+            elif verb == "DATA":
+                if not recipients:
+                    reply("554 No valid recipients")
+                    continue
+                reply("354 End data with <CR><LF>.<CR><LF>")
+                await writer.drain()
+                try:
+                    data = await reader.readuntil(b"\r\n.\r\n")
+                except asyncio.IncompleteReadError:
+                    break
+                if self.latency:
+                    await asyncio.sleep(self.latency)
+                message = (b"\r\n" + data[:-3]).replace(b"\r\n..", b"\r\n.")[2:]
+                self.messages.append((sender, recipients, message))
+                reply("250 Queued")
+            elif verb == "RSET":
+                sender, recipients = "", []
+                reply("250 OK")
+            elif verb == "NOOP":
+                reply("250 OK")
+            elif verb == "QUIT":
+                reply("221 Bye")
+                await writer.drain()
+                break
+            else:
+                reply("502 Command not implemented")
+            await writer.drain()
+        writer.close()
+
+
+def write_recipients(path: Path, count: int) -> None:
+    with open(path, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["email", "name", "greeting_text"])
+        for index in range(count):
+            writer.writerow([f"reader{index}@example.{'org' if index % 2 else 'com'}", f"Reader {index}",
+                             f"Dear reader {index},"])
+
+
+def check(count: int, connections: int, workers: int, defer_every: int, rate: Optional[float]) -> bool:
+    """Deliver ``count`` messages to an in-process stub and verify what arrived."""
+    server = StubSMTPServer(defer_every=defer_every)
+    loop = asyncio.new_event_loop()
+    port = loop.run_until_complete(server.start())
+    # Serve from a background thread; the delivery engine runs its own event loop
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+
+    with tempfile.TemporaryDirectory() as directory:
+        recipients_path = Path(directory) / "subscribers.csv"
+        write_recipients(recipients_path, count)
+        generator = NewsletterGenerator(template_path=str(REPO_ROOT / NEWSLETTER_TEMPLATE),
+                                        data_path=str(REPO_ROOT / NEWSLETTER_DATA))
+        started = time.perf_counter()
+        report = BulkDelivery(
+            generator, recipients_path, SMTPSettings(host="127.0.0.1", port=port, local_hostname="check"),
+            connections=connections, workers=workers, backoff=0.05,
+            rate_limiter=DomainRateLimiter(default_rate=rate)
+        ).run(resume=False)
+        elapsed = time.perf_counter() - started
+
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+
+    received = [recipient for _, recipients, _ in server.messages for recipient in recipients]
+    expected = {f"reader{index}@example.{'org' if index % 2 else 'com'}" for index in range(count)}
+    parsed = email.message_from_bytes(server.messages[0][2], policy=policy.SMTP) if server.messages else None
+    ok = (len(received) == count and set(received) == expected and report.failed == 0
+          and parsed is not None and parsed.get_body(("plain",)) is not None)
+
+    print(f"{BOLD}Delivered {len(received)}/{count} messages over {server.connections} connections "
+          f"in {elapsed:.2f} s: {len(received) / elapsed:.1f} msgs/s end to end "
+          f"({report.messages_per_second:.1f} msgs/s delivery), {report.retries} retries{RESET}")
+    print(f"{GREEN}OK{RESET}" if ok else f"{RED}FAILED{RESET}")
+    return ok
+
+
+async def serve(host: str, port: int, defer_every: int, latency: float) -> None:
+    server = StubSMTPServer(host, port, defer_every, latency)
+    await server.start()
+    print(f"Stub SMTP server listening on {host}:{server.port}")
+    last = 0
+    while True:
+        await asyncio.sleep(1)
+        if len(server.messages) != last:
+            print(f"{len(server.messages)} messages ({len(server.messages) - last} msgs/s)")
+            last = len(server.messages)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Local stand-in SMTP server for delivery tests. Serves until interrupted, or with "
+                    "--check delivers a synthetic subscriber list to an in-process stub, verifies that "
+                    "every recipient got exactly one message and reports the throughput."
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8025)
+    parser.add_argument("--defer-every", type=int, default=0,
+                        help="Answer every Nth RCPT with a temporary 451 error")
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds to wait before accepting DATA")
+    parser.add_argument("--check", type=int, metavar="COUNT",
+                        help="Deliver COUNT messages to an in-process stub and verify them")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--rate", type=float, help="Per-domain rate limit in messages/s for --check")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s: %(message)s")
+    if args.check:
+        exit(0 if check(args.check, args.connections, args.workers, args.defer_every, args.rate) else 1)
+    try:
+        asyncio.run(serve(args.host, args.port, args.defer_every, args.latency))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""Cached builds must write the same file as an uncached run."""
+from build_cache import BuildCache
+from generate import NewsletterGenerator
+
+
+def test_build_cache_matches_generate(tmp_path, generator):
+    generator.generate()
+    expected = generator.paths.output.read_bytes()
+
+    cache = BuildCache(tmp_path / 'cache')
+    for run in range(2):
+        cached = NewsletterGenerator(
+            template_path=str(generator.paths.template), output_path=str(tmp_path / f'cached{run}.html'),
+            data_path=str(generator.paths.data), size_budget=None, build_cache=cache
+        )
+        cached.generate()
+        assert cached.paths.output.read_bytes() == expected
+    assert cache.hits
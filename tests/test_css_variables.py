@@ -0,0 +1,31 @@
+"""The single-pass CSS variable resolver against the per-variable replacement it replaced."""
+import re
+
+from generate import CSSVariableResolver
+
+
+def per_variable_sub(html_content):
+    """The original CSS variable replacement: one re.sub per variable."""
+    variables = {
+        match.group(1): match.group(2).strip()
+        for match in re.finditer(r'--([a-zA-Z0-9_-]+)\s*:\s*([^;}]+)', html_content)
+    }
+    for name, value in variables.items():
+        html_content = re.sub(f'var\\(--{name}\\)', value, html_content)
+    return html_content
+
+
+def test_var_resolver_matches_per_variable_sub(generator, data):
+    html_content = generator.replace_placeholders(generator.read_html_template(), data)
+    assert CSSVariableResolver(html_content).resolve() == per_variable_sub(html_content)
+
+
+def test_var_resolver_keeps_scoped_variables_in_their_rules():
+    css = (
+        "<style>:root { --a: red; } .card { --a: green; --b: blue; }"
+        " .card { color: var(--a); border-color: var(--b); }"
+        " .other { color: var(--a); border-color: var(--b); }</style>"
+    )
+    resolved = CSSVariableResolver(css).resolve()
+    assert ".card { color: green; border-color: blue; }" in resolved
+    assert ".other { color: red; border-color: var(--b); }" in resolved
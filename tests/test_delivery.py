@@ -0,0 +1,42 @@
+"""Delivery against the in-process stub SMTP server (no TLS, no AUTH)."""
+import asyncio
+import threading
+
+import pytest
+
+from delivery import BulkDelivery, SMTPSettings, SMTPSetupError
+from tests.smtp_stub import StubSMTPServer, write_recipients
+
+
+@pytest.fixture
+def stub():
+    """A stub SMTP server served from a background thread."""
+    server = StubSMTPServer()
+    loop = asyncio.new_event_loop()
+    loop.run_until_complete(server.start())
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    yield server
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+
+
+def deliver(stub, tmp_path, generator, count=3, **options):
+    recipients_path = tmp_path / 'subscribers.csv'
+    write_recipients(recipients_path, count)
+    settings = SMTPSettings(host='127.0.0.1', port=stub.port, local_hostname='test', **options)
+    return BulkDelivery(generator, recipients_path, settings, connections=2, backoff=0.01).run(resume=False)
+
+
+def test_delivers_every_message(stub, tmp_path, generator):
+    report = deliver(stub, tmp_path, generator)
+    assert report.sent == 3 and report.failed == 0
+    assert len(stub.messages) == 3
+
+
+@pytest.mark.parametrize('options', [{'starttls': True}, {'username': 'newsletter', 'password': 'secret'}])
+def test_refused_session_setup_stops_the_run(stub, tmp_path, generator, options):
+    with pytest.raises(SMTPSetupError):
+        deliver(stub, tmp_path, generator, **options)
+    assert stub.messages == []
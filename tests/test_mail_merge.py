@@ -0,0 +1,48 @@
+"""The mail merge's failures file across restarted and resumed runs."""
+import json
+
+from mail_merge import DirectorySink, MailMerge
+
+# Constants
+ROWS = [{'greeting_text': 'Hi'}, {'fail': True}, {'greeting_text': 'Hello'}, {'fail': True}]
+
+
+def failing_renderer(generator, newsletter_data):
+    """Render rows normally unless they ask to fail."""
+    render = generator.chunk_renderer(newsletter_data)
+
+    def render_or_fail(record):
+        if record.get('fail'):
+            raise ValueError("bad row")
+        return render(record)
+
+    return render_or_fail
+
+
+def merge(generator, tmp_path, resume):
+    recipients_path = tmp_path / 'subscribers.jsonl'
+    recipients_path.write_text(''.join(json.dumps(row) + '\n' for row in ROWS), encoding='utf-8')
+    sink = DirectorySink(tmp_path / 'out')
+    MailMerge(generator, recipients_path, sink, chunk_size=1, renderer_factory=failing_renderer).run(resume=resume)
+    return sink
+
+
+def failed_rows(sink):
+    return [json.loads(line)['index'] for line in sink.failures_path.read_text(encoding='utf-8').splitlines()]
+
+
+def test_restart_lists_every_failure_once(generator, tmp_path):
+    merge(generator, tmp_path, resume=False)
+    sink = merge(generator, tmp_path, resume=False)
+    assert failed_rows(sink) == [1, 3]
+
+
+def test_resume_lists_every_failure_once(generator, tmp_path):
+    sink = merge(generator, tmp_path, resume=False)
+    # As if the first run was killed after checkpointing two rows
+    checkpoint = json.loads(sink.state_path.read_text(encoding='utf-8'))
+    sink.state_path.write_text(json.dumps({**checkpoint, 'completed': 2, 'done': False}), encoding='utf-8')
+    with open(sink.failures_path, 'a', encoding='utf-8') as f:
+        f.write('{"index": 3, "err')
+    merge(generator, tmp_path, resume=True)
+    assert failed_rows(sink) == [1, 3]
@@ -0,0 +1,25 @@
+"""Headers of the MIME messages built for each recipient."""
+import time
+
+import pytest
+
+from mime_messages import MessageBuilder
+
+# Constants
+SETTINGS = {'mail': {'from': 'Newsletter <news@example.com>', 'subject': 'Issue 1'}}
+
+
+def test_date_is_stamped_per_message(monkeypatch):
+    builder = MessageBuilder(SETTINGS)
+    monkeypatch.setattr(time, 'time', lambda: 1_700_000_000.5)
+    first = builder.headers({**SETTINGS, 'email': 'a@example.com'})
+    monkeypatch.setattr(time, 'time', lambda: 1_700_003_600.5)
+    second = builder.headers({**SETTINGS, 'email': 'b@example.com'})
+    dates = [line for headers in (first, second) for line in headers.splitlines() if line.startswith(b'Date: ')]
+    assert len(dates) == 2 and dates[0] != dates[1]
+
+
+@pytest.mark.parametrize('address', ['a@example.com, b@example.com', 'a@example.com\nBcc: b@example.com', 'nobody'])
+def test_rejects_recipient_addresses_that_are_not_one_mailbox(address):
+    with pytest.raises(ValueError):
+        MessageBuilder(SETTINGS).headers({**SETTINGS, 'email': address})
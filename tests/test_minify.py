@@ -0,0 +1,41 @@
+"""Minified output keeps the text, conditional comments and CSS fallbacks."""
+import re
+
+import pytest
+
+from minify import minify_html, normalize_declarations
+
+
+def test_minified_skeleton_matches_minified_full_pipeline(generator, data):
+    generator.minify = True
+    record = {'greeting_text': "O'Brien & R&D", 'sections': data['sections'][:2]}
+    assert generator.bulk_renderer(data)(record) == generator.bulk_renderer(data, use_skeleton=False)(record)
+
+
+def test_minify_keeps_text_and_conditional_comments(generator, data):
+    html_content = generator.bulk_renderer(data, use_skeleton=False)({})
+    minified, stats = minify_html(html_content, prune_inlined=True)
+    assert stats.minified_bytes < stats.original_bytes
+    assert minified.count('<!--[if') == html_content.count('<!--[if')
+
+    def text(document):
+        return ' '.join(re.sub(r'<[^>]*>', ' ', re.sub(r'<style\b.*?</style>', '', document, flags=re.S)).split())
+
+    assert text(minified) == text(html_content)
+
+
+@pytest.mark.parametrize('declarations, expected', [
+    ('background: #fff; background: linear-gradient(#fff, #000)',
+     'background:#fff;background:linear-gradient(#fff, #000)'),
+    ('width: 600px; width: 100%', 'width:600px;width:100%'),
+    ('color: red; margin: 0; color: red', 'margin:0;color:red'),
+    ('color: red !important; color: blue', 'color:red !important'),
+])
+def test_normalize_declarations_keeps_fallbacks(declarations, expected):
+    assert normalize_declarations(declarations) == expected
+
+
+def test_minify_keeps_fallback_pairs_in_style_attributes():
+    html_content = '<td style="width: 600px; width: 100%; background: #fff; background: var(--x, #000)">x</td>'
+    minified, _ = minify_html(html_content)
+    assert 'style="width:600px;width:100%;background:#fff;background:var(--x, #000)"' in minified
@@ -0,0 +1,16 @@
+"""Runs through a precompiled skeleton must write the same file as the full pipeline."""
+from generate import NewsletterGenerator
+
+
+def test_precompiled_matches_generate(tmp_path, generator):
+    generator.generate()
+    expected = generator.paths.output.read_bytes()
+
+    for run in range(2):
+        precompiled = NewsletterGenerator(
+            template_path=str(generator.paths.template), output_path=str(tmp_path / f'precompiled{run}.html'),
+            data_path=str(generator.paths.data), size_budget=None,
+            precompiled_path=tmp_path / 'skeleton.bin'
+        )
+        precompiled.generate()
+        assert precompiled.paths.output.read_bytes() == expected
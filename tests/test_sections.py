@@ -0,0 +1,40 @@
+"""Repeated sections: skeletons with loops must match the full pipeline for every loop shape."""
+import copy
+
+import pytest
+
+from generate import NewsletterGenerator
+
+
+@pytest.mark.parametrize('count', [0, 1, 2, 3, 7])
+def test_skeleton_matches_full_pipeline_for_loop_shapes(generator, data, count):
+    sections = copy.deepcopy(data['sections'])
+    sections[0]['title'] = "O'Brien & R&D"
+    sections[-1]['bullets'] = []
+    record = {'sections': (sections * 3)[:count]}
+    skeleton_render = generator.bulk_renderer(data)
+    full = generator.bulk_renderer(data, use_skeleton=False)
+    assert skeleton_render(record) == full(record)
+    assert skeleton_render({}) == full({})
+
+
+def test_skeleton_matches_full_pipeline_for_positional_selectors(tmp_path):
+    template = tmp_path / 'template.html'
+    template.write_text(
+        "<html><head><style>li:nth-child(2) { color: red; } li { color: blue; }</style></head>"
+        "<body><ul>{% for item in items %}<li>{{ item.name }}{% if item.note %} "
+        "<em>{{ item.note }}</em>{% endif %}</li>{% endfor %}</ul></body></html>",
+        encoding='utf-8'
+    )
+    data_path = tmp_path / 'data.yaml'
+    data_path.write_text("items: []\n", encoding='utf-8')
+    generator = NewsletterGenerator(str(template), str(tmp_path / 'out.html'), str(data_path), size_budget=None)
+    records = [
+        {'items': [{'name': "A & B"}, {'name': "C", 'note': "it's"}, {'name': "D"}]},
+        {'items': [{'name': "E"}]},
+        {'items': []},
+    ]
+    skeleton_render = generator.bulk_renderer()
+    full = generator.bulk_renderer(use_skeleton=False)
+    for record in records:
+        assert skeleton_render(record) == full(record)
@@ -0,0 +1,106 @@
+"""The render server's request handling and socket setup."""
+import json
+import socket
+import threading
+
+import pytest
+
+from generate import NewsletterGenerator
+from server import OverlayError, RenderService, create_server
+
+
+@pytest.fixture
+def address(generator):
+    """A render server for the shipped template on a free local port."""
+    server = create_server(RenderService(generator), ('127.0.0.1', 0))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server.server_address[:2]
+    server.shutdown()
+    server.server_close()
+
+
+def request(address, head, body=b''):
+    """Send one raw request and return the status code and the decoded body."""
+    with socket.create_connection(address, timeout=10) as connection:
+        connection.sendall(head.replace('\n', '\r\n').encode('ascii') + b'\r\n' + body)
+        response = b''
+        while b'\r\n\r\n' not in response:
+            response += connection.recv(65536)
+        header, _, content = response.partition(b'\r\n\r\n')
+        length = int(next(line.split(b':')[1] for line in header.split(b'\r\n')
+                          if line.lower().startswith(b'content-length')))
+        while len(content) < length:
+            content += connection.recv(65536)
+    return int(header.split()[1]), content.decode('utf-8')
+
+
+def post(address, overlay, headers=None):
+    """POST ``overlay`` to /render; ``headers`` replace the computed Content-Length."""
+    body = json.dumps(overlay).encode('utf-8')
+    if headers is None:
+        headers = f"Content-Length: {len(body)}\n"
+    return request(address, f"POST /render HTTP/1.1\nHost: test\n{headers}", body)
+
+
+def test_renders_an_overlay(address):
+    status, html_content = post(address, {'greeting_text': "Dear O'Brien & Co,"})
+    assert status == 200
+    assert "Dear O'Brien &amp; Co," in html_content
+
+
+def test_metrics_report_the_cache_sizes(address):
+    post(address, {})
+    status, body = request(address, "GET /metrics HTTP/1.1\nHost: test\n")
+    caches = json.loads(body)['caches']
+    assert status == 200
+    assert caches['templates']['entries'] == 1 and caches['skeletons']['entries'] == 1
+
+
+@pytest.mark.parametrize('overlay', [{'logo_path': '/etc/passwd'}, {'colors': {'text': 'red'}}, {'unused': 1}, []])
+def test_rejects_overlays_setting_protected_or_unknown_keys(address, overlay):
+    assert post(address, overlay)[0] == 400
+
+
+def test_overlay_keys_follow_the_template(tmp_path, generator):
+    template_path = tmp_path / 'template.html'
+    template_path.write_text('<p style="color: {{ colors.text }}">{{ footer_note }}</p>'
+                             '{% for item in items %}<i>{{ item }}</i>{% endfor %}', encoding='utf-8')
+    service = RenderService(NewsletterGenerator(
+        template_path=str(template_path), output_path=str(tmp_path / 'out.html'),
+        data_path=str(generator.paths.data), size_budget=None
+    ))
+    assert service.overlay_keys == {'footer_note', 'items'}
+    html_content = b''.join(service.render({'footer_note': 'Bye', 'items': ['a']})).decode('utf-8')
+    assert '>Bye</p>' in html_content and '<i>a</i>' in html_content
+    with pytest.raises(OverlayError):
+        service.render({'greeting_text': 'Hi'})
+
+
+@pytest.mark.parametrize('headers, status', [
+    ('', 411),
+    ('Content-Length: abc\n', 400),
+    ('Content-Length: -1\n', 400),
+    ('Content-Length: +5\n', 400),
+    ('Content-Length: 1_0\n', 400),
+])
+def test_rejects_missing_or_malformed_content_length(address, headers, status):
+    assert post(address, {}, headers)[0] == status
+
+
+def test_refuses_to_replace_a_file_that_is_not_a_socket(tmp_path):
+    path = tmp_path / 'render.sock'
+    path.write_text('keep')
+    with pytest.raises(ValueError):
+        create_server(None, str(path))
+    assert path.read_text() == 'keep'
+
+
+def test_replaces_a_stale_socket(tmp_path):
+    path = tmp_path / 'render.sock'
+    stale = socket.socket(socket.AF_UNIX)
+    stale.bind(str(path))
+    stale.close()
+    server = create_server(None, str(path))
+    server.server_close()
+    assert path.exists()
@@ -0,0 +1,42 @@
+"""Skeleton fills must produce the same bytes as the full pipeline."""
+import pytest
+
+# Constants
+TRICKY_TEXTS = [
+    "O'Brien & R&D",
+    'He said "hello"',
+    "AT&T's 5 > 3 offer",
+    "a &amp; b",
+    "Café — crème brûlée\xa0!",
+    "&#",
+    "line one\nline two",
+    "",
+]
+TRICKY_URLS = [
+    "https://example.com/?a=1&b=2",
+    "https://example.com/O'Brien",
+    "https://example.com/café menu",
+    'https://example.com/"quoted"',
+]
+
+
+@pytest.mark.parametrize('text', TRICKY_TEXTS)
+@pytest.mark.parametrize('key', ['greeting_text', 'signature', 'newsletter_title', 'blog_url_text', 'logo_alt'])
+def test_skeleton_matches_full_pipeline_for_text(generator, data, key, text):
+    record = {key: text}
+    assert generator.bulk_renderer(data)(record) == generator.bulk_renderer(data, use_skeleton=False)(record)
+
+
+@pytest.mark.parametrize('url', TRICKY_URLS)
+def test_skeleton_matches_full_pipeline_for_attributes(generator, data, url):
+    record = {'blog_url': url}
+    assert generator.bulk_renderer(data)(record) == generator.bulk_renderer(data, use_skeleton=False)(record)
+
+
+def test_skeleton_fills_ordinary_punctuation_without_inlining(generator, data):
+    render = generator.bulk_renderer(data)
+    render({})
+    inlined = []
+    generator._inline_html = lambda html_content: inlined.append(html_content)
+    render({'greeting_text': "O'Brien & R&D", 'signature': 'The "Team"'})
+    assert not inlined
@@ -0,0 +1,17 @@
+"""The compiled template against the per-key replacement it replaced."""
+import re
+
+from generate import CompiledTemplate
+
+
+def plain_replace(html_content, values):
+    """The original placeholder replacement: one str.replace per key."""
+    for key, value in values.items():
+        html_content = html_content.replace(f"{{{{ {key} }}}}", value)
+    return html_content
+
+
+def test_compiled_template_matches_plain_replace(generator, data):
+    source = re.sub(r'\{%.*?%\}', '', generator.read_html_template())
+    values = {key: value for key, value in generator.placeholder_values(data).items() if isinstance(value, str)}
+    assert CompiledTemplate.compile(source).render(values) == plain_replace(source, values)
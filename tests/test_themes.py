@@ -0,0 +1,41 @@
+"""Patched theme palettes must match the full pipeline and stay in the output directory."""
+import pytest
+
+from instrumentation import metrics
+from themes import ThemeVariants, load_themes, theme_output_path
+
+
+@pytest.mark.parametrize('palette', [
+    {'primary': '#112233', 'accent': '#A1B2C3'},
+    {'primary': '#abc', 'tertiary': '#FFF'},
+    {'primary': 'navy', 'text': 'Black'},
+    {'primary': 'transparent'},
+    {'accent': 'currentColor', 'text': 'inherit'},
+    {'primary': 'rgb(10, 20, 30)'},
+])
+def test_theme_patching_matches_full_pipeline(generator, data, palette):
+    themes = ThemeVariants(generator, data).build()
+    colors = {**data['colors'], **palette}
+    assert themes.render(palette) == generator.bulk_renderer({**data, 'colors': colors}, use_skeleton=False)({})
+
+
+def test_render_all_reports_utf8_bytes(generator, data):
+    data['greeting_text'] = 'Café — crème brûlée'
+    metrics.reset()
+    [(_, html_content)] = ThemeVariants(generator, data).build().render_all({'dark': {'text': '#eeeeee'}})
+    assert metrics.to_dict()['stages']['Theme rendering']['output_bytes'] == len(html_content.encode('utf-8'))
+
+
+@pytest.mark.parametrize('name', ['../escape', 'a/b', '..', '.hidden', '', 'dark mode'])
+def test_rejects_theme_names_that_are_not_file_name_parts(tmp_path, name):
+    with pytest.raises(ValueError):
+        theme_output_path(tmp_path / 'newsletter_ready.html', name)
+    themes_path = tmp_path / 'themes.yaml'
+    themes_path.write_text(f'"{name}": {{text: "#eeeeee"}}\n', encoding='utf-8')
+    with pytest.raises(ValueError):
+        load_themes(themes_path)
+
+
+def test_theme_output_path_stays_next_to_the_output(tmp_path):
+    output = tmp_path / 'newsletter_ready.html'
+    assert theme_output_path(output, 'dark-v2.1') == tmp_path / 'newsletter_ready-dark-v2.1.html'
@@ -3,10 +3,13 @@ import os
 import re
 from pathlib import Path
 
+# Automated structure reports (check_clients.py) are not manual client test results
+STRUCTURE_REPORT_SUFFIX = '.structure.report'
+
 def get_latest_report(reports_dir):
-    """Get the most recent report file"""
+    """Get the most recent manual report file"""
     report_files = sorted(
-        [f for f in os.listdir(reports_dir) if f.endswith('.report')],
+        [f for f in os.listdir(reports_dir) if f.endswith('.report') and not f.endswith(STRUCTURE_REPORT_SUFFIX)],
         key=lambda f: os.path.getmtime(os.path.join(reports_dir, f)),
         reverse=True
     )
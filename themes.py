@@ -0,0 +1,325 @@
+import logging
+import re
+from dataclasses import dataclass, replace
+from pathlib import Path
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple, Union
+
+from generate import (
+    HTMLContent,
+    NewsletterGenerator,
+    PlaceholderData,
+    load_yaml_file,
+    log_operation,
+    merge_newsletter_data,
+)
+from instrumentation import metrics, payload_size
+
+# Constants
+COLORS_KEY = 'colors'
+THEME_OUTPUT_FORMAT = '{stem}-{name}{suffix}'
+# Theme names become part of a file name: no separators, no leading dot
+THEME_NAME_PATTERN = re.compile(r'[A-Za-z0-9][A-Za-z0-9._-]*')
+# Sentinel colors are #aabbcc/#abc pairs; how the inliner rewrites each
+# form tells the kinds of position apart
+SENTINEL_COLOR_START = 0x5e1
+LONG_COLOR_PATTERN = re.compile(r'#[0-9a-fA-F]{6}')
+SHORT_COLOR_PATTERN = re.compile(r'#[0-9a-fA-F]{3}')
+SHORTENABLE_COLOR_PATTERN = re.compile(r'#([0-9a-fA-F])\1([0-9a-fA-F])\2([0-9a-fA-F])\3')
+# CSS named colors; keywords like transparent, currentColor or inherit are not colors to patch
+NAMED_COLORS = frozenset({
+    'aliceblue', 'antiquewhite', 'aqua', 'aquamarine', 'azure', 'beige', 'bisque', 'black', 'blanchedalmond',
+    'blue', 'blueviolet', 'brown', 'burlywood', 'cadetblue', 'chartreuse', 'chocolate', 'coral',
+    'cornflowerblue', 'cornsilk', 'crimson', 'cyan', 'darkblue', 'darkcyan', 'darkgoldenrod', 'darkgray',
+    'darkgreen', 'darkgrey', 'darkkhaki', 'darkmagenta', 'darkolivegreen', 'darkorange', 'darkorchid',
+    'darkred', 'darksalmon', 'darkseagreen', 'darkslateblue', 'darkslategray', 'darkslategrey',
+    'darkturquoise', 'darkviolet', 'deeppink', 'deepskyblue', 'dimgray', 'dimgrey', 'dodgerblue', 'firebrick',
+    'floralwhite', 'forestgreen', 'fuchsia', 'gainsboro', 'ghostwhite', 'gold', 'goldenrod', 'gray', 'green',
+    'greenyellow', 'grey', 'honeydew', 'hotpink', 'indianred', 'indigo', 'ivory', 'khaki', 'lavender',
+    'lavenderblush', 'lawngreen', 'lemonchiffon', 'lightblue', 'lightcoral', 'lightcyan',
+    'lightgoldenrodyellow', 'lightgray', 'lightgreen', 'lightgrey', 'lightpink', 'lightsalmon',
+    'lightseagreen', 'lightskyblue', 'lightslategray', 'lightslategrey', 'lightsteelblue', 'lightyellow',
+    'lime', 'limegreen', 'linen', 'magenta', 'maroon', 'mediumaquamarine', 'mediumblue', 'mediumorchid',
+    'mediumpurple', 'mediumseagreen', 'mediumslateblue', 'mediumspringgreen', 'mediumturquoise',
+    'mediumvioletred', 'midnightblue', 'mintcream', 'mistyrose', 'moccasin', 'navajowhite', 'navy', 'oldlace',
+    'olive', 'olivedrab', 'orange', 'orangered', 'orchid', 'palegoldenrod', 'palegreen', 'paleturquoise',
+    'palevioletred', 'papayawhip', 'peachpuff', 'peru', 'pink', 'plum', 'powderblue', 'purple',
+    'rebeccapurple', 'red', 'rosybrown', 'royalblue', 'saddlebrown', 'salmon', 'sandybrown', 'seagreen',
+    'seashell', 'sienna', 'silver', 'skyblue', 'slateblue', 'slategray', 'slategrey', 'snow', 'springgreen',
+    'steelblue', 'tan', 'teal', 'thistle', 'tomato', 'turquoise', 'violet', 'wheat', 'white', 'whitesmoke',
+    'yellow', 'yellowgreen',
+})
+STYLE_BLOCK_SPAN_PATTERN = re.compile(r'<style\b[^>]*>.*?</style>', re.DOTALL | re.IGNORECASE)
+STYLE_ATTRIBUTE_SPAN_PATTERN = re.compile(r'\sstyle\s*=\s*(?:"[^"]*"|\'[^\']*\')', re.IGNORECASE)
+BGCOLOR_ATTRIBUTE_SPAN_PATTERN = re.compile(r'\sbgcolor\s*=\s*(?:"[^"]*"|\'[^\']*\')', re.IGNORECASE)
+POSITION_CONTEXTS = (
+    ('style block', STYLE_BLOCK_SPAN_PATTERN),
+    ('style attribute', STYLE_ATTRIBUTE_SPAN_PATTERN),
+    ('bgcolor attribute', BGCOLOR_ATTRIBUTE_SPAN_PATTERN),
+)
+
+logger = logging.getLogger(__name__)
+
+Palette = Dict[str, str]
+
+
+@dataclass(frozen=True)
+class ColorPosition:
+    """Where a color ends up in the inlined output.
+
+    ``offset`` is the position in the output without colors and
+    ``context`` the kind of markup around it. ``shortens`` marks
+    declarations the inliner serialized, which write ``#aabbcc`` as
+    ``#abc``; ``expands`` marks attributes it derived from CSS, which write
+    ``#abc`` as ``#aabbcc`` (None until a palette needed to know).
+    """
+    offset: int
+    key: str
+    context: str
+    shortens: bool
+    expands: Optional[bool] = None
+
+
+def load_themes(path: Union[str, Path]) -> Dict[str, Palette]:
+    """Read a YAML mapping of theme names to palettes (partial ``colors`` blocks)."""
+    themes = load_yaml_file(path) or {}
+    if not isinstance(themes, dict) or not all(isinstance(palette, dict) for palette in themes.values()):
+        raise ValueError(f"{path} must map theme names to color mappings")
+    for name in themes:
+        check_theme_name(str(name))
+    return {str(name): {key: str(value) for key, value in palette.items()} for name, palette in themes.items()}
+
+
+def check_theme_name(name: str) -> str:
+    """Return the name if it can be used in a file name as it is, raise ValueError otherwise."""
+    if not THEME_NAME_PATTERN.fullmatch(name):
+        raise ValueError(f"Theme name {name!r} must be letters, digits, '.', '_' or '-' and not start with '.'")
+    return name
+
+
+def theme_output_path(output: Union[str, Path], name: str) -> Path:
+    """``newsletter_ready.html`` becomes ``newsletter_ready-<name>.html``, next to it."""
+    output = Path(output)
+    check_theme_name(name)
+    return output.with_name(THEME_OUTPUT_FORMAT.format(stem=output.stem, name=name, suffix=output.suffix))
+
+
+def color_forms(value: str) -> Optional[Tuple[str, str, str]]:
+    """The color as written verbatim, where the inliner shortens it and where
+    it expands it; None for values it may rewrite in ways not modelled here."""
+    match = SHORTENABLE_COLOR_PATTERN.fullmatch(value)
+    if match:
+        return value, '#' + ''.join(match.groups()), value
+    if SHORT_COLOR_PATTERN.fullmatch(value):
+        return value, value, '#' + ''.join(digit * 2 for digit in value[1:])
+    if LONG_COLOR_PATTERN.fullmatch(value) or value.lower() in NAMED_COLORS:
+        return value, value, value
+    return None
+
+
+def palette_signature(palette: Palette) -> Hashable:
+    """What the inliner's rewriting of a patchable palette depends on.
+
+    Hex colors of the same length and letter case are rewritten alike, so
+    one verified palette stands for all palettes with the same signature;
+    named colors are only trusted name by name.
+    """
+    signature = []
+    for key, value in sorted(palette.items()):
+        if value.lower() in NAMED_COLORS:
+            signature.append((key, value))
+            continue
+        verbatim, shortened, _ = color_forms(value)
+        length = 'short' if len(value) == 4 else 'shortenable' if shortened != verbatim else 'long'
+        case = 'lower' if value == value.lower() else 'upper' if value == value.upper() else 'mixed'
+        signature.append((key, length, case))
+    return tuple(signature)
+
+
+def _context(offset: int, spans: List[Tuple[str, int, int]]) -> str:
+    """The kind of markup an offset falls into."""
+    for context, start, end in spans:
+        if start <= offset < end:
+            return context
+    return 'markup'
+
+
+class ThemeVariants:
+    """Render one issue in many color palettes from a single inlining pass.
+
+    The issue is rendered once through the full pipeline with a unique
+    ``#aabbcc`` sentinel color for every key of the ``colors`` block.
+    Wherever a sentinel comes out (the ``<style>`` block, inlined ``style``
+    attributes, ``bgcolor`` attributes, plain markup) its position is
+    recorded, and each palette is then patched in at those offsets with a
+    single join.
+
+    The inliner does not copy every color verbatim: declarations it
+    serializes write ``#aabbcc`` as ``#abc``, which the sentinels reveal,
+    and attributes it derives from CSS write ``#abc`` as ``#aabbcc``, which
+    a second sentinel pass with short sentinels reveals the first time a
+    palette needs it. Patching is checked against the full pipeline once
+    per palette signature (see
+    ``palette_signature``) and the full render is used wherever the two
+    differ; palettes with values whose rewriting is not modelled (see
+    ``color_forms``) fall back to the full pipeline on their own.
+    """
+
+    def __init__(self, generator: NewsletterGenerator, newsletter_data: Optional[PlaceholderData] = None):
+        self.generator = generator
+        self.newsletter_data = newsletter_data if newsletter_data is not None else generator.read_newsletter_data()
+        self.colors: Palette = {
+            key: str(value) for key, value in (self.newsletter_data.get(COLORS_KEY) or {}).items()
+        }
+        self.positions: List[ColorPosition] = []
+        self._literals: List[str] = []
+        self._sentinel_digits: Dict[str, str] = {}
+        self._patchable = False
+        self._expansion_known: Optional[bool] = None
+        # Whether patching matched the full pipeline, per palette signature
+        self._verified: Dict[Hashable, bool] = {}
+
+    def _choose_sentinels(self, source: HTMLContent) -> None:
+        """Pick three hex digits per key whose short and long forms occur nowhere in the template."""
+        candidate = SENTINEL_COLOR_START
+        for key in self.colors:
+            while True:
+                digits = f"{candidate:03x}"
+                candidate += 1
+                long_digits = ''.join(digit * 2 for digit in digits)
+                if not re.search(f'#(?:{digits}|{long_digits})(?![0-9a-fA-F])', source, re.IGNORECASE):
+                    break
+            self._sentinel_digits[key] = digits
+
+    def _render_full(self, palette: Palette) -> HTMLContent:
+        """The issue in one palette through the whole pipeline."""
+        data = merge_newsletter_data(self.newsletter_data, {COLORS_KEY: palette})
+        return self.generator.bulk_renderer(data, use_skeleton=False)({})
+
+    def _sentinel_pass(self, short: bool) -> Tuple[HTMLContent, List[str], List[Tuple[str, bool, int]]]:
+        """Render with sentinels and split the output at them.
+
+        Returns the output, the literals between colors and, per color, its
+        key, whether it came out in the long form and where it starts.
+        """
+        forms: Dict[str, Tuple[str, bool]] = {}
+        palette: Palette = {}
+        for key, digits in self._sentinel_digits.items():
+            long_form = '#' + ''.join(digit * 2 for digit in digits)
+            forms[long_form] = (key, True)
+            forms['#' + digits] = (key, False)
+            palette[key] = '#' + digits if short else long_form
+        html_content = self._render_full(palette)
+        pattern = re.compile(
+            '(' + '|'.join(re.escape(form) for form in forms) + ')(?![0-9a-fA-F])', re.IGNORECASE
+        )
+
+        literals: List[str] = []
+        found: List[Tuple[str, bool, int]] = []
+        position = 0
+        for match in pattern.finditer(html_content):
+            literals.append(html_content[position:match.start()])
+            found.append((*forms[match.group(1).lower()], match.start()))
+            position = match.end()
+        literals.append(html_content[position:])
+        return html_content, literals, found
+
+    @log_operation("Theme precomputation")
+    def build(self) -> 'ThemeVariants':
+        """Inline the sentinel render once and record where every color ends up."""
+        if not self.colors:
+            logger.warning(f"No {COLORS_KEY} in the newsletter data; every theme renders the same")
+            return self
+
+        self._choose_sentinels(self.generator.read_html_template())
+        html_content, self._literals, found = self._sentinel_pass(short=False)
+        spans = [
+            (context, match.start(), match.end())
+            for context, span_pattern in POSITION_CONTEXTS
+            for match in span_pattern.finditer(html_content)
+        ]
+        offset = 0
+        for literal, (key, long_form, start) in zip(self._literals, found):
+            offset += len(literal)
+            self.positions.append(ColorPosition(offset, key, _context(start, spans), shortens=not long_form))
+
+        counts: Dict[str, int] = {}
+        for color_position in self.positions:
+            counts[color_position.context] = counts.get(color_position.context, 0) + 1
+        logger.info(f"Recorded {len(self.positions)} color positions: "
+                    + ", ".join(f"{count} in {context}s" for context, count in sorted(counts.items())))
+
+        self._patchable = self.patchable(self.colors) and self._verify(self.colors)[0]
+        if not self._patchable:
+            logger.warning("Patched colors differ from the full pipeline; rendering every theme in full")
+        return self
+
+    def _verify(self, palette: Palette) -> Tuple[bool, Optional[HTMLContent]]:
+        """Whether patching ``palette`` matches the full pipeline, checked once per
+        palette signature; returns the full render as well when it was needed."""
+        signature = palette_signature(palette)
+        if signature in self._verified:
+            return self._verified[signature], None
+        full = self._render_full(palette)
+        self._verified[signature] = self._patch(palette) == full
+        metrics.increment('themes.verified')
+        return self._verified[signature], full
+
+    def _learn_expansion(self) -> bool:
+        """Find the positions that write ``#abc`` as ``#aabbcc`` (one more sentinel pass)."""
+        if self._expansion_known is None:
+            _, literals, found = self._sentinel_pass(short=True)
+            self._expansion_known = literals == self._literals
+            if self._expansion_known:
+                self.positions = [
+                    replace(color_position, expands=long_form)
+                    for color_position, (_, long_form, _) in zip(self.positions, found)
+                ]
+            else:
+                logger.warning("Short colors change the inlined layout; they are rendered in full")
+        return self._expansion_known
+
+    def patchable(self, palette: Palette) -> bool:
+        """Whether every value of the palette can be patched in."""
+        for value in palette.values():
+            forms = color_forms(value)
+            if forms is None or (forms[2] != value and not self._learn_expansion()):
+                return False
+        return True
+
+    def _patch(self, palette: Palette) -> HTMLContent:
+        """Fill the recorded positions with a complete palette."""
+        forms = {key: color_forms(value) for key, value in palette.items()}
+        parts = [self._literals[0]]
+        for color_position, literal in zip(self.positions, self._literals[1:]):
+            verbatim, shortened, expanded = forms[color_position.key]
+            if color_position.shortens:
+                parts.append(shortened)
+            elif color_position.expands:
+                parts.append(expanded)
+            else:
+                parts.append(verbatim)
+            parts.append(literal)
+        return "".join(parts)
+
+    def render(self, palette: Palette) -> HTMLContent:
+        """The issue in ``palette``; keys it leaves out keep the issue's colors."""
+        palette = {**self.colors, **palette}
+        full = None
+        if self._patchable and palette.keys() == self.colors.keys() and self.patchable(palette):
+            matches, full = self._verify(palette)
+            if matches:
+                metrics.increment('themes.patched')
+                return self._patch(palette)
+            logger.warning("Patched palette differs from the full pipeline; using the full pipeline")
+        else:
+            logger.info("Palette cannot be patched in; using the full pipeline")
+        metrics.increment('themes.full')
+        return full if full is not None else self._render_full(palette)
+
+    def render_all(self, themes: Dict[str, Palette]) -> Iterator[Tuple[str, HTMLContent]]:
+        """Yield ``(name, html)`` for every theme."""
+        for name, palette in themes.items():
+            with metrics.stage("Theme rendering") as probe:
+                html_content = self.render(palette)
+                probe.output_bytes = payload_size(html_content)
+            yield name, html_content
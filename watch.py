@@ -0,0 +1,88 @@
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from generate import NewsletterGenerator, PlaceholderData
+
+# Constants
+DEFAULT_POLL_INTERVAL = 0.2
+
+logger = logging.getLogger(__name__)
+
+FileSignature = Optional[Tuple[int, int]]
+
+
+def file_signature(path: Path) -> FileSignature:
+    """The mtime and size of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+
+class Watcher:
+    """Keep the generator resident and regenerate whenever an input changes.
+
+    The template, the data file and the logo referenced by the data are
+    polled with ``os.stat`` (inotify would need a third-party package).
+    Regeneration goes through the generator's caches: a change to text
+    values only refills the inlined skeleton, a color change rebuilds the
+    skeleton, a template change recompiles, and the logo is only re-encoded
+    when the file itself changed. The output is replaced atomically.
+    """
+
+    def __init__(self, generator: NewsletterGenerator, interval: float = DEFAULT_POLL_INTERVAL):
+        self.generator = generator
+        self.interval = interval
+        self._signatures: Dict[Path, FileSignature] = {}
+
+    def _watched_files(self, newsletter_data: Optional[PlaceholderData]) -> List[Path]:
+        """Template, data file and logo (if the data names one)."""
+        files = [self.generator.paths.template, self.generator.paths.data]
+        if newsletter_data and newsletter_data.get('logo_path'):
+            files.append(Path(newsletter_data['logo_path']))
+        return files
+
+    def _changed_files(self, files: List[Path]) -> List[Path]:
+        """Update the stored signatures and return the files that changed."""
+        changed = []
+        for path in files:
+            signature = file_signature(path)
+            if self._signatures.get(path, ()) != signature:
+                self._signatures[path] = signature
+                changed.append(path)
+        return changed
+
+    def regenerate(self) -> Optional[PlaceholderData]:
+        """Regenerate the output, logging and swallowing errors so watching continues."""
+        started = time.perf_counter()
+        try:
+            newsletter_data = self.generator.read_newsletter_data()
+            self.generator.regenerate(newsletter_data)
+        except Exception as e:
+            logger.error(f"Regeneration failed: {e}")
+            return None
+        logger.info(f"Regenerated {self.generator.paths.output} in {(time.perf_counter() - started) * 1000:.0f} ms")
+        return newsletter_data
+
+    def run(self, max_iterations: Optional[int] = None) -> None:
+        """Poll for changes until interrupted (or for ``max_iterations`` polls)."""
+        self._changed_files(self._watched_files(None))
+        newsletter_data = self.regenerate()
+        self._changed_files(self._watched_files(newsletter_data))
+        logger.info(f"Watching {', '.join(str(p) for p in self._watched_files(newsletter_data))}")
+
+        iterations = 0
+        while max_iterations is None or iterations < max_iterations:
+            iterations += 1
+            time.sleep(self.interval)
+            changed = self._changed_files(self._watched_files(newsletter_data))
+            if not changed:
+                continue
+            logger.info(f"Changed: {', '.join(str(p) for p in changed)}")
+            newsletter_data = self.regenerate() or newsletter_data
+            # Pick up a logo that the data now points to
+            self._changed_files(self._watched_files(newsletter_data))